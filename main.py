@@ -1,4 +1,5 @@
 import sys
+from typing import List
 
 sys.path.append('./src')
 
@@ -6,10 +7,17 @@ import click
 
 import utils
 import const
+from data import augmentations
+from data.catalog import DatasetCatalog
+from data.displacement_bank import DisplacementFieldBank
 from data.datasets import *
+from data.datasets.chunked_dataset import CODECS as CHUNK_CODECS
 from data.dataloaders import *
+from data.samplers import *
 from model.losses import *
-from pipeline import Pipeline, METRICS_DICT
+from model import metrics_log
+from model.utils import PRECISIONS
+from pipeline import Pipeline, METRICS_DICT, SCHEDULES
 
 
 @click.group()
@@ -17,6 +25,76 @@ def cli():
     """Segmentation pipeline with additional utilities."""
 
 
+def create_dataset(
+        dataset_type: str, data_paths: const.DataPaths, img_ids: List[str], numpy_access: str,
+        nifti_cache_mb: int, nifti_spill_dp: str, nifti_gzip_index: bool = False, nifti_gzip_index_dp: str = None,
+        catalog: DatasetCatalog = None, chunk_cache_mb: int = 1024, mask_format: str = 'uint8',
+        n_workers: int = 0, numpy_cache_volumes: int = 32, numpy_cache_mb: int = None,
+        numpy_slice_cache_mb: int = None
+) -> BaseDataset:
+    """
+    :param n_workers: number of data loader worker processes the dataset is read in.
+    each worker keeps its own caches, so `nifti_cache_mb`, `numpy_cache_mb` and `numpy_slice_cache_mb`
+    are split across them
+    :param numpy_cache_mb: max size of volume cache of numpy dataset. no limit if None
+    :param numpy_slice_cache_mb: max size of slice cache of numpy dataset.
+    defaults to 1024 with 'mmap' access (slices are gathered from pages of the whole volume) and to 0 otherwise
+    """
+    if dataset_type == 'nifti':
+        dataset = NiftiDataset(
+            data_paths.scans_dp, data_paths.masks_dp, img_ids,
+            cache_max_bytes=nifti_cache_mb * 1024 ** 2 // max(n_workers, 1), spill_dp=nifti_spill_dp,
+            use_gzip_index=nifti_gzip_index, gzip_index_dp=nifti_gzip_index_dp, catalog=catalog
+        )
+    elif dataset_type == 'numpy':
+        ndp = const.NumpyDataPaths(data_paths.default_numpy_dataset_dp)
+        masks_dp = ndp.masks_bits_dp if mask_format == 'bits' else ndp.masks_dp
+        if numpy_slice_cache_mb is None:
+            numpy_slice_cache_mb = 1024 if numpy_access == 'mmap' else 0
+        dataset = NumpyDataset(
+            ndp.scans_dp, masks_dp, ndp.shapes_fp, img_ids, access_mode=numpy_access,
+            cache_max_volumes=numpy_cache_volumes,
+            cache_max_bytes=numpy_cache_mb * 1024 ** 2 // max(n_workers, 1) if numpy_cache_mb is not None else None,
+            slice_cache_max_bytes=numpy_slice_cache_mb * 1024 ** 2 // max(n_workers, 1), mask_format=mask_format
+        )
+    elif dataset_type == 'packed':
+        dataset = PackedDataset(data_paths.default_numpy_dataset_dp, img_ids)
+    elif dataset_type == 'chunked':
+        dataset = ChunkedDataset(
+            data_paths.default_numpy_dataset_dp, img_ids, chunk_cache_max_bytes=chunk_cache_mb * 1024 ** 2
+        )
+    else:
+        raise ValueError(f"`dataset` should be in ['nifti', 'numpy', 'packed', 'chunked']. passed '{dataset_type}'")
+    return dataset
+
+
+def create_sampler(
+        dataset: BaseDataset, data_paths: const.DataPaths, shuffle_window_volumes: int, empty_slices_ratio: float
+) -> BaseSampler:
+    """
+    Create sampler for train loader. Returns None if samples are to be shuffled globally.
+    """
+    sampler = VolumeLocalitySampler(shuffle_window_volumes) if shuffle_window_volumes is not None else None
+    if empty_slices_ratio is not None:
+        # slices stats of numpy dataset match datasets of all the types built from the same images
+        dataset.load_slices_stats(const.NumpyDataPaths(data_paths.default_numpy_dataset_dp).slices_stats_fp)
+        sampler = ForegroundSampler(empty_slices_ratio, sampler)
+    return sampler
+
+
+def prepare_loader(
+        loader: BaseDataLoader, n_workers: int, prefetch_depth: int, device: str
+) -> BaseDataLoader:
+    """
+    Wrap loader with `PrefetchDataLoader` if needed and make it collate batches into preallocated tensors.
+    Workers already pass masks bit-packed, so such masks are kept packed up to the device.
+    """
+    if n_workers > 0:
+        loader = PrefetchDataLoader(loader, n_workers=n_workers, prefetch_depth=prefetch_depth)
+    loader.use_batch_buffers(pin_memory=torch.device(device).type == 'cuda', pack_masks=n_workers > 0)
+    return loader
+
+
 @cli.command(short_help='Build and train the model. Heavy augs and warm start are supported.')
 @click.option('--launch', help='launch location. used to determine default paths',
               type=click.Choice(['local', 'server']), default='server', show_default=True)
@@ -24,12 +102,82 @@ def cli():
               type=click.Choice(['unet', 'mnet2']), default='unet', show_default=True)
 @click.option('--device', help='device to use',
               type=click.Choice(['cpu', 'cuda:0', 'cuda:1']), default='cuda:0', show_default=True)
+@click.option('--precision', help='precision to run the model in: float32 (fp32) '
+                                  'or bfloat16 / float16 autocast (bf16, fp16). fp16 requires cuda device',
+              type=click.Choice(PRECISIONS), default='fp32', show_default=True)
 @click.option('--dataset', 'dataset_type', help='dataset type',
-              type=click.Choice(['nifti', 'numpy']), default='numpy', show_default=True)
+              type=click.Choice(['nifti', 'numpy', 'packed', 'chunked']), default='numpy', show_default=True)
+@click.option('--numpy-access', help='how to read .npy volumes of numpy dataset: '
+                                     'load the whole volume for each slice or memory-map it',
+              type=click.Choice(NumpyDataset.ACCESS_MODES), default='load', show_default=True)
+@click.option('--numpy-cache-volumes', help='max number of memory-mapped volumes of numpy dataset to keep open. '
+                                            'used with --numpy-access mmap',
+              type=click.INT, default=32, show_default=True)
+@click.option('--numpy-cache-mb', help='max size of volume cache of numpy dataset in MB. '
+                                       'memory-mapped volumes are counted as 0 bytes. no limit if no value passed',
+              type=click.INT, default=None)
+@click.option('--numpy-slice-cache-mb', help='max size of cache of recently read slices of numpy dataset in MB. '
+                                             'with --workers cache sizes are split evenly across worker processes. '
+                                             'defaults to 1024 with --numpy-access mmap and to 0 otherwise',
+              type=click.INT, default=None)
+@click.option('--mask-format', help='format of masks of numpy dataset: one byte per pixel or bit-packed',
+              type=click.Choice(NumpyDataset.MASK_FORMATS), default='uint8', show_default=True)
+@click.option('--chunk-cache-mb', help='max size of decompressed chunks cache of chunked dataset in MB',
+              type=click.INT, default=1024, show_default=True)
+@click.option('--nifti-cache-mb', help='max size of decoded volumes cache of nifti dataset in MB. '
+                                       'train and valid datasets have caches of their own. '
+                                       'with --workers the size is split evenly across worker processes, '
+                                       'as each process keeps its own cache: pass --nifti-spill-dir '
+                                       'to decompress each file once. '
+                                       'pass 0 to decompress .nii.gz file for each slice',
+              type=click.INT, default=2048, show_default=True)
+@click.option('--nifti-spill-dir', 'nifti_spill_dp',
+              help='scratch directory to store decoded volumes of nifti dataset to as uncompressed .npy files. '
+                   'each .nii.gz file is decompressed at most once if passed',
+              type=click.STRING, default=None)
+@click.option('--nifti-gzip-index/--no-nifti-gzip-index', 'nifti_gzip_index',
+              help='whether to read slices of nifti dataset through gzip seek-point index. '
+                   'used only with --nifti-cache-mb 0 and no --nifti-spill-dir. requires indexed_gzip package',
+              default=False, show_default=True)
+@click.option('--nifti-gzip-index-dir', 'nifti_gzip_index_dp',
+              help='directory to store gzip indices of nifti dataset to. '
+                   'indices are stored next to .nii.gz files if no value passed',
+              type=click.STRING, default=None)
+@click.option('--catalog', 'catalog_fp',
+              help='path to SQLite catalog of nifti images. created if does not exist. '
+                   'image headers are read only for new or changed files if passed',
+              type=click.STRING, default=None)
 @click.option('--heavy-augs/--no-heavy-augs', 'apply_heavy_augs',
               help='whether to apply different number of augmentations for hard and regular train images'
                    ' (uses docs/hard_cases_mapping.csv to identify hard cases)',
               default=True, show_default=True)
+@click.option('--aug-backend', help='how to augment train images: one by one with numpy (numpy) '
+                                    'or the whole batch at once with torch (torch)',
+              type=click.Choice(augmentations.AUG_BACKENDS), default='numpy', show_default=True)
+@click.option('--displacement-bank-dir', 'displacement_bank_dp',
+              help='directory to store pools of precomputed displacement fields for elastic deformations to. '
+                   'used by numpy augmentations. fields are generated for each slice if no value passed',
+              type=click.STRING, default=None)
+@click.option('--displacement-bank-size', help='number of displacement fields in pool for each slice shape',
+              type=click.INT, default=64, show_default=True)
+@click.option('--displacement-bank-refresh',
+              help='number of draws from pool of displacement fields after which pool is regenerated. '
+                   'never regenerate if no value passed',
+              type=click.INT, default=None)
+@click.option('--shuffle-window', 'shuffle_window_volumes',
+              help='shuffle train slices within windows of this many volumes to make reads cache-friendly. '
+                   'shuffle all slices globally if no value passed',
+              type=click.INT, default=None)
+@click.option('--empty-slices-ratio', help='share of train slices without lungs to use on each epoch. '
+                                           'empty slices are chosen randomly on each epoch. '
+                                           'use all slices if no value passed',
+              type=click.FloatRange(0, 1), default=None)
+@click.option('--workers', 'n_workers', help='number of worker processes that build batches. '
+                                              'pass 0 to build batches in the main process',
+              type=click.INT, default=0, show_default=True)
+@click.option('--prefetch', 'prefetch_depth', help='max number of batches prefetched by workers. '
+                                                   'defaults to 2 * workers',
+              type=click.INT, default=None)
 @click.option('--epochs', 'n_epochs', help='max number of epochs to train',
               type=click.INT, required=True)
 @click.option('--out', 'out_dp', help='directory path to store artifacts',
@@ -39,10 +187,47 @@ def cli():
               type=click.INT, default=None)
 @click.option('--checkpoint', 'initial_checkpoint_fp', help='path to initial .pth checkpoint for warm start',
               type=click.STRING, default=None)
+@click.option('--schedule', help='learning rate schedule: reduce learning rate on validation loss plateau '
+                                 '(plateau) or 1-cycle policy with learning rate changed after each batch (onecycle)',
+              type=click.Choice(SCHEDULES), default='plateau', show_default=True)
+@click.option('--max-lr', help='max learning rate of 1-cycle policy. '
+                               'suggested from lr-find results if no value passed',
+              type=click.FLOAT, default=None)
+@click.option('--lr-finder-results', 'lr_finder_results_fp',
+              help='path to .csv results of lr-find to suggest max learning rate of 1-cycle policy from. '
+                   'defaults to results of lr-find with default --out',
+              type=click.STRING, default=None)
+@click.option('--anneal', 'anneal_strategy', help='how to anneal learning rate in 1-cycle policy',
+              type=click.Choice(['cos', 'linear']), default='cos', show_default=True)
+@click.option('--sync-every', help='number of batches to show running loss and metrics after. '
+                                   'loss and metrics are kept on the device and are copied '
+                                   'only in the end of epoch if no value passed',
+              type=click.INT, default=None)
+@click.option('--keep-last', help='number of last epoch checkpoints to keep. '
+                                  'checkpoint of the best epoch is always kept. '
+                                  'keep all epoch checkpoints if neither --keep-last nor --keep-every passed',
+              type=click.IntRange(min=1), default=None)
+@click.option('--keep-every', help='keep checkpoints of every n-th epoch in addition to --keep-last',
+              type=click.IntRange(min=1), default=None)
+@click.option('--state-every', help='number of train batches to save full training state after '
+                                    'to resume from with --resume. state is saved in the end of each epoch anyway',
+              type=click.IntRange(min=1), default=None)
+@click.option('--resume', 'resume_dp', help='directory of interrupted training (its --out) to resume from '
+                                            'the last saved training state. pass the same options '
+                                            'as to the interrupted run',
+              type=click.STRING, default=None)
 def train(
-        launch: str, model_architecture: str, device: str, dataset_type: str,
-        apply_heavy_augs: bool, n_epochs: int, out_dp: str, max_batches: int,
-        initial_checkpoint_fp: str
+        launch: str, model_architecture: str, device: str, precision: str,
+        dataset_type: str, numpy_access: str, numpy_cache_volumes: int, numpy_cache_mb: int,
+        numpy_slice_cache_mb: int, mask_format: str, chunk_cache_mb: int,
+        nifti_cache_mb: int, nifti_spill_dp: str, nifti_gzip_index: bool, nifti_gzip_index_dp: str, catalog_fp: str,
+        apply_heavy_augs: bool, aug_backend: str,
+        displacement_bank_dp: str, displacement_bank_size: int, displacement_bank_refresh: int,
+        shuffle_window_volumes: int, empty_slices_ratio: float,
+        n_workers: int, prefetch_depth: int, n_epochs: int,
+        out_dp: str, max_batches: int, initial_checkpoint_fp: str,
+        schedule: str, max_lr: float, lr_finder_results_fp: str, anneal_strategy: str, sync_every: int,
+        keep_last: int, keep_every: int, state_every: int, resume_dp: str
 ):
     """Build and train the model. Heavy augs and warm start are supported."""
     loss_func = METRICS_DICT['NegDiceLoss']
@@ -56,16 +241,25 @@ def train(
     data_paths = const.DataPaths()
 
     split = utils.load_split_from_yaml(const.TRAIN_VALID_SPLIT_FP)
+    catalog = DatasetCatalog(catalog_fp) if catalog_fp is not None else None
 
-    if dataset_type == 'nifti':
-        train_dataset = NiftiDataset(data_paths.scans_dp, data_paths.masks_dp, split['train'])
-        valid_dataset = NiftiDataset(data_paths.scans_dp, data_paths.masks_dp, split['valid'])
-    elif dataset_type == 'numpy':
-        ndp = const.NumpyDataPaths(data_paths.default_numpy_dataset_dp)
-        train_dataset = NumpyDataset(ndp.scans_dp, ndp.masks_dp, ndp.shapes_fp, split['train'])
-        valid_dataset = NumpyDataset(ndp.scans_dp, ndp.masks_dp, ndp.shapes_fp, split['valid'])
-    else:
-        raise ValueError(f"`dataset` should be in ['nifti', 'numpy']. passed '{dataset_type}'")
+    train_dataset = create_dataset(
+        dataset_type, data_paths, split['train'], numpy_access, nifti_cache_mb, nifti_spill_dp,
+        nifti_gzip_index, nifti_gzip_index_dp, catalog, chunk_cache_mb, mask_format, n_workers,
+        numpy_cache_volumes, numpy_cache_mb, numpy_slice_cache_mb
+    )
+    valid_dataset = create_dataset(
+        dataset_type, data_paths, split['valid'], numpy_access, nifti_cache_mb, nifti_spill_dp,
+        nifti_gzip_index, nifti_gzip_index_dp, catalog, chunk_cache_mb, mask_format, n_workers,
+        numpy_cache_volumes, numpy_cache_mb, numpy_slice_cache_mb
+    )
+
+    sampler = create_sampler(train_dataset, data_paths, shuffle_window_volumes, empty_slices_ratio)
+
+    if displacement_bank_dp is not None:
+        bank = DisplacementFieldBank(displacement_bank_dp, displacement_bank_size, displacement_bank_refresh)
+        print(f'\nwill draw displacement fields for elastic deformations from {bank}')
+        augmentations.set_displacement_bank(bank)
 
     # init train data loader
     if apply_heavy_augs:
@@ -76,23 +270,31 @@ def train(
             const.HARD_CASES_MAPPING, const.TRAIN_VALID_SPLIT_FP
         )
         train_dataset.set_different_aug_cnt_for_two_subsets(1, ids_hard_train, 3)
+        train_dataset.set_aug_backend(aug_backend)
         # init loader
-        train_loader = DataLoaderNoAugmentations(train_dataset, batch_size=4, to_shuffle=True)
+        train_loader = DataLoaderNoAugmentations(train_dataset, batch_size=4, to_shuffle=True, sampler=sampler)
     else:
         print('\nwill apply the same augmentations for all train images')
         train_loader = DataLoaderWithAugmentations(
-            train_dataset, orig_img_per_batch=2, aug_cnt=1, to_shuffle=True
+            train_dataset, orig_img_per_batch=2, aug_cnt=1, to_shuffle=True, sampler=sampler,
+            aug_backend=aug_backend
         )
 
     valid_loader = DataLoaderNoAugmentations(valid_dataset, batch_size=4, to_shuffle=False)
 
+    train_loader = prepare_loader(train_loader, n_workers, prefetch_depth, device)
+    valid_loader = prepare_loader(valid_loader, n_workers, prefetch_depth, device)
+
     device_t = torch.device(device)
     pipeline = Pipeline(model_architecture=model_architecture, device=device_t)
 
     pipeline.train(
         train_loader=train_loader, valid_loader=valid_loader,
         n_epochs=n_epochs, loss_func=loss_func, metrics=metrics,
-        out_dp=out_dp, max_batches=max_batches, initial_checkpoint_fp=initial_checkpoint_fp
+        out_dp=out_dp, max_batches=max_batches, initial_checkpoint_fp=initial_checkpoint_fp,
+        precision=precision, schedule=schedule, max_lr=max_lr, lr_finder_results_fp=lr_finder_results_fp,
+        anneal_strategy=anneal_strategy, sync_every=sync_every,
+        keep_last=keep_last, keep_every=keep_every, state_every=state_every, resume_dp=resume_dp
     )
 
 
@@ -103,11 +305,18 @@ def train(
               type=click.Choice(['unet', 'mnet2']), default='unet', show_default=True)
 @click.option('--device', help='device to use',
               type=click.Choice(['cpu', 'cuda:0', 'cuda:1']), default='cuda:0', show_default=True)
+@click.option('--precision', help='precision to run the model in: float32 (fp32) '
+                                  'or bfloat16 / float16 autocast (bf16, fp16). fp16 requires cuda device',
+              type=click.Choice(PRECISIONS), default='fp32', show_default=True)
 @click.option('--checkpoint', 'checkpoint_fp',
               help='path to checkpoint .pth file',
               type=click.STRING, default=None)
 @click.option('--scans', 'scans_dp', help='path to directory with nifti scans',
               type=click.STRING, default=None)
+@click.option('--catalog', 'catalog_fp',
+              help='path to SQLite catalog of nifti images. created if does not exist. '
+                   'image headers are read only for new or changed files if passed',
+              type=click.STRING, default=None)
 @click.option('--subset', help='what scans to segment under --scans dir: '
                                'either all, or the ones from "validation" dataset',
               type=click.Choice(['all', 'validation']), default='all', show_default=True)
@@ -115,10 +324,16 @@ def train(
               type=click.STRING, default=None)
 @click.option('--postfix', help='postfix to set for segmented masks',
               type=click.STRING, default='autolungs', show_default=True)
+@click.option('--crop-body/--no-crop-body',
+              help='whether to segment only body bounding box of scans. '
+                   'use for models trained on datasets created with --crop-body',
+              default=False, show_default=True)
+@click.option('--crop-margin', help='margin of body bounding box in pixels',
+              type=click.INT, default=const.BODY_CROP_MARGIN, show_default=True)
 def segment_scans(
-        launch: str, model_architecture: str, device: str,
-        checkpoint_fp: str, scans_dp: str, subset: str,
-        output_dp: str, postfix: str
+        launch: str, model_architecture: str, device: str, precision: str,
+        checkpoint_fp: str, scans_dp: str, catalog_fp: str, subset: str,
+        output_dp: str, postfix: str, crop_body: bool, crop_margin: int
 ):
     """Segment Nifti `.nii.gz` scans with already trained model stored in `.pth` file."""
     const.set_launch_type_env_var(launch == 'local')
@@ -134,9 +349,12 @@ def segment_scans(
         split = utils.load_split_from_yaml(const.TRAIN_VALID_SPLIT_FP)
         ids_list = split['valid']
 
+    catalog = DatasetCatalog(catalog_fp) if catalog_fp is not None else None
+
     pipeline.segment_scans(
         checkpoint_fp=checkpoint_fp, scans_dp=scans_dp,
-        ids=ids_list, output_dp=output_dp, postfix=postfix
+        ids=ids_list, output_dp=output_dp, postfix=postfix, catalog=catalog,
+        crop_body=crop_body, crop_margin=crop_margin, precision=precision
     )
 
 
@@ -147,34 +365,95 @@ def segment_scans(
               type=click.Choice(['unet', 'mnet2']), default='unet', show_default=True)
 @click.option('--device', help='device to use',
               type=click.Choice(['cpu', 'cuda:0', 'cuda:1']), default='cuda:0', show_default=True)
+@click.option('--precision', help='precision to run the model in: float32 (fp32) '
+                                  'or bfloat16 / float16 autocast (bf16, fp16). fp16 requires cuda device',
+              type=click.Choice(PRECISIONS), default='fp32', show_default=True)
 @click.option('--dataset', 'dataset_type', help='dataset type',
-              type=click.Choice(['nifti', 'numpy']), default='numpy', show_default=True)
+              type=click.Choice(['nifti', 'numpy', 'packed', 'chunked']), default='numpy', show_default=True)
+@click.option('--numpy-access', help='how to read .npy volumes of numpy dataset: '
+                                     'load the whole volume for each slice or memory-map it',
+              type=click.Choice(NumpyDataset.ACCESS_MODES), default='load', show_default=True)
+@click.option('--numpy-cache-volumes', help='max number of memory-mapped volumes of numpy dataset to keep open. '
+                                            'used with --numpy-access mmap',
+              type=click.INT, default=32, show_default=True)
+@click.option('--numpy-cache-mb', help='max size of volume cache of numpy dataset in MB. '
+                                       'memory-mapped volumes are counted as 0 bytes. no limit if no value passed',
+              type=click.INT, default=None)
+@click.option('--numpy-slice-cache-mb', help='max size of cache of recently read slices of numpy dataset in MB. '
+                                             'with --workers cache sizes are split evenly across worker processes. '
+                                             'defaults to 1024 with --numpy-access mmap and to 0 otherwise',
+              type=click.INT, default=None)
+@click.option('--mask-format', help='format of masks of numpy dataset: one byte per pixel or bit-packed',
+              type=click.Choice(NumpyDataset.MASK_FORMATS), default='uint8', show_default=True)
+@click.option('--chunk-cache-mb', help='max size of decompressed chunks cache of chunked dataset in MB',
+              type=click.INT, default=1024, show_default=True)
+@click.option('--nifti-cache-mb', help='max size of decoded volumes cache of nifti dataset in MB. '
+                                       'with --workers the size is split evenly across worker processes, '
+                                       'as each process keeps its own cache: pass --nifti-spill-dir '
+                                       'to decompress each file once. '
+                                       'pass 0 to decompress .nii.gz file for each slice',
+              type=click.INT, default=2048, show_default=True)
+@click.option('--nifti-spill-dir', 'nifti_spill_dp',
+              help='scratch directory to store decoded volumes of nifti dataset to as uncompressed .npy files. '
+                   'each .nii.gz file is decompressed at most once if passed',
+              type=click.STRING, default=None)
+@click.option('--nifti-gzip-index/--no-nifti-gzip-index', 'nifti_gzip_index',
+              help='whether to read slices of nifti dataset through gzip seek-point index. '
+                   'used only with --nifti-cache-mb 0 and no --nifti-spill-dir. requires indexed_gzip package',
+              default=False, show_default=True)
+@click.option('--nifti-gzip-index-dir', 'nifti_gzip_index_dp',
+              help='directory to store gzip indices of nifti dataset to. '
+                   'indices are stored next to .nii.gz files if no value passed',
+              type=click.STRING, default=None)
+@click.option('--catalog', 'catalog_fp',
+              help='path to SQLite catalog of nifti images. created if does not exist. '
+                   'image headers are read only for new or changed files if passed',
+              type=click.STRING, default=None)
+@click.option('--shuffle-window', 'shuffle_window_volumes',
+              help='shuffle train slices within windows of this many volumes to make reads cache-friendly. '
+                   'shuffle all slices globally if no value passed',
+              type=click.INT, default=None)
+@click.option('--empty-slices-ratio', help='share of train slices without lungs to use on each epoch. '
+                                           'empty slices are chosen randomly on each epoch. '
+                                           'use all slices if no value passed',
+              type=click.FloatRange(0, 1), default=None)
+@click.option('--workers', 'n_workers', help='number of worker processes that build batches. '
+                                              'pass 0 to build batches in the main process',
+              type=click.INT, default=0, show_default=True)
+@click.option('--prefetch', 'prefetch_depth', help='max number of batches prefetched by workers. '
+                                                   'defaults to 2 * workers',
+              type=click.INT, default=None)
 @click.option('--out', 'out_dp', help='directory path to store artifacts',
               type=click.STRING, default=None)
 def lr_find(
-        launch: str, model_architecture: str, device: str,
-        dataset_type: str, out_dp: str
+        launch: str, model_architecture: str, device: str, precision: str,
+        dataset_type: str, numpy_access: str, numpy_cache_volumes: int, numpy_cache_mb: int,
+        numpy_slice_cache_mb: int, mask_format: str, chunk_cache_mb: int, nifti_cache_mb: int,
+        nifti_spill_dp: str,
+        nifti_gzip_index: bool, nifti_gzip_index_dp: str, catalog_fp: str, shuffle_window_volumes: int,
+        empty_slices_ratio: float, n_workers: int, prefetch_depth: int, out_dp: str
 ):
     """Find optimal LR for training with 1-cycle policy."""
     const.set_launch_type_env_var(launch == 'local')
     data_paths = const.DataPaths()
 
     split = utils.load_split_from_yaml(const.TRAIN_VALID_SPLIT_FP)
+    catalog = DatasetCatalog(catalog_fp) if catalog_fp is not None else None
 
-    if dataset_type == 'nifti':
-        train_dataset = NiftiDataset(data_paths.scans_dp, data_paths.masks_dp, split['train'])
-    elif dataset_type == 'numpy':
-        ndp = const.NumpyDataPaths(data_paths.default_numpy_dataset_dp)
-        train_dataset = NumpyDataset(ndp.scans_dp, ndp.masks_dp, ndp.shapes_fp, split['train'])
-    else:
-        raise ValueError(f"`dataset` should be in ['nifti', 'numpy']. passed '{dataset_type}'")
+    train_dataset = create_dataset(
+        dataset_type, data_paths, split['train'], numpy_access, nifti_cache_mb, nifti_spill_dp,
+        nifti_gzip_index, nifti_gzip_index_dp, catalog, chunk_cache_mb, mask_format, n_workers,
+        numpy_cache_volumes, numpy_cache_mb, numpy_slice_cache_mb
+    )
 
     loss_func = METRICS_DICT['NegDiceLoss']
-    train_loader = DataLoaderNoAugmentations(train_dataset, batch_size=4, to_shuffle=True)
+    sampler = create_sampler(train_dataset, data_paths, shuffle_window_volumes, empty_slices_ratio)
+    train_loader = DataLoaderNoAugmentations(train_dataset, batch_size=4, to_shuffle=True, sampler=sampler)
+    train_loader = prepare_loader(train_loader, n_workers, prefetch_depth, device)
     device_t = torch.device(device)
 
     pipeline = Pipeline(model_architecture=model_architecture, device=device_t)
-    pipeline.lr_find_and_store(loss_func=loss_func, train_loader=train_loader, out_dp=out_dp)
+    pipeline.lr_find_and_store(loss_func=loss_func, train_loader=train_loader, out_dp=out_dp, precision=precision)
 
 
 @cli.command(short_help='Create numpy dataset from initial Nifti scans.')
@@ -184,12 +463,49 @@ def lr_find(
               type=click.STRING, default=None)
 @click.option('--masks', 'masks_dp', help='path to directory with nifti binary masks',
               type=click.STRING, default=None)
-@click.option('--zoom', 'zoom_factor', help='zoom factor for output images',
-              type=click.FLOAT, default=0.25, show_default=True)
-@click.option('--out', 'output_dp', help='path to output directory with numpy dataset',
+@click.option('--catalog', 'catalog_fp',
+              help='path to SQLite catalog of nifti images. created if does not exist. '
+                   'image headers are read only for new or changed files if passed',
+              type=click.STRING, default=None)
+@click.option('--zoom', 'zoom_factors', help='zoom factor for output images. pass multiple times '
+                                            'to create datasets for several zoom factors from a single decode',
+              type=click.FLOAT, multiple=True, default=[0.25], show_default=True)
+@click.option('--out', 'output_dp', help='path to output directory with numpy dataset. '
+                                         'if several zoom factors are passed - path to parent directory '
+                                         'for the datasets',
               type=click.STRING, default=None)
+@click.option('--packed/--no-packed', 'store_packed',
+              help='whether to additionally store slice-major shards for packed dataset',
+              default=False, show_default=True)
+@click.option('--chunked/--no-chunked', 'store_chunked',
+              help='whether to additionally store compressed chunks for chunked dataset',
+              default=False, show_default=True)
+@click.option('--chunk-size', help='number of slices in a single chunk of chunked dataset',
+              type=click.INT, default=8, show_default=True)
+@click.option('--chunk-codec', help='compression codec for chunks of chunked dataset. lz4 requires lz4 package',
+              type=click.Choice(CHUNK_CODECS), default='zlib', show_default=True)
+@click.option('--crop-body/--no-crop-body',
+              help='whether to crop images to body bounding box before zoom. '
+                   'bounding boxes are stored to crops.json',
+              default=False, show_default=True)
+@click.option('--crop-margin', help='margin of body bounding box in pixels of source images',
+              type=click.INT, default=const.BODY_CROP_MARGIN, show_default=True)
+@click.option('--workers', 'n_workers', help='number of worker processes that process images. '
+                                              'defaults to number of CPUs',
+              type=click.INT, default=None)
+@click.option('--rebuild/--no-rebuild',
+              help='whether to remove output directory and process all the images. '
+                   'otherwise only new or changed images are processed',
+              default=False, show_default=True)
+@click.option('--verify/--no-verify', 'verify_checksums',
+              help='whether to compare checksums of existing outputs with the ones stored in manifest. '
+                   'reads all the outputs',
+              default=False, show_default=True)
 def create_numpy_dataset(
-        launch: str, scans_dp: str, masks_dp: str, zoom_factor: float, output_dp: str
+        launch: str, scans_dp: str, masks_dp: str, catalog_fp: str, zoom_factors: List[float], output_dp: str,
+        store_packed: bool, store_chunked: bool, chunk_size: int, chunk_codec: str,
+        crop_body: bool, crop_margin: int, n_workers: int, rebuild: bool,
+        verify_checksums: bool
 ):
     """Create numpy dataset from initial Nifti `.nii.gz` scans to speedup the training."""
     const.set_launch_type_env_var(launch == 'local')
@@ -198,11 +514,28 @@ def create_numpy_dataset(
     scans_dp = scans_dp or data_paths.scans_dp
     masks_dp = masks_dp or data_paths.masks_dp
 
-    numpy_data_root_dp = data_paths.get_numpy_data_root_dp(zoom_factor=zoom_factor)
-    output_dp = output_dp or numpy_data_root_dp
+    if len(zoom_factors) == 1 and output_dp is not None:
+        output_dps = {zoom_factors[0]: output_dp}
+    else:
+        output_dps = {zf: data_paths.get_numpy_data_root_dp(zoom_factor=zf, parent_dp=output_dp) for zf in zoom_factors}
+
+    catalog = DatasetCatalog(catalog_fp) if catalog_fp is not None else None
+    ds = NiftiDataset(scans_dp, masks_dp, catalog=catalog)
+    chunked_params = {'chunk_size': chunk_size, 'codec': chunk_codec} if store_chunked else None
+    crop_params = {'margin': crop_margin} if crop_body else None
+    ds.store_as_numpy_datasets(
+        output_dps, store_packed=store_packed, n_workers=n_workers, rebuild=rebuild,
+        chunked_params=chunked_params, crop_params=crop_params, verify_checksums=verify_checksums
+    )
+
 
-    ds = NiftiDataset(scans_dp, masks_dp)
-    ds.store_as_numpy_dataset(output_dp, zoom_factor)
+@cli.command(short_help='Build learning curves and batch statistics plots of training run.')
+@click.option('--run', 'run_dp', help='directory of training run (--out of train). '
+                                     'can be used while training is in progress',
+              type=click.STRING, default=const.RESULTS_DN, show_default=True)
+def plot_run(run_dp: str):
+    """Build learning curves and batch statistics plots of training run from its metrics log."""
+    metrics_log.plot_run(run_dp)
 
 
 if __name__ == '__main__':
@@ -14,14 +14,29 @@ BODY_THRESH_HIGH = 1500
 
 MASK_BINARIZATION_THRESH = -500
 
+# margin (in pixels of source image) added to body bounding box when cropping images
+BODY_CROP_MARGIN = 10
+
+# slices of a batch are padded so that height and width are divisible by this value
+# (input size of the network has to be divisible by 2 ** number of poolings:
+# 4 for UNet and 5 for MobileNetV2_UNet. the largest one is used for all the architectures)
+PAD_MULTIPLE = 32
+
 ZOOM_FACTOR = 0.25
 
+# distance between seek points of gzip index (see `utils.build_gzip_index`)
+GZIP_INDEX_SPACING_MB = 4
+GZIP_INDEX_EXT = '.gzidx'
+
 # ----------- paths relative to project folder ----------- #
 
 RESULTS_DN = 'results'
 MODEL_CHECKPOINTS_DN = 'model_checkpoints'
+TRAINING_STATE_FN = 'training_state.pickle'
+METRICS_LOG_FN = 'metrics.jsonl'
 SEGMENTED_DN = 'segmented'
 LR_FINDER_RESULTS_DN = 'lr_finder'
+LR_FINDER_RESULTS_FN = 'lr_finder_results.csv'
 
 DOCS_DN = 'docs'
 TRAIN_VALID_SPLIT_FP = os.path.join(DOCS_DN, 'train_valid_split.yaml')
@@ -82,15 +97,15 @@ class DataPaths:
     def default_numpy_dataset_dp(self):
         return self._default_numpy_dataset_dp
 
-    def get_numpy_data_root_dp(self, zoom_factor=None):
+    def get_numpy_data_root_dp(self, zoom_factor=None, parent_dp=None):
         """
         get dir path where processed images are to be stored after dataset creation
-        :param mark_as_new: whether to add '_new' postfix to avoid occasional overwrite on the the ready dataset
+        :param parent_dp: directory to create dataset directory in. defaults to data root directory
         """
         dirname = f'processed_z{zoom_factor}' \
             if zoom_factor is not None and zoom_factor != 1 \
             else 'processed_no_zoom'
-        return os.path.join(self._root_dp, dirname)
+        return os.path.join(parent_dp or self._root_dp, dirname)
 
 
 # ----------- paths for NumpyDataset ----------- #
@@ -100,8 +115,12 @@ class NumpyDataPaths:
         self._root_dp = root_dp
         self._scans_dp = os.path.join(self._root_dp, 'numpy', 'scans')
         self._masks_dp = os.path.join(self._root_dp, 'numpy', 'masks')
+        self._masks_bits_dp = os.path.join(self._root_dp, 'numpy', 'masks_bits')
         self._shapes_fp = os.path.join(self._root_dp, 'numpy', 'shapes.pickle')
         self._nifti_dp = os.path.join(self._root_dp, 'nifti')
+        self._manifest_fp = os.path.join(self._root_dp, 'manifest.json')
+        self._crops_fp = os.path.join(self._root_dp, 'crops.json')
+        self._slices_stats_fp = os.path.join(self._root_dp, 'slices_stats.json')
 
     @property
     def root_dp(self):
@@ -115,6 +134,10 @@ class NumpyDataPaths:
     def masks_dp(self):
         return self._masks_dp
 
+    @property
+    def masks_bits_dp(self):
+        return self._masks_bits_dp
+
     @property
     def shapes_fp(self):
         return self._shapes_fp
@@ -122,3 +145,82 @@ class NumpyDataPaths:
     @property
     def nifti_dp(self):
         return self._nifti_dp
+
+    @property
+    def manifest_fp(self):
+        return self._manifest_fp
+
+    @property
+    def crops_fp(self):
+        return self._crops_fp
+
+    @property
+    def slices_stats_fp(self):
+        return self._slices_stats_fp
+
+
+# ----------- paths for PackedDataset ----------- #
+
+class PackedDataPaths:
+    def __init__(self, root_dp):
+        self._root_dp = root_dp
+        self._packed_dp = os.path.join(self._root_dp, 'packed')
+        self._scans_dp = os.path.join(self._packed_dp, 'scans')
+        self._masks_dp = os.path.join(self._packed_dp, 'masks')
+        self._index_fp = os.path.join(self._packed_dp, 'index.npy')
+        self._volumes_fp = os.path.join(self._packed_dp, 'volumes.json')
+
+    @property
+    def root_dp(self):
+        return self._root_dp
+
+    @property
+    def packed_dp(self):
+        return self._packed_dp
+
+    @property
+    def scans_dp(self):
+        return self._scans_dp
+
+    @property
+    def masks_dp(self):
+        return self._masks_dp
+
+    @property
+    def index_fp(self):
+        return self._index_fp
+
+    @property
+    def volumes_fp(self):
+        return self._volumes_fp
+
+
+# ----------- paths for ChunkedDataset ----------- #
+
+class ChunkedDataPaths:
+    def __init__(self, root_dp):
+        self._root_dp = root_dp
+        self._chunked_dp = os.path.join(self._root_dp, 'chunked')
+        self._chunks_dp = os.path.join(self._chunked_dp, 'chunks')
+        self._index_fp = os.path.join(self._chunked_dp, 'index.npy')
+        self._volumes_fp = os.path.join(self._chunked_dp, 'volumes.json')
+
+    @property
+    def root_dp(self):
+        return self._root_dp
+
+    @property
+    def chunked_dp(self):
+        return self._chunked_dp
+
+    @property
+    def chunks_dp(self):
+        return self._chunks_dp
+
+    @property
+    def index_fp(self):
+        return self._index_fp
+
+    @property
+    def volumes_fp(self):
+        return self._volumes_fp
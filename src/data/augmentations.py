@@ -1,28 +1,46 @@
 import cv2
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter
-from scipy.ndimage.interpolation import map_coordinates
 
+# 'numpy' - augment samples one by one (see `get_single_augmentation`).
+# 'torch' - augment whole batch at once (see `batch_augmentations.augment_batch`)
+AUG_BACKENDS = ['numpy', 'torch']
 
-def elastic_transform(image, alpha, sigma, alpha_affine, random_state=None):
+FIELD_DTYPE = np.dtype(np.float32)
+
+# pool of precomputed displacement fields for elastic transform (see `set_displacement_bank`)
+_displacement_bank = None
+
+
+def set_displacement_bank(bank):
     """
-    Elastic deformation of images as described in [Simard2003]_ (with modifications).
-    [Simard2003] Simard, Steinkraus and Platt, "Best Practices for
-    Convolutional Neural Networks applied to Visual Document Analysis", in
-    Proc. of the International Conference on Document Analysis and
-    Recognition, 2003.
+    Draw displacement fields of elastic transform from `DisplacementFieldBank`
+    instead of generating and smoothing new random fields for each sample.
+    Pass None to generate fields for each sample.
+    """
+    global _displacement_bank
+    _displacement_bank = bank
 
-    written by Eduard Sniazko.
-    Based on https://gist.github.com/erniejunior/601cdf56d2b424757de5
+
+def get_smoothed_field(shape: tuple, sigma: float, random_state: np.random.RandomState, mode: str = 'reflect'):
     """
-    if random_state is None:
-        random_state = np.random.RandomState(None)
+    Generate single smoothed random displacement field of unit amplitude.
+
+    Field is the smoothed mean of two uniform fields: that is what smoothing of (H, W, 2) random field
+    along all the axes with sigma much larger than 2 ends up with, as the original elastic transform did.
+    The same is done here to keep the magnitude of displacements.
+    """
+    noise = (random_state.rand(*shape) * 2 - 1 + random_state.rand(*shape) * 2 - 1) / 2
+    return gaussian_filter(noise, sigma, mode=mode).astype(FIELD_DTYPE)
 
-    k_size = 1  # number of slice and labels pairs
-    shape = image.shape
-    shape_size = shape[:2]
 
-    # Random affine
+def get_random_affine_transform(shape_size: tuple, alpha_affine: float, random_state: np.random.RandomState):
+    """
+    Build random affine transform: three points around the center of the slice
+    are moved by random offsets from [-alpha_affine, alpha_affine].
+
+    :return: 2x3 affine matrix of (x, y) pixel coordinates
+    """
     center_square = np.float32(shape_size) // 2
     square_size = min(shape_size) // 3
     pts1 = np.float32([
@@ -31,53 +49,60 @@ def elastic_transform(image, alpha, sigma, alpha_affine, random_state=None):
         center_square - square_size]
     )
     pts2 = pts1 + random_state.uniform(-alpha_affine, alpha_affine, size=pts1.shape).astype(np.float32)
-    M = cv2.getAffineTransform(pts1, pts2)
+    return cv2.getAffineTransform(pts1, pts2)
+
+
+def elastic_transform_fused(image, alpha, sigma, alpha_affine, random_state=None):
+    """
+    Elastic deformation of images as described in [Simard2003]_ (with modifications).
+    [Simard2003] Simard, Steinkraus and Platt, "Best Practices for
+    Convolutional Neural Networks applied to Visual Document Analysis", in
+    Proc. of the International Conference on Document Analysis and
+    Recognition, 2003.
+
+    written by Eduard Sniazko.
+    Based on https://gist.github.com/erniejunior/601cdf56d2b424757de5
+
+    Random affine transform and elastic displacement are composed into a single coordinates map:
+    output pixel (x, y) is taken from input pixel `M^-1 @ (x + dx, y + dy, 1)`.
+    The map is applied to all channels at once with single `cv2.remap` call,
+    so each pixel is resampled once instead of warping and displacing it separately.
+    All channels are displaced with the same field.
+
+    :param image: np.ndarray of shape (H, W, C) with scan channels followed by labels channel
+    :return: transformed image of the same shape and dtype
+    """
+    if random_state is None:
+        # draw from the global random state, so augmentations are reproduced when it's seeded or restored
+        random_state = np.random.RandomState(np.random.randint(2 ** 31))
+
+    shape_size = image.shape[:2]
+    h, w = shape_size
+
+    M = get_random_affine_transform(shape_size, alpha_affine, random_state)
+
+    field = _displacement_bank.get_field(shape_size, sigma, random_state) \
+        if _displacement_bank is not None else None
+    if field is None:
+        field = np.stack([get_smoothed_field(shape_size, sigma, random_state) for _ in range(2)])
+
+    x = np.arange(w, dtype=FIELD_DTYPE)[np.newaxis, :] + field[0] * alpha
+    y = np.arange(h, dtype=FIELD_DTYPE)[:, np.newaxis] + field[1] * alpha
+    # pixels displaced outside of the affine-warped image are filled with min values
+    outside = (x < -0.5) | (x >= w - 0.5) | (y < -0.5) | (y >= h - 0.5)
 
-    im_ = image[:, :, :-k_size].copy()
-    roi_ = image[:, :, -k_size:].copy()
-    shape_im = im_.shape
-    shape_roi = roi_.shape
+    M_inv = cv2.invertAffineTransform(M)
+    map_x = (M_inv[0, 0] * x + M_inv[0, 1] * y + M_inv[0, 2]).astype(FIELD_DTYPE)
+    map_y = (M_inv[1, 0] * x + M_inv[1, 1] * y + M_inv[1, 2]).astype(FIELD_DTYPE)
+    map_x[outside] = -1
+    map_y[outside] = -1
 
     # cv2 does not accept numpy's dtypes
-    im_min_value = float(np.min(im_))
-    roi_min_value = float(np.min(roi_))
-
-    for i in range(im_.shape[2]):
-        im_t = im_[:, :, i]
-        im_t = cv2.warpAffine(
-            im_t, M, shape_size[::-1], flags=cv2.INTER_NEAREST,
-            borderMode=cv2.BORDER_CONSTANT, borderValue=im_min_value)
-        im_[:, :, i] = im_t[:]
-
-    for i in range(roi_.shape[2]):
-        roi_t = roi_[:, :, i]
-        roi_t = cv2.warpAffine(
-            roi_t, M, shape_size[::-1], flags=cv2.INTER_NEAREST,
-            borderMode=cv2.BORDER_CONSTANT, borderValue=roi_min_value)
-        roi_[:, :, i] = roi_t[:]
-
-    dx = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma) * alpha
-    dy = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma) * alpha
-    dz = np.zeros_like(dx)
-
-    x, y, z = np.meshgrid(np.arange(shape_im[1]), np.arange(shape_im[0]), np.arange(shape_im[2]))
-    indices = np.reshape(y + dy[:, :, :-k_size], (-1, 1)), \
-              np.reshape(x + dx[:, :, :-k_size], (-1, 1)), \
-              np.reshape(z, (-1, 1))
-    im_o = map_coordinates(
-        im_, indices, order=0, mode='constant', cval=im_min_value, prefilter=False).reshape(shape_im)
-
-    x, y, z = np.meshgrid(np.arange(shape_roi[1]), np.arange(shape_roi[0]), np.arange(shape_roi[2]))
-    indices = np.reshape(y + dy[:, :, -k_size:], (-1, 1)), \
-              np.reshape(x + dx[:, :, -k_size:], (-1, 1)), \
-              np.reshape(z, (-1, 1))
-    roi_o = map_coordinates(
-        roi_, indices, order=0, mode='constant', cval=roi_min_value, prefilter=False).reshape(shape_roi)
-
-    image[:, :, :-k_size] = im_o
-    image[:, :, -k_size:] = roi_o
-
-    return image
+    min_values = [float(v) for v in image.reshape(-1, image.shape[2]).min(axis=0)]
+    res = cv2.remap(
+        image, map_x, map_y, interpolation=cv2.INTER_NEAREST,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=min_values)
+    return res.reshape(image.shape)
 
 
 def gen_aug_vector():
@@ -126,10 +151,9 @@ def apply_aug(_img, _index, _value):
     if _index == 2:  # horizontal flip
         # _img = np.fliplr(_img)
         return _img
-    if _index == 3:  # elastic_transform
+    if _index == 3:  # elastic transform
         if _value == 1:
-            # _img = elastic_transform(_img, _img.shape[1] * 0.4, _img.shape[1] * 0.05, _img.shape[1] * 0.05)
-            _img = elastic_transform(_img, _img.shape[1] * 0.4, _img.shape[1] * 0.07, _img.shape[1] * 0.07)
+            _img = elastic_transform_fused(_img, _img.shape[1] * 0.4, _img.shape[1] * 0.07, _img.shape[1] * 0.07)
         return _img
     if _index == 4:  # intensity shift
         _tim = _img[:, :, :-k_size]
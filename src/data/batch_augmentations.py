@@ -0,0 +1,148 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# the same parameters as of `augmentations.apply_aug` relative to slice width
+ALPHA_COEF = 0.4
+SIGMA_COEF = 0.07
+ALPHA_AFFINE_COEF = 0.07
+INTENSITY_SHIFTS = np.arange(-16, 17)
+
+
+def get_inverse_affine_matrices(n: int, h: int, w: int, alpha_affine: float) -> np.ndarray:
+    """
+    Build random affine transforms the same way `augmentations.get_random_affine_transform` does:
+    three points around the center of the slice are moved by random offsets
+    from [-alpha_affine, alpha_affine] (see `cv2.getAffineTransform`).
+
+    :return: np.ndarray of shape (N, 2, 3) with inverse transforms of (x, y, 1) pixel coordinates
+    """
+    center_square = np.float32([h, w]) // 2
+    square_size = min(h, w) // 3
+    pts1 = np.float32([
+        center_square + square_size,
+        [center_square[0] + square_size, center_square[1] - square_size],
+        center_square - square_size]
+    )
+    pts2 = pts1 + np.random.uniform(-alpha_affine, alpha_affine, size=(n, *pts1.shape)).astype(np.float32)
+
+    res = np.empty((n, 2, 3), dtype=np.float32)
+    for i in range(n):
+        res[i] = cv2.invertAffineTransform(cv2.getAffineTransform(pts1, pts2[i]))
+    return res
+
+
+def gaussian_blur(x: torch.Tensor, sigma: float) -> torch.Tensor:
+    """
+    Separable gaussian blur of (N, C, H, W) tensor with reflect padding.
+    Kernel is truncated at 4 sigma as in `scipy.ndimage.gaussian_filter`.
+    """
+    radius = int(4 * sigma + 0.5)
+    coords = torch.arange(-radius, radius + 1, dtype=x.dtype, device=x.device)
+    kernel = torch.exp(-0.5 * (coords / sigma) ** 2)
+    kernel = kernel / kernel.sum()
+
+    n_channels = x.shape[1]
+    for dim in [2, 3]:
+        # reflect padding must be smaller than the size of the tensor
+        pad = min(radius, x.shape[dim] - 1)
+        k = kernel[radius - pad: radius + pad + 1]
+        if dim == 2:
+            x = F.pad(x, [0, 0, pad, pad], mode='reflect')
+            weight = k.view(1, 1, -1, 1)
+        else:
+            x = F.pad(x, [pad, pad, 0, 0], mode='reflect')
+            weight = k.view(1, 1, 1, -1)
+        x = F.conv2d(x, weight.expand(n_channels, 1, *weight.shape[2:]), groups=n_channels)
+    return x
+
+
+def get_sampling_grid(
+        n: int, h: int, w: int, alpha: float, sigma: float, alpha_affine: float, device: torch.device
+) -> torch.Tensor:
+    """
+    Build sampling grid that composes random affine transform and random elastic displacement:
+    output pixel (x, y) is taken from input pixel `M^-1 @ (x + dx, y + dy, 1)`,
+    which is what `augmentations.elastic_transform_fused` does.
+
+    :return: grid of shape (N, H, W, 2) for `F.grid_sample` with `align_corners=True`
+    """
+    # mean of two uniform fields as in `augmentations.get_smoothed_field`
+    displacement = torch.rand(n, 2, h, w, device=device) + torch.rand(n, 2, h, w, device=device) - 1
+    displacement = gaussian_blur(displacement, sigma) * alpha
+
+    xs = torch.arange(w, dtype=torch.float32, device=device).view(1, 1, w)
+    ys = torch.arange(h, dtype=torch.float32, device=device).view(1, h, 1)
+    x = xs + displacement[:, 0]
+    y = ys + displacement[:, 1]
+
+    m_inv = torch.from_numpy(get_inverse_affine_matrices(n, h, w, alpha_affine)).to(device).view(n, 2, 3, 1, 1)
+    x_src = m_inv[:, 0, 0] * x + m_inv[:, 0, 1] * y + m_inv[:, 0, 2]
+    y_src = m_inv[:, 1, 0] * x + m_inv[:, 1, 1] * y + m_inv[:, 1, 2]
+
+    # normalize pixel coordinates to [-1, 1]
+    grid = torch.stack([
+        2 * x_src / max(w - 1, 1) - 1,
+        2 * y_src / max(h - 1, 1) - 1
+    ], dim=-1)
+    return grid
+
+
+def warp_nearest(x: torch.Tensor, grid: torch.Tensor) -> torch.Tensor:
+    """
+    Resample (N, H, W) tensor with nearest-neighbour interpolation.
+    Pixels outside of the input are filled with the min value of each sample (as `augmentations` do).
+    """
+    x = x.float()
+    fill = x.flatten(1).min(dim=1)[0].view(-1, 1, 1)
+    res = F.grid_sample((x - fill).unsqueeze(1), grid, mode='nearest', padding_mode='zeros', align_corners=True)
+    return res.squeeze(1) + fill
+
+
+def augment_batch(scans: np.ndarray, masks: np.ndarray, device: torch.device = None):
+    """
+    Apply random affine + elastic deformation and intensity shift to the whole batch at once with torch ops.
+    Counterpart of `augmentations.get_single_augmentation` applied to each slice of the batch.
+
+    Scans and masks are warped with the same sampling grid with nearest-neighbour interpolation,
+    so masks stay binary and consistent with scans.
+
+    :param scans: np.ndarray of shape (N, H, W)
+    :param masks: np.ndarray of shape (N, H, W)
+    :param device: device to run augmentations on. cpu if None
+    :return: (scans, masks) np.ndarrays with the same shape and dtypes
+    """
+    device = device or torch.device('cpu')
+    n, h, w = scans.shape
+    if n == 0:
+        return scans, masks
+
+    grid = get_sampling_grid(
+        n, h, w, alpha=w * ALPHA_COEF, sigma=w * SIGMA_COEF, alpha_affine=w * ALPHA_AFFINE_COEF, device=device
+    )
+    scans_t = warp_nearest(torch.from_numpy(np.ascontiguousarray(scans)).to(device), grid)
+    masks_t = warp_nearest(torch.from_numpy(np.ascontiguousarray(masks)).to(device), grid)
+
+    shifts = torch.from_numpy(np.random.choice(INTENSITY_SHIFTS, n)).to(device=device, dtype=torch.float32)
+    scans_t = scans_t + shifts.view(-1, 1, 1)
+
+    scans_res = scans_t.round().cpu().numpy().astype(scans.dtype)
+    masks_res = masks_t.round().cpu().numpy().astype(np.uint8)
+    return scans_res, masks_res
+
+
+def augment_samples_in_batch(scans, masks, to_augment: np.ndarray, device: torch.device = None):
+    """
+    Augment selected samples of the batch at once (see `augment_batch`).
+
+    :param scans: list of 2D np.ndarrays of the same shape or 3D np.ndarray of shape (N, H, W)
+    :param masks: list of 2D np.ndarrays or 3D np.ndarray with the same shape as `scans`
+    :param to_augment: bool array. whether to augment each sample
+    :return: (scans, masks) 3D np.ndarrays
+    """
+    scans, masks = np.stack(scans), np.stack(masks)
+    ixs = np.flatnonzero(to_augment)
+    if len(ixs) > 0:
+        scans[ixs], masks[ixs] = augment_batch(scans[ixs], masks[ixs], device)
+    return scans, masks
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+def get_nbytes(value) -> int:
+    """
+    Estimate number of bytes occupied by cached value.
+    Memory-mapped arrays are not resident in process memory, so they are counted as 0 bytes.
+    """
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(x) for x in value)
+    return 0
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache with hit / miss counters.
+
+    Cache can be bounded by number of items and / or by total number of bytes
+    occupied by cached values. Size of each value is estimated with `get_size` function.
+    Pass None for both limits to get an unbounded cache.
+    """
+
+    def __init__(self, max_items: int = None, max_bytes: int = None, get_size=get_nbytes, on_evict=None):
+        """
+        :param max_items: max number of items to keep. no limit if None
+        :param max_bytes: max total size of items to keep. no limit if None
+        :param get_size: function that returns size of value in bytes
+        :param on_evict: optional callback `f(key, value)` called for each evicted item
+        """
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._get_size = get_size
+        self._on_evict = on_evict
+
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        info = self.cache_info()
+        return (f'LRUCache('
+                f'items: {info["items"]}/{info["max_items"]}; '
+                f'bytes: {info["bytes"]}/{info["max_bytes"]}; '
+                f'hits: {info["hits"]}; '
+                f'misses: {info["misses"]})')
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def enabled(self):
+        return self._max_items != 0 and self._max_bytes != 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+
+        size = self._get_size(value)
+        if self._max_bytes is not None and size > self._max_bytes:
+            # value would evict the whole cache and still not fit
+            return
+
+        if key in self._data:
+            self._remove(key)
+
+        self._data[key] = value
+        self._sizes[key] = size
+        self._nbytes += size
+        self._evict_if_needed()
+
+    def get_or_load(self, key, load_func):
+        """
+        Return cached value for `key` or load it with `load_func()` and cache it.
+        """
+        value = self.get(key)
+        if value is None:
+            value = load_func()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        for key in list(self._data.keys()):
+            self._evict(key)
+
+    def cache_info(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'items': len(self._data),
+            'bytes': self._nbytes,
+            'max_items': self._max_items,
+            'max_bytes': self._max_bytes
+        }
+
+    def _remove(self, key):
+        value = self._data.pop(key)
+        self._nbytes -= self._sizes.pop(key)
+        return value
+
+    def _evict(self, key):
+        value = self._remove(key)
+        if self._on_evict is not None:
+            self._on_evict(key, value)
+
+    def _evict_if_needed(self):
+        while self._data and (
+                self._max_items is not None and len(self._data) > self._max_items or
+                self._max_bytes is not None and self._nbytes > self._max_bytes
+        ):
+            oldest_key = next(iter(self._data))
+            self._evict(oldest_key)
@@ -0,0 +1,207 @@
+import json
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import const
+import utils
+
+_CREATE_TABLE_QUERY = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    id TEXT NOT NULL,
+    postfix TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    dtype TEXT NOT NULL,
+    affine TEXT NOT NULL,
+    spacing TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+)
+'''
+_CREATE_INDEX_QUERY = 'CREATE INDEX IF NOT EXISTS images_dir_id ON images (dir, id)'
+
+_COLUMNS = ['path', 'dir', 'id', 'postfix', 'shape', 'dtype', 'affine', 'spacing', 'mtime', 'size']
+# columns stored as json strings
+_JSON_COLUMNS = ['shape', 'affine', 'spacing']
+
+
+def _read_header_record(fp: str, dp: str, mtime: float, size: int) -> dict:
+    """Read Nifti header and build catalog record. Image data is not read."""
+    img_id, img_postfix = utils.parse_image_id_from_filepath(fp, get_postfix=True)
+    image, _ = utils.load_nifti(fp, load_data=False)
+    header = image.header
+    return {
+        'path': fp,
+        'dir': dp,
+        'id': img_id,
+        'postfix': img_postfix,
+        'shape': json.dumps([int(x) for x in image.shape]),
+        'dtype': header.get_data_dtype().name,
+        'affine': json.dumps(image.affine.tolist()),
+        'spacing': json.dumps([float(x) for x in header.get_zooms()]),
+        'mtime': mtime,
+        'size': size
+    }
+
+
+class DatasetCatalog:
+    """
+    Persistent SQLite catalog of Nifti `.nii.gz` images.
+
+    For each image the catalog stores id, path, postfix, shape, dtype, affine, spacing,
+    modification time and size of the file. Catalog is refreshed incrementally: directory is listed
+    on every query, but headers are read (in a thread pool) only for new or changed files.
+    This saves reading thousands of headers from shared storage at every start.
+    """
+
+    def __init__(self, catalog_fp: str, n_threads: int = 16):
+        """
+        :param catalog_fp: path to SQLite catalog file. created if does not exist
+        :param n_threads: number of threads that read Nifti headers
+        """
+        self._catalog_fp = catalog_fp
+        self._n_threads = n_threads
+        # directories already refreshed by this instance
+        self._refreshed_dps = set()
+
+        catalog_dp = os.path.dirname(catalog_fp)
+        if catalog_dp:
+            os.makedirs(catalog_dp, exist_ok=True)
+
+        self._conn = sqlite3.connect(catalog_fp)
+        self._conn.execute(_CREATE_TABLE_QUERY)
+        self._conn.execute(_CREATE_INDEX_QUERY)
+        self._conn.commit()
+
+    def __str__(self):
+        return f'DatasetCatalog(catalog_fp: {self._catalog_fp}; n_threads: {self._n_threads})'
+
+    def close(self):
+        self._conn.close()
+
+    def refresh(self, dp: str, force: bool = False):
+        """
+        Synchronize catalog records for `.nii.gz` files under `dp` directory with the file system:
+        read headers of new and changed files and remove records of deleted files.
+
+        :param force: refresh even if directory was already refreshed by this catalog instance
+        """
+        dp = os.path.abspath(dp)
+        if dp in self._refreshed_dps and not force:
+            return
+
+        print(const.SEPARATOR)
+        print(f'DatasetCatalog.refresh(): "{dp}"')
+        time_start = time.time()
+
+        stats = {}
+        with os.scandir(dp) as it:
+            for entry in it:
+                if entry.name.endswith('.nii.gz') and entry.is_file():
+                    st = entry.stat()
+                    stats[entry.path] = (st.st_mtime, st.st_size)
+
+        cataloged = {
+            path: (mtime, size) for (path, mtime, size)
+            in self._conn.execute('SELECT path, mtime, size FROM images WHERE dir = ?', (dp,))
+        }
+
+        to_read = [fp for (fp, st) in stats.items() if cataloged.get(fp) != st]
+        to_delete = [fp for fp in cataloged if fp not in stats]
+
+        with ThreadPoolExecutor(max_workers=self._n_threads) as executor:
+            records = list(executor.map(
+                lambda fp: _read_header_record(fp, dp, *stats[fp]), to_read
+            ))
+
+        with self._conn:
+            self._conn.executemany('DELETE FROM images WHERE path = ?', [(fp,) for fp in to_delete])
+            self._conn.executemany(
+                f'INSERT OR REPLACE INTO images ({", ".join(_COLUMNS)}) '
+                f'VALUES ({", ".join(["?"] * len(_COLUMNS))})',
+                [tuple(r[c] for c in _COLUMNS) for r in records]
+            )
+
+        self._refreshed_dps.add(dp)
+        print(f'files: {len(stats)}. headers read: {len(to_read)}. records removed: {len(to_delete)}')
+        print(f'elapsed time: {utils.get_elapsed_time_str(time_start)}')
+
+    def get_images(self, dp: str, ids: List[str] = None, postfixes: List[str] = None) -> List[dict]:
+        """
+        Get catalog records for images under `dp` directory. Directory is refreshed before the query.
+
+        :param ids: list of ids to consider. if None return all images
+        :param postfixes: list of postfixes to consider. if None return images with any postfix
+        :return: list of dicts with keys: path, dir, id, postfix, shape, dtype, affine, spacing, mtime, size
+        """
+        utils.check_var_to_be_iterable_collection(ids)
+        utils.check_var_to_be_iterable_collection(postfixes)
+
+        dp = os.path.abspath(dp)
+        self.refresh(dp)
+
+        ids = set(ids) if ids is not None else None
+        postfixes = set(postfixes) if postfixes is not None else None
+
+        records = []
+        query = f'SELECT {", ".join(_COLUMNS)} FROM images WHERE dir = ? ORDER BY path'
+        for row in self._conn.execute(query, (dp,)):
+            record = dict(zip(_COLUMNS, row))
+            if ids is not None and record['id'] not in ids:
+                continue
+            if postfixes is not None and record['postfix'] not in postfixes:
+                continue
+            for c in _JSON_COLUMNS:
+                record[c] = json.loads(record[c])
+            record['shape'] = tuple(record['shape'])
+            records.append(record)
+
+        return records
+
+    def get_files_dict(self, scans_dp, masks_dp, ids: List[str] = None, mask_postfixes=('autolungs', 'mask')):
+        """
+        Catalog-backed version of `utils.get_files_dict`. Create dict of the following structure:
+        `img_id: {'scan_fp': scan_filepath, 'mask_fp': mask_filepath, 'shape': scan_shape}`
+        and leave only those images that have both scans and masks.
+        """
+        print(const.SEPARATOR)
+        print('DatasetCatalog.get_files_dict()')
+        print(f'scans_dp: {scans_dp}')
+        print(f'masks_dp: {masks_dp}')
+
+        same_dirs = (scans_dp == masks_dp)
+        scans = self.get_images(scans_dp, ids=ids, postfixes=[''] if same_dirs else None)
+        masks = self.get_images(masks_dp, ids=ids, postfixes=mask_postfixes if same_dirs else None)
+
+        d = defaultdict(dict)
+        for r in scans:
+            d[r['id']].update({'scan_fp': r['path'], 'shape': r['shape']})
+        for r in masks:
+            d[r['id']].update({'mask_fp': r['path'], 'mask_shape': r['shape']})
+
+        d_intersection = {}
+        for (k, v) in d.items():
+            if 'scan_fp' not in v or 'mask_fp' not in v:
+                continue
+            mask_shape = v.pop('mask_shape')
+            assert v['shape'] == mask_shape, (f'scan shape != mask shape. '
+                                              f'id: {k}. '
+                                              f'scan shape: {v["shape"]}, '
+                                              f'mask shape: {mask_shape}')
+            d_intersection[k] = v
+
+        scans_wo_masks = [k for (k, v) in d.items() if 'scan_fp' in v and 'mask_fp' not in v]
+        masks_wo_scans = [k for (k, v) in d.items() if 'scan_fp' not in v and 'mask_fp' in v]
+
+        print(f'\n# of scans found: {len(scans)}')
+        print(f'# of masks found: {len(masks)}')
+        print(f'# of images with scans and masks: {len(d_intersection)}')
+        print(f'list of scans without masks: {scans_wo_masks}')
+        print(f'list of masks without scans: {masks_wo_scans}')
+
+        return d_intersection
@@ -1,3 +1,5 @@
 from .base_dl import BaseDataLoader
+from .batch_buffers import BatchBuffers, BitPackedMasks
 from .dl_no_augs import DataLoaderNoAugmentations
 from .dl_w_augs import DataLoaderWithAugmentations
+from .dl_prefetch import PrefetchDataLoader
@@ -1,10 +1,13 @@
 import math
 
+from data import preprocessing
 from data.datasets import BaseDataset
+from .batch_buffers import BatchBuffers
 
 
 class BaseDataLoader:
     _dataset: BaseDataset
+    _batch_buffers: BatchBuffers = None
 
     @property
     def batch_size(self):
@@ -21,5 +24,48 @@ class BaseDataLoader:
     def __len__(self):
         return NotImplementedError
 
-    def get_generator(self):
+    def get_batch_indices(self) -> list:
+        """
+        Get list of dataset indices arrays. Each array holds indices of samples for a single batch.
+        """
         return NotImplementedError
+
+    def get_batch(self, indices) -> tuple:
+        """
+        Build single batch from dataset samples with specified indices.
+        Slices of different shapes are padded to common shape (see `preprocessing.pad_slices`).
+        :return: (scans, masks, descriptions) tuple
+        """
+        return NotImplementedError
+
+    def use_batch_buffers(self, pin_memory: bool = False, n_buffers: int = 3, pack_masks: bool = False):
+        """
+        Collate batches into preallocated (optionally pinned) int16 / uint8 tensors
+        instead of yielding lists of np.ndarrays. See `BatchBuffers`.
+
+        :param pack_masks: whether to yield masks bit-packed (see `BitPackedMasks`)
+        """
+        self._batch_buffers = BatchBuffers(
+            self.batch_size, pin_memory=pin_memory, n_buffers=n_buffers, pack_masks=pack_masks
+        )
+
+    def collate(self, scans, masks, descriptions, masks_packed: bool = False) -> tuple:
+        """
+        :param masks_packed: whether `masks` are bit-packed (see `preprocessing.pack_mask_bits`)
+        """
+        if self._batch_buffers is not None:
+            scans, masks = self._batch_buffers.collate(scans, masks, masks_packed=masks_packed)
+        elif masks_packed:
+            masks = preprocessing.unpack_mask_bits(masks, scans[0].shape[-1])
+        return scans, masks, descriptions
+
+    def get_generator(self, batch_indices: list = None):
+        """
+        :param batch_indices: batches to yield (see `get_batch_indices`). new batch indices are drawn if None.
+        pass part of already drawn batch indices to resume interrupted epoch
+        """
+        # TODO: consider replacing with __iter__ method
+        if batch_indices is None:
+            batch_indices = self.get_batch_indices()
+        for cur_indices in batch_indices:
+            yield self.collate(*self.get_batch(cur_indices))
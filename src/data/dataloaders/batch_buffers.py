@@ -0,0 +1,134 @@
+from typing import NamedTuple
+
+import torch
+
+from data import preprocessing
+
+SCAN_TORCH_DTYPE = torch.int16
+MASK_TORCH_DTYPE = torch.uint8
+
+
+class BitPackedMasks(NamedTuple):
+    """
+    Batch of binary masks bit-packed along rows (see `preprocessing.pack_mask_bits`).
+    Masks are unpacked on the target device (see `model.utils.masks_to_tensor`).
+    """
+    packed: torch.Tensor  # uint8 tensor of shape (N, H, ceil(W / 8))
+    width: int  # width of unpacked masks
+
+    def __len__(self):
+        return len(self.packed)
+
+
+class BatchBuffers:
+    """
+    Ring of preallocated (optionally pinned) tensors that batches are collated into.
+
+    Each buffer is a flat tensor that is viewed as (N, H, W) batch, so batches with different slice shapes
+    (e.g. batches of cropped datasets) reuse the same memory. Buffers grow if batch doesn't fit them.
+
+    Scans and masks are kept in their compact dtypes (int16 and uint8) and are converted to float
+    only on the target device (see `model.utils.ingest_batch`). Tensors are reused in a round-robin fashion:
+    a collated batch stays valid until `n_buffers - 1` more batches are collated.
+
+    With `pack_masks=True` masks are collated bit-packed and are yielded as `BitPackedMasks`,
+    so 8 times less mask bytes are copied to the device.
+
+    Pinned buffers allow asynchronous host-to-device copies. To avoid overwriting a buffer
+    that is still being copied, a CUDA event is recorded for the previously yielded buffer
+    on each call to `collate` and is waited for before the buffer is reused.
+    """
+
+    def __init__(self, batch_size: int, pin_memory: bool = False, n_buffers: int = 3, pack_masks: bool = False):
+        if n_buffers < 2:
+            raise ValueError(f'n_buffers must be >= 2. passed {n_buffers}')
+
+        self._batch_size = batch_size
+        self._pin_memory = pin_memory and torch.cuda.is_available()
+        self._n_buffers = n_buffers
+        self._pack_masks = pack_masks
+
+        self._capacity = 0
+        self._scans = None
+        self._masks = None
+        self._events = [None] * n_buffers
+        self._cur_ix = -1
+
+    def __str__(self):
+        return (f'BatchBuffers('
+                f'batch_size: {self._batch_size}; '
+                f'capacity: {self._capacity}; '
+                f'pin_memory: {self._pin_memory}; '
+                f'n_buffers: {self._n_buffers}; '
+                f'pack_masks: {self._pack_masks})')
+
+    def collate(self, scans, masks, masks_packed: bool = False):
+        """
+        Copy scans and masks into the next free buffer.
+
+        :param scans: list of 2D np.ndarrays or 3D np.ndarray of shape (N, H, W).
+        slices of different shapes are padded to common shape (see `preprocessing.pad_slices`)
+        :param masks: list of 2D np.ndarrays or 3D np.ndarray with the same shapes as `scans`
+        :param masks_packed: whether `masks` is already bit-packed np.ndarray of shape (N, H, ceil(W / 8)).
+        scans must have common shape in this case
+        :return: (scans, masks) tensors of shape (N, H, W). masks are `BitPackedMasks` if buffers pack masks
+        """
+        n = len(scans)
+        if n > self._batch_size:
+            raise ValueError(f'batch has {n} samples. buffers are allocated for {self._batch_size}')
+
+        h, w = preprocessing.get_padded_shape([s.shape for s in scans], multiple_of=1)
+        if masks_packed and not self._pack_masks:
+            masks = preprocessing.unpack_mask_bits(masks, w)
+        if n * h * w > self._capacity:
+            self._allocate(self._batch_size * h * w)
+
+        if self._pin_memory and self._cur_ix >= 0:
+            # all the work that uses previously yielded buffer is already enqueued
+            self._events[self._cur_ix] = torch.cuda.Event()
+            self._events[self._cur_ix].record()
+
+        self._cur_ix = (self._cur_ix + 1) % self._n_buffers
+        if self._events[self._cur_ix] is not None:
+            self._events[self._cur_ix].synchronize()
+            self._events[self._cur_ix] = None
+
+        scans_t = self._scans[self._cur_ix][:n * h * w].view(n, h, w)
+        if not self._pack_masks:
+            masks_t = self._masks[self._cur_ix][:n * h * w].view(n, h, w)
+            preprocessing.copy_slices_with_padding(scans, masks, scans_t.numpy(), masks_t.numpy())
+            return scans_t, masks_t
+
+        w_packed = _get_packed_size(w)
+        masks_t = self._masks[self._cur_ix][:n * h * w_packed].view(n, h, w_packed)
+        scans_np, masks_np = scans_t.numpy(), masks_t.numpy()
+        if masks_packed:
+            for i in range(n):
+                scans_np[i] = scans[i]
+            masks_np[:] = masks
+        else:
+            # pad masks before packing so that padded pixels are packed as zeros
+            scans, masks = preprocessing.pad_slices(scans, masks, multiple_of=1)
+            for i in range(n):
+                scans_np[i] = scans[i]
+                masks_np[i] = preprocessing.pack_mask_bits(masks[i])
+
+        return scans_t, BitPackedMasks(masks_t, w)
+
+    def _allocate(self, n_pixels: int):
+        self._scans = [
+            torch.empty(n_pixels, dtype=SCAN_TORCH_DTYPE, pin_memory=self._pin_memory)
+            for _ in range(self._n_buffers)
+        ]
+        self._masks = [
+            # packed masks take less than `n_pixels` bytes
+            torch.empty(n_pixels, dtype=MASK_TORCH_DTYPE, pin_memory=self._pin_memory)
+            for _ in range(self._n_buffers)
+        ]
+        self._capacity = n_pixels
+        self._events = [None] * self._n_buffers
+        self._cur_ix = -1
+
+
+def _get_packed_size(size: int) -> int:
+    return (size + 7) // 8
@@ -1,7 +1,9 @@
 import numpy as np
 
 import utils
+from data import preprocessing, batch_augmentations
 from data.datasets import BaseDataset
+from data.samplers import BaseSampler
 from .base_dl import BaseDataLoader
 
 
@@ -12,10 +14,15 @@ class DataLoaderNoAugmentations(BaseDataLoader):
     to avoid performing augmentations twice.
     """
 
-    def __init__(self, dataset: BaseDataset, batch_size: int, to_shuffle: bool):
+    def __init__(self, dataset: BaseDataset, batch_size: int, to_shuffle: bool, sampler: BaseSampler = None):
+        """
+        :param sampler: sampler that defines order (and subset) of samples if `to_shuffle` is True.
+        if None - samples are shuffled globally
+        """
         self._dataset = dataset
         self._batch_size = batch_size
         self._to_shuffle = to_shuffle
+        self._sampler = sampler
 
     def __str__(self):
         return (f'{utils.get_class_name(self)}('
@@ -23,7 +30,8 @@ class DataLoaderNoAugmentations(BaseDataLoader):
                 f'n_images: {self.n_images}; '
                 f'batch_size: {self.batch_size}; '
                 f'n_batches: {self.n_batches}; '
-                f'to_shuffle: {self._to_shuffle})'
+                f'to_shuffle: {self._to_shuffle}; '
+                f'sampler: {self._sampler})'
                 )
 
     @property
@@ -31,25 +39,40 @@ class DataLoaderNoAugmentations(BaseDataLoader):
         return self._batch_size
 
     def __len__(self):
+        if self._to_shuffle and self._sampler is not None:
+            return self._sampler.get_n_samples(self._dataset)
         return len(self._dataset)
 
-    def get_generator(self):
-        orig_images_cnt = len(self)
-        indices = np.arange(orig_images_cnt)
+    def get_batch_indices(self):
+        indices = np.arange(len(self._dataset))
 
         if self._to_shuffle:
-            np.random.shuffle(indices)
+            if self._sampler is not None:
+                indices = self._sampler.get_indices(self._dataset)
+            else:
+                np.random.shuffle(indices)
+
+        orig_images_cnt = len(indices)
 
         batch_indices = [indices[a: a + self._batch_size]
                          for a in range(0, orig_images_cnt, self._batch_size)]
+        return batch_indices
+
+    def get_batch(self, indices):
+        scans_batch, masks_batch, descriptions_batch, to_augment = [], [], [], []
+        for ix in indices:
+            sample = self._dataset[ix]
+            scans_batch.append(sample['scan'])
+            masks_batch.append(sample['mask'])
+            descriptions_batch.append(sample['description'])
+            to_augment.append(sample['to_augment'])
 
-        for cur_indices in batch_indices:
+        # slices of cropped datasets have different shapes
+        scans_batch, masks_batch = preprocessing.pad_slices(scans_batch, masks_batch)
 
-            scans_batch, masks_batch, descriptions_batch = [], [], []
-            for ix in cur_indices:
-                sample = self._dataset[ix]
-                scans_batch.append(sample['scan'])
-                masks_batch.append(sample['mask'])
-                descriptions_batch.append(sample['description'])
+        # dataset leaves samples to be augmented with the whole batch if 'torch' backend is used
+        if any(to_augment):
+            scans_batch, masks_batch = batch_augmentations.augment_samples_in_batch(
+                scans_batch, masks_batch, np.array(to_augment))
 
-            yield scans_batch, masks_batch, descriptions_batch
+        return scans_batch, masks_batch, descriptions_batch
@@ -0,0 +1,318 @@
+import multiprocessing as mp
+import queue
+import signal
+import traceback
+import weakref
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+import utils
+from data import preprocessing
+from .base_dl import BaseDataLoader
+
+
+class _SharedBatchSlot:
+    """
+    Shared memory block that holds scans and masks arrays of a single batch.
+    Slots are created in the main process before workers are forked, so workers inherit them.
+    Slot is sized for `max_batch_size` slices of `max_slice_shape` and holds batches of any
+    (N, H, W) shape with no more pixels than that.
+    Binary masks are passed bit-packed along rows (see `preprocessing.pack_mask_bits`).
+    """
+
+    def __init__(self, max_batch_size: int, max_slice_shape: tuple, scan_dtype: np.dtype):
+        self.max_batch_size = max_batch_size
+        self.max_slice_shape = tuple(max_slice_shape)
+        self.scan_dtype = np.dtype(scan_dtype)
+
+        h, w = self.max_slice_shape
+        self.capacity = max_batch_size * h * w
+        self._scans_nbytes = self.capacity * self.scan_dtype.itemsize
+        self._masks_nbytes = max_batch_size * h * _get_packed_size(w)
+        self.shm = shared_memory.SharedMemory(create=True, size=self._scans_nbytes + self._masks_nbytes)
+
+    def get_arrays(self, batch_shape: tuple):
+        """
+        :param batch_shape: (N, H, W) shape of the batch
+        :return: (scans, packed masks) arrays. packed masks have (N, H, ceil(W / 8)) shape
+        """
+        n, h, w = batch_shape
+        scans = np.ndarray(batch_shape, dtype=self.scan_dtype, buffer=self.shm.buf)
+        masks_packed = np.ndarray(
+            (n, h, _get_packed_size(w)), dtype=np.uint8, buffer=self.shm.buf, offset=self._scans_nbytes
+        )
+        return scans, masks_packed
+
+    def fits(self, scans: list, masks: list):
+        if len(scans) == 0 or len(scans) > self.max_batch_size:
+            return False
+        n, (h, w) = len(scans), scans[0].shape
+        return n * h * w <= self.capacity and n * h * _get_packed_size(w) <= self._masks_nbytes and all(
+            s.shape == (h, w) and m.shape == (h, w) and s.dtype == self.scan_dtype
+            for (s, m) in zip(scans, masks)
+        )
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _get_packed_size(size: int) -> int:
+    return (size + 7) // 8
+
+
+def _get_batch_seed(epoch_seed: int, batch_ix: int) -> int:
+    return int(np.random.SeedSequence([epoch_seed, batch_ix]).generate_state(1)[0])
+
+
+def _worker_loop(loader: BaseDataLoader, slots: list, tasks_queue, results_queue, current_epoch):
+    """
+    Build batches of `loader` for tasks received from `tasks_queue`.
+
+    Each task is a tuple `(epoch_ix, batch_ix, slot_ix, seed, indices)`. Random generators are reseeded
+    with the seed of the batch before building it, so augmentations of the batch depend neither on the worker
+    that builds it nor on batches built by that worker before. Batch is written
+    to shared memory slot if it fits there, otherwise it's sent back through `results_queue`.
+    Tasks of already finished epochs are skipped.
+    """
+    # let the main process handle KeyboardInterrupt
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # batch augmentations run in every worker. don't let torch threads of workers compete for CPUs
+    torch.set_num_threads(1)
+
+    while True:
+        task = tasks_queue.get()
+        if task is None:
+            break
+
+        epoch_ix, batch_ix, slot_ix, seed, indices = task
+        if epoch_ix < current_epoch.value:
+            results_queue.put((epoch_ix, batch_ix, slot_ix, None, None, None))
+            continue
+
+        try:
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+            scans, masks, descriptions = loader.get_batch(indices)
+            slot = slots[slot_ix]
+            if slot.fits(scans, masks):
+                batch_shape = (len(scans), *scans[0].shape)
+                scans_shared, masks_shared = slot.get_arrays(batch_shape)
+                for i, (s, m) in enumerate(zip(scans, masks)):
+                    scans_shared[i] = s
+                    masks_shared[i] = preprocessing.pack_mask_bits(m)
+                payload = ('shared', batch_shape)
+            else:
+                payload = ('pickled', scans, masks)
+            results_queue.put((epoch_ix, batch_ix, slot_ix, payload, descriptions, None))
+        except Exception:
+            results_queue.put((epoch_ix, batch_ix, slot_ix, None, None, traceback.format_exc()))
+
+
+def _shutdown_workers(workers: list, tasks_queue, slots: list):
+    for _ in workers:
+        tasks_queue.put(None)
+    for w in workers:
+        w.join(timeout=5)
+        if w.is_alive():
+            w.terminate()
+    for slot in slots:
+        slot.release()
+
+
+class PrefetchDataLoader(BaseDataLoader):
+    """
+    Data loader that builds batches of the wrapped data loader in a pool of worker processes.
+
+    Batches are built ahead of time and are passed to the main process through shared memory slots.
+    Masks are bit-packed in workers, so 8 times less mask bytes are passed between processes.
+    They are unpacked on the device if batch buffers pack masks, otherwise in the main process.
+    At most `prefetch_depth` batches are in flight at the same time.
+    Batches are yielded in the order defined by `get_batch_indices` of the wrapped loader,
+    so the `(scans, masks, descriptions)` contract of `get_generator` is preserved.
+
+    Worker processes are forked on the first call to `get_generator` and are kept alive between epochs,
+    so dataset caches filled in workers survive. Call `shutdown` to stop workers explicitly.
+    """
+
+    RESULT_TIMEOUT_SECONDS = 5
+
+    def __init__(self, loader: BaseDataLoader, n_workers: int, prefetch_depth: int = None):
+        """
+        :param loader: data loader to build batches with
+        :param n_workers: number of worker processes
+        :param prefetch_depth: max number of batches being built at the same time.
+        defaults to `2 * n_workers`
+        """
+        if n_workers < 1:
+            raise ValueError(f'n_workers must be >= 1. passed {n_workers}')
+
+        self._loader = loader
+        self._dataset = loader._dataset
+        self._n_workers = n_workers
+        self._prefetch_depth = prefetch_depth or 2 * n_workers
+        if self._prefetch_depth < 1:
+            raise ValueError(f'prefetch_depth must be >= 1. passed {self._prefetch_depth}')
+
+        self._workers = None
+        self._slots = None
+        self._free_slots = None
+        self._tasks_queue = None
+        self._results_queue = None
+        self._current_epoch = None
+        self._epoch_ix = 0
+        self._finalizer = None
+
+    def __str__(self):
+        return (f'{utils.get_class_name(self)}('
+                f'loader: {self._loader}; '
+                f'n_workers: {self._n_workers}; '
+                f'prefetch_depth: {self._prefetch_depth})'
+                )
+
+    @property
+    def batch_size(self):
+        return self._loader.batch_size
+
+    def __len__(self):
+        return len(self._loader)
+
+    def get_batch_indices(self):
+        """
+        Each batch of the wrapped loader is paired with the seed to build it with (see `_worker_loop`).
+        Seeds are derived from the epoch seed drawn from the global random state,
+        so batches stored with training state are augmented the same way after resume.
+
+        :return: list of (seed, indices) tuples
+        """
+        batch_indices = self._loader.get_batch_indices()
+        epoch_seed = np.random.randint(2 ** 31)
+        return [(_get_batch_seed(epoch_seed, batch_ix), indices) for batch_ix, indices in enumerate(batch_indices)]
+
+    def get_batch(self, indices):
+        """
+        Build batch in the main process. Global random generators are not reseeded here.
+
+        :param indices: (seed, indices) tuple (see `get_batch_indices`)
+        """
+        _, indices = indices
+        return self._loader.get_batch(indices)
+
+    def get_generator(self, batch_indices: list = None):
+        """
+        :param batch_indices: (seed, indices) tuples of batches to yield (see `get_batch_indices`).
+        new batches are drawn if None
+        """
+        if batch_indices is None:
+            batch_indices = self.get_batch_indices()
+        n_batches = len(batch_indices)
+        if n_batches == 0:
+            return
+
+        self._start_workers_if_needed()
+
+        self._epoch_ix += 1
+        epoch_ix = self._epoch_ix
+        self._current_epoch.value = epoch_ix
+
+        next_to_submit = 0
+        ready = {}
+        try:
+            for batch_ix in range(n_batches):
+                while next_to_submit < n_batches and self._free_slots:
+                    slot_ix = self._free_slots.popleft()
+                    seed, indices = batch_indices[next_to_submit]
+                    self._tasks_queue.put((epoch_ix, next_to_submit, slot_ix, seed, indices))
+                    next_to_submit += 1
+
+                while batch_ix not in ready:
+                    result = self._get_result()
+                    if result[0] != epoch_ix:
+                        # result of the task submitted during one of the previous epochs
+                        self._free_slots.append(result[2])
+                        continue
+                    ready[result[1]] = result
+
+                yield self._read_result(ready.pop(batch_ix))
+        finally:
+            # consumer stopped early (`max_batches`, closed generator or exception).
+            # give back slots of received results. slots of tasks still in flight
+            # are given back once their results arrive during the next epoch
+            for result in ready.values():
+                self._free_slots.append(result[2])
+
+    def shutdown(self):
+        if self._finalizer is not None:
+            self._finalizer()
+        self._workers = None
+
+    def _start_workers_if_needed(self):
+        if self._workers is not None:
+            return
+
+        # slots are sized for the largest slice of the dataset padded the same way batches are.
+        # no sample is read here: reading it would decode volumes and draw augmentations in the main process
+        max_slice_shape = preprocessing.get_padded_shape([self._dataset.get_max_slice_shape()])
+        self._slots = [
+            _SharedBatchSlot(
+                max_batch_size=self.batch_size, max_slice_shape=max_slice_shape,
+                scan_dtype=self._dataset.get_scan_dtype()
+            ) for _ in range(self._prefetch_depth)
+        ]
+        self._free_slots = deque(range(self._prefetch_depth))
+
+        ctx = mp.get_context('fork')
+        self._tasks_queue = ctx.Queue()
+        self._results_queue = ctx.Queue()
+        self._current_epoch = ctx.Value('i', 0)
+
+        self._workers = [
+            ctx.Process(
+                target=_worker_loop,
+                args=(self._loader, self._slots, self._tasks_queue, self._results_queue, self._current_epoch),
+                daemon=True
+            ) for _ in range(self._n_workers)
+        ]
+        for w in self._workers:
+            w.start()
+
+        self._finalizer = weakref.finalize(self, _shutdown_workers, self._workers, self._tasks_queue, self._slots)
+
+    def _get_result(self):
+        while True:
+            try:
+                return self._results_queue.get(timeout=PrefetchDataLoader.RESULT_TIMEOUT_SECONDS)
+            except queue.Empty:
+                dead_workers = [w for w in self._workers if not w.is_alive()]
+                if dead_workers:
+                    exit_codes = [w.exitcode for w in dead_workers]
+                    self.shutdown()
+                    raise RuntimeError(f'{len(dead_workers)} data loader worker(s) exited unexpectedly. '
+                                       f'exit codes: {exit_codes}')
+
+    def _read_result(self, result):
+        epoch_ix, batch_ix, slot_ix, payload, descriptions, error = result
+
+        try:
+            if error is not None:
+                raise RuntimeError(f'error while building batch {batch_ix} in data loader worker:\n{error}')
+            return self._collate_result(slot_ix, payload, descriptions)
+        finally:
+            self._free_slots.append(slot_ix)
+
+    def _collate_result(self, slot_ix, payload, descriptions):
+        if payload[0] == 'shared':
+            scans_shared, masks_packed = self._slots[slot_ix].get_arrays(payload[1])
+            # copy batch out of the slot so the slot can be reused right away.
+            # collate directly from the slot if batch buffers are used.
+            # masks are unpacked either on the device or here for the whole batch at once
+            if self._batch_buffers is not None:
+                batch = self.collate(scans_shared, masks_packed, descriptions, masks_packed=True)
+            else:
+                batch = self.collate(scans_shared.copy(), masks_packed, descriptions, masks_packed=True)
+        else:
+            batch = self.collate(payload[1], payload[2], descriptions)
+        return batch
@@ -1,8 +1,9 @@
 import numpy as np
 
 import utils
-from data import augmentations
+from data import augmentations, batch_augmentations, preprocessing
 from data.datasets import BaseDataset
+from data.samplers import BaseSampler
 from .base_dl import BaseDataLoader
 
 
@@ -16,15 +17,26 @@ class DataLoaderWithAugmentations(BaseDataLoader):
     def __init__(self, dataset: BaseDataset,
                  orig_img_per_batch,
                  aug_cnt,
-                 to_shuffle):
+                 to_shuffle,
+                 sampler: BaseSampler = None,
+                 aug_backend: str = 'numpy'):
         """
         :param orig_img_per_batch: number of images without augmentations in batch
         :param aug_cnt: number of augmentations for each original image in batch
+        :param sampler: sampler that defines order (and subset) of samples if `to_shuffle` is True.
+        if None - samples are shuffled globally
+        :param aug_backend: backend to augment images with (see `augmentations.AUG_BACKENDS`).
+        'torch' backend augments all the copies of batch images at once
         """
+        if aug_backend not in augmentations.AUG_BACKENDS:
+            raise ValueError(f'`aug_backend` should be in {augmentations.AUG_BACKENDS}. passed "{aug_backend}"')
+
         self._dataset = dataset
         self._orig_img_per_batch = orig_img_per_batch
         self._aug_cnt = aug_cnt
         self._to_shuffle = to_shuffle
+        self._sampler = sampler
+        self._aug_backend = aug_backend
 
     def __str__(self):
         return (f'{utils.get_class_name(self)}('
@@ -34,7 +46,9 @@ class DataLoaderWithAugmentations(BaseDataLoader):
                 f'aug_cnt: {self._aug_cnt}; '
                 f'batch_size: {self.batch_size}; '
                 f'n_batches: {self.n_batches}; '
-                f'to_shuffle: {self._to_shuffle})'
+                f'to_shuffle: {self._to_shuffle}; '
+                f'sampler: {self._sampler}; '
+                f'aug_backend: {self._aug_backend})'
                 )
 
     @property
@@ -42,29 +56,46 @@ class DataLoaderWithAugmentations(BaseDataLoader):
         return self._orig_img_per_batch * (1 + self._aug_cnt)
 
     def __len__(self):
+        if self._to_shuffle and self._sampler is not None:
+            return self._sampler.get_n_samples(self._dataset) * (1 + self._aug_cnt)
         return len(self._dataset) * (1 + self._aug_cnt)
 
-    def get_generator(self):
-        # TODO: consider replacing with __iter__ method
-
-        orig_images_cnt = len(self._dataset)
-        indices = np.arange(orig_images_cnt)
+    def get_batch_indices(self):
+        indices = np.arange(len(self._dataset))
 
         if self._to_shuffle:
-            np.random.shuffle(indices)
+            if self._sampler is not None:
+                indices = self._sampler.get_indices(self._dataset)
+            else:
+                np.random.shuffle(indices)
+
+        orig_images_cnt = len(indices)
 
         batch_indices = [indices[a: a + self._orig_img_per_batch]
                          for a in range(0, orig_images_cnt, self._orig_img_per_batch)]
+        return batch_indices
 
-        for cur_indices in batch_indices:
-
-            scans_batch, masks_batch, descriptions_batch = [], [], []
-            for ix in cur_indices:
-                sample = self._dataset[ix]
+    def get_batch(self, indices):
+        scans_batch, masks_batch, descriptions_batch, to_augment = [], [], [], []
+        for ix in indices:
+            sample = self._dataset[ix]
+            if self._aug_backend == 'numpy':
                 scan_augs, mask_augs = augmentations.get_multiple_augmentations(
                     sample['scan'], sample['mask'], self._aug_cnt)
-                scans_batch.extend(scan_augs)
-                masks_batch.extend(mask_augs)
-                descriptions_batch.extend([sample['description']] * (1 + self._aug_cnt))
+            else:
+                # copies are augmented later together with the whole batch
+                scan_augs = [sample['scan']] + [sample['scan'].copy() for _ in range(self._aug_cnt)]
+                mask_augs = [sample['mask']] + [sample['mask'].copy() for _ in range(self._aug_cnt)]
+            scans_batch.extend(scan_augs)
+            masks_batch.extend(mask_augs)
+            descriptions_batch.extend([sample['description']] * (1 + self._aug_cnt))
+            to_augment.extend([sample['to_augment']] + [self._aug_backend == 'torch'] * self._aug_cnt)
+
+        # slices of cropped datasets have different shapes
+        scans_batch, masks_batch = preprocessing.pad_slices(scans_batch, masks_batch)
+
+        if any(to_augment):
+            scans_batch, masks_batch = batch_augmentations.augment_samples_in_batch(
+                scans_batch, masks_batch, np.array(to_augment))
 
-            yield scans_batch, masks_batch, descriptions_batch
+        return scans_batch, masks_batch, descriptions_batch
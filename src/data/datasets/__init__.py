@@ -1,3 +1,6 @@
 from .base_dataset import BaseDataset
 from .nifti_dataset import NiftiDataset
 from .numpy_dataset import NumpyDataset
+from .packed_dataset import PackedDataset
+from .slice_index import SliceIndex
+from .chunked_dataset import ChunkedDataset
@@ -1,9 +1,13 @@
+import json
 from typing import List
 
+import numpy as np
 from torch.utils.data import Dataset
 
 import const
 import utils
+from data import augmentations
+from data.datasets.slice_index import SliceIndex, SLICE_FLAG_HEAVY_AUGS
 
 
 class BaseDataset(Dataset):
@@ -15,16 +19,20 @@ class BaseDataset(Dataset):
     of `set_different_aug_cnt_for_two_subsets` method and use of `DataLoaderNoAugmentations`.
     """
 
-    _slice_info = None
+    _slice_index: SliceIndex = None
+    # number of lungs pixels for each slice row of slice index (see `load_slices_stats`)
+    _slices_lungs_pixels: np.ndarray = None
+    # how augmented samples are augmented (see `set_aug_backend`)
+    _aug_backend: str = 'numpy'
 
     def set_different_aug_cnt_for_two_subsets(
             self, augs_cnt: int, ids_heavy_augs: List[str], augs_cnt_heavy: int
     ):
         """
-        Initialize `slice_info` dict with number of augmentations per images.
+        Set number of augmentations per slice in slice index.
         Use this method to set different number of augmentations for two subsets of images.
-        When images are retrieved with `__getitem__` method and `slice_info` dict has
-        'augment' == True augmentations are applied before yielding scan and mask.
+        Each slice yields the raw sample followed by augmented ones. When augmented sample
+        is retrieved with `__getitem__` method augmentations are applied before yielding scan and mask.
 
         :param augs_cnt: number of augmentations for all slices
         :param ids_heavy_augs: list with ids of images that need to be heavily augmented.
@@ -37,28 +45,22 @@ class BaseDataset(Dataset):
         print('BaseDataset.set_different_aug_cnt_for_two_subsets()')
         print('setting different number of augmentations for train subsets:')
         print(f'augs_cnt: {augs_cnt}')
-        print(f'len(ids_heavy_augs): {len(ids_heavy_augs)}')
+        print(f'len(ids_heavy_augs): {len(ids_heavy_augs) if ids_heavy_augs is not None else None}')
         print(f'augs_cnt_heavy: {augs_cnt_heavy}')
 
         utils.check_var_to_be_iterable_collection(ids_heavy_augs)
 
-        n_slices_hard_cases = 0
-        n_slices_regular_cases = 0
+        ids_heavy_augs = set(ids_heavy_augs) if ids_heavy_augs is not None else set()
+        volume_is_hard_case = np.array([v['id'] in ids_heavy_augs for v in self._slice_index.volumes], dtype=bool)
+        is_hard_case = volume_is_hard_case[self._slice_index.slices['vol_ix']] \
+            if len(volume_is_hard_case) else np.zeros(0, dtype=bool)
 
-        new_slice_info = []
-        for si in self._slice_info:
-            is_hard_case = ids_heavy_augs is not None and si['id'] in ids_heavy_augs
+        n_augs = np.where(is_hard_case, augs_cnt_heavy, augs_cnt)
+        flags = np.where(is_hard_case, SLICE_FLAG_HEAVY_AUGS, 0)
+        self._slice_index.set_augs_cnt(n_augs, flags)
 
-            if is_hard_case:
-                n_slices_hard_cases += 1
-            else:
-                n_slices_regular_cases += 1
-
-            # append raw slice
-            new_slice_info.append({**si, 'augment': False})
-            # append augmentations
-            cur_augs = augs_cnt_heavy if is_hard_case else augs_cnt
-            new_slice_info.extend([{**si, 'augment': True} for _ in range(cur_augs)])
+        n_slices_hard_cases = int(is_hard_case.sum())
+        n_slices_regular_cases = len(is_hard_case) - n_slices_hard_cases
 
         print(f'\nhard cases.\t'
               f'raw slices: {n_slices_hard_cases}.\t'
@@ -68,18 +70,103 @@ class BaseDataset(Dataset):
               f'together with augmentations: {n_slices_regular_cases * (1 + augs_cnt)}')
         print(f'combined.\t'
               f'raw slices: {n_slices_hard_cases + n_slices_regular_cases}.\t'
-              f'together with augmentations: '
-              f'{n_slices_hard_cases * (1 + augs_cnt_heavy) + n_slices_regular_cases * (1 + augs_cnt)}')
+              f'together with augmentations: {len(self._slice_index)}')
+
+    def set_aug_backend(self, aug_backend: str):
+        """
+        Set backend to augment samples with (see `augmentations.AUG_BACKENDS`).
+
+        'numpy' - augmented samples are augmented one by one in `__getitem__` method.
+        'torch' - augmented samples are yielded as is with `to_augment` flag set,
+        data loader augments all flagged samples of a batch at once (see `batch_augmentations.augment_batch`).
+        """
+        if aug_backend not in augmentations.AUG_BACKENDS:
+            raise ValueError(f'`aug_backend` should be in {augmentations.AUG_BACKENDS}. passed "{aug_backend}"')
+        self._aug_backend = aug_backend
+
+    def _augment_sample(self, scan: np.ndarray, mask: np.ndarray):
+        """
+        Augment single sample if augmentations are applied per sample.
+
+        :return: (scan, mask, to_augment) tuple. `to_augment` is True if sample is left
+        to be augmented by data loader together with the whole batch
+        """
+        if self._aug_backend == 'numpy':
+            scan, mask = augmentations.get_single_augmentation(scan, mask)
+            return scan, mask, False
+        return scan, mask, True
+
+    def get_samples_volume_ixs(self) -> np.ndarray:
+        """
+        Get index of the image (volume) for each sample. Samplers use it to group samples by volumes.
+        """
+        return self._slice_index.get_samples_vol_ixs()
 
-        self._slice_info = new_slice_info
+    def load_slices_stats(self, slices_stats_fp: str):
+        """
+        Load per-slice stats stored at dataset creation (see `NiftiDataset.store_as_numpy_datasets`).
+        Datasets of any type can use stats of numpy dataset created from the same images,
+        because images are not resampled along z-axis.
+
+        :param slices_stats_fp: path to `slices_stats.json` (see `const.NumpyDataPaths`)
+        """
+        print(f'loading slices stats from "{slices_stats_fp}"')
+        with open(slices_stats_fp) as fin:
+            stats = json.load(fin)
+
+        volumes = self._slice_index.volumes
+        missing_ids = [v['id'] for v in volumes if v['id'] not in stats]
+        if missing_ids:
+            raise ValueError(f'no slices stats for {len(missing_ids)} images: {missing_ids[:10]}')
+
+        # flatten per-volume lists into an array indexed by volume index and z-index
+        volumes_offsets = np.cumsum([0] + [len(stats[v['id']]['lungs_pixels']) for v in volumes])
+        lungs_pixels = np.array(
+            [x for v in volumes for x in stats[v['id']]['lungs_pixels']], dtype=np.int64
+        )
+        slices = self._slice_index.slices
+        if len(slices) > 0 and np.any(slices['z_ix'] >= np.diff(volumes_offsets)[slices['vol_ix']]):
+            raise ValueError(f'slices stats from "{slices_stats_fp}" do not match images shapes')
+        self._slices_lungs_pixels = lungs_pixels[volumes_offsets[slices['vol_ix']] + slices['z_ix']]
+
+        n_empty = int(np.sum(self._slices_lungs_pixels == 0))
+        print(f'slices with lungs: {len(slices) - n_empty}. empty slices: {n_empty}')
+
+    def get_samples_lungs_pixels(self) -> np.ndarray:
+        """
+        Get number of lungs pixels for each sample. Requires slices stats to be loaded.
+        """
+        if self._slices_lungs_pixels is None:
+            raise ValueError('slices stats are not loaded. call `load_slices_stats` first')
+        return self._slice_index.repeat_for_samples(self._slices_lungs_pixels)
+
+    def get_max_slice_shape(self) -> tuple:
+        """
+        Get (H, W) shape that fits slices of all the images. Slices of cropped datasets have different shapes.
+        Data loaders use it to preallocate batch memory.
+
+        :return: (H, W) tuple or None if dataset is empty
+        """
+        shapes = [v['shape'] for v in self._slice_index.volumes]
+        if len(shapes) == 0:
+            return None
+        return max(s[0] for s in shapes), max(s[1] for s in shapes)
+
+    def get_scan_dtype(self) -> np.dtype:
+        """
+        Get dtype of scan slices. Data loaders use it to preallocate batch memory without reading samples.
+        Scans are stored as int16 (see `NiftiDataset.store_as_numpy_dataset`). Batches of slices of other dtype
+        (e.g. of source nifti images of other dtype) don't fit preallocated memory and are passed as is.
+        """
+        return np.dtype(np.int16)
 
     def __len__(self):
-        return len(self._slice_info)
+        return len(self._slice_index)
 
     def __getitem__(self, item):
         raise NotImplementedError
 
-    def _init_slice_info(self):
+    def _init_slice_index(self):
         raise NotImplementedError
 
     @property
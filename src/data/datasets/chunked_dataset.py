@@ -0,0 +1,276 @@
+import json
+import os
+import zlib
+from typing import List
+
+import numpy as np
+
+import const
+import utils
+from data.cache import LRUCache
+from data.datasets import BaseDataset
+from data.datasets.slice_index import SliceIndex
+
+try:
+    # optional dependency. faster alternative to zlib codec
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# single row of chunk index: volume index in volumes table, z-index of the first slice of the chunk,
+# number of slices in the chunk, byte range of compressed chunk in volume file and slice shape
+CHUNK_INDEX_DTYPE = np.dtype([
+    ('vol_ix', np.int32),
+    ('z_start', np.int32),
+    ('n_slices', np.int32),
+    ('offset', np.int64),
+    ('nbytes', np.int64),
+    ('h', np.int32),
+    ('w', np.int32)
+])
+
+SCAN_DTYPE = np.dtype(np.int16)
+MASK_DTYPE = np.dtype(np.uint8)
+
+ZLIB_COMPRESSION_LEVEL = 1
+
+CODECS = ['zlib', 'lz4']
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == 'zlib':
+        return zlib.compress(data, ZLIB_COMPRESSION_LEVEL)
+    if codec == 'lz4':
+        check_lz4_is_installed()
+        return lz4.frame.compress(data)
+    raise ValueError(f'`codec` should be in {CODECS}. passed "{codec}"')
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lz4':
+        check_lz4_is_installed()
+        return lz4.frame.decompress(data)
+    raise ValueError(f'`codec` should be in {CODECS}. passed "{codec}"')
+
+
+def check_lz4_is_installed():
+    if lz4 is None:
+        raise ImportError('lz4 codec requires `lz4` package. install it with `pip3 install lz4`')
+
+
+class ChunkedDataset(BaseDataset):
+    """
+    Dataset that reads slices from compressed chunks.
+
+    Each chunk is a z-slab of `chunk_size` consecutive slices of scan together with mask,
+    compressed with fast codec (see `CODECS`). Chunks of a volume are stored one after another
+    in a single file, location of every chunk is stored in compact chunk index (see `CHUNK_INDEX_DTYPE`).
+    Reading a slice is a single `pread` of its chunk followed by decompression.
+    Decompressed chunks are kept in bounded LRU cache, so reading neighboring slices
+    (see `VolumeLocalitySampler`) doesn't require reading and decompressing the chunk again.
+
+    Chunks are created with `ChunkedDataset.store_volume` and `ChunkedDataset.store_index`
+    (see `NiftiDataset.store_as_numpy_datasets`).
+    """
+
+    def __init__(
+            self, chunked_data_root_dp: str, img_ids: List[str] = None,
+            chunk_cache_max_bytes: int = 1024 ** 3, cache_max_volumes: int = 64
+    ):
+        """
+        :param chunked_data_root_dp: root directory of processed dataset (see `const.ChunkedDataPaths`)
+        :param chunk_cache_max_bytes: max number of bytes occupied by decompressed chunks.
+        pass 0 to disable the cache
+        :param cache_max_volumes: max number of volume files to keep open
+        """
+        utils.check_var_to_be_iterable_collection(img_ids)
+
+        self._paths = const.ChunkedDataPaths(chunked_data_root_dp)
+        self._img_ids = img_ids
+
+        self._files_cache = LRUCache(max_items=cache_max_volumes, on_evict=lambda fp, fd: os.close(fd))
+        self._chunks_cache = LRUCache(max_bytes=chunk_cache_max_bytes)
+        self._files_pid = os.getpid()
+
+        self._load_index()
+        self._init_slice_index()
+
+    def _load_index(self):
+        if not os.path.isfile(self._paths.index_fp):
+            raise FileNotFoundError(f'{self._paths.index_fp}')
+
+        print(f'loading chunked dataset index from "{self._paths.index_fp}"')
+        with open(self._paths.volumes_fp) as fin:
+            self._volumes = json.load(fin)
+        self._index = utils.load_npy(self._paths.index_fp)
+
+        # filter images
+        if self._img_ids is not None:
+            img_ids = set(self._img_ids)
+            is_kept = np.array([v['id'] in img_ids for v in self._volumes], dtype=bool)
+            self._volumes = [v for (v, kept) in zip(self._volumes, is_kept) if kept]
+            new_vol_ixs = np.cumsum(is_kept) - 1
+            self._index = self._index[is_kept[self._index['vol_ix']]]
+            self._index['vol_ix'] = new_vol_ixs[self._index['vol_ix']]
+            # chunks of each volume are stored contiguously, so they start where previous volume's ones end
+            first_chunk_ixs = np.searchsorted(self._index['vol_ix'], np.arange(len(self._volumes)))
+            for volume, first_chunk_ix in zip(self._volumes, first_chunk_ixs):
+                volume['first_chunk_ix'] = int(first_chunk_ix)
+
+    def _init_slice_index(self):
+        n_slices = [v['shape'][2] for v in self._volumes]
+        vol_ixs = np.repeat(np.arange(len(self._volumes)), n_slices)
+        z_ixs = np.concatenate([np.arange(n) for n in n_slices]) if n_slices else np.zeros(0)
+        self._slice_index = SliceIndex(self._volumes, vol_ixs, z_ixs)
+
+    @property
+    def n_images(self):
+        return len(self._volumes)
+
+    def __getitem__(self, ix):
+        """
+        Yield (scan, mask, description) tuple for single slice.
+
+        If sample is an augmented copy of the slice (see `SliceIndex`)
+        than augmentations are applied before yielding results.
+        """
+        volume, z_ix, augment, _ = self._slice_index.get_sample(ix)
+        cur_id = volume['id']
+
+        chunk_ix = volume['first_chunk_ix'] + z_ix // volume['chunk_size']
+        scans, masks = self._load_chunk(chunk_ix)
+        z_in_chunk = z_ix - self._index[chunk_ix]['z_start']
+        # copy slices to detach them from cached chunk
+        scan = np.array(scans[z_in_chunk])
+        mask = np.array(masks[z_in_chunk])
+
+        to_augment = False
+        if augment:
+            scan, mask, to_augment = self._augment_sample(scan, mask)
+
+        sample = {
+            'scan': scan,
+            'mask': mask,
+            'description': f'{cur_id}_{z_ix}',
+            # whether sample is left to be augmented by data loader (see `BaseDataset.set_aug_backend`)
+            'to_augment': to_augment
+        }
+
+        return sample
+
+    def cache_info(self) -> dict:
+        """Return hits and misses statistics for decompressed chunks cache"""
+        return self._chunks_cache.cache_info()
+
+    def _get_volume_fd(self, fp: str) -> int:
+        if self._files_pid != os.getpid():
+            # forked worker process inherited opened files of the parent. open own ones
+            self._files_cache = LRUCache(
+                max_items=self._files_cache.cache_info()['max_items'], on_evict=lambda fp, fd: os.close(fd)
+            )
+            self._files_pid = os.getpid()
+        return self._files_cache.get_or_load(fp, lambda: os.open(fp, os.O_RDONLY))
+
+    def _load_chunk(self, chunk_ix: int):
+        """
+        :return: (scans, masks) slabs of chunk of shape (n_slices, H, W)
+        """
+        cached = self._chunks_cache.get(chunk_ix)
+        if cached is not None:
+            return cached
+
+        row = self._index[chunk_ix]
+        volume = self._volumes[row['vol_ix']]
+        fp = ChunkedDataset.get_chunks_fp(self._paths.root_dp, volume['id'])
+
+        n_bytes = int(row['nbytes'])
+        buf = os.pread(self._get_volume_fd(fp), n_bytes, int(row['offset']))
+        if len(buf) != n_bytes:
+            raise IOError(f'could not read chunk from "{fp}" at offset {row["offset"]}: '
+                          f'read {len(buf)} bytes out of {n_bytes}')
+
+        data = decompress(buf, volume['codec'])
+        shape = (int(row['n_slices']), int(row['h']), int(row['w']))
+        scans_nbytes = int(np.prod(shape)) * SCAN_DTYPE.itemsize
+        scans = np.frombuffer(data, dtype=SCAN_DTYPE, count=int(np.prod(shape))).reshape(shape)
+        masks = np.frombuffer(data, dtype=MASK_DTYPE, offset=scans_nbytes).reshape(shape)
+
+        self._chunks_cache.put(chunk_ix, (scans, masks))
+        return scans, masks
+
+    @staticmethod
+    def get_chunks_fp(chunked_data_root_dp: str, img_id: str):
+        return os.path.join(const.ChunkedDataPaths(chunked_data_root_dp).chunks_dp, f'{img_id}.bin')
+
+    @staticmethod
+    def get_chunks_table_fp(chunked_data_root_dp: str, img_id: str):
+        return os.path.join(const.ChunkedDataPaths(chunked_data_root_dp).chunks_dp, f'{img_id}.npy')
+
+    @staticmethod
+    def store_volume(
+            chunked_data_root_dp: str, img_id: str, scan: np.ndarray, mask: np.ndarray,
+            chunk_size: int, codec: str
+    ):
+        """
+        Split scan and mask volumes of shape (H, W, Z) into z-slabs of `chunk_size` slices,
+        compress each slab and store all the chunks of the volume to a single file.
+        Chunks table of the volume (with `vol_ix` left unset) is stored next to it.
+        """
+        if chunk_size < 1:
+            raise ValueError(f'chunk_size must be >= 1. passed {chunk_size}')
+
+        paths = const.ChunkedDataPaths(chunked_data_root_dp)
+        os.makedirs(paths.chunks_dp, exist_ok=True)
+
+        for data, dtype in [(scan, SCAN_DTYPE), (mask, MASK_DTYPE)]:
+            if data.dtype != dtype:
+                raise ValueError(f'id: "{img_id}". expected {dtype} dtype. got {data.dtype}')
+
+        h, w, n_slices = scan.shape
+        z_starts = np.arange(0, n_slices, chunk_size)
+        table = np.zeros(len(z_starts), dtype=CHUNK_INDEX_DTYPE)
+
+        offset = 0
+        with open(ChunkedDataset.get_chunks_fp(chunked_data_root_dp, img_id), 'wb') as fout:
+            for chunk_ix, z_start in enumerate(z_starts):
+                z_end = min(z_start + chunk_size, n_slices)
+                scans_slab = np.ascontiguousarray(np.transpose(scan[:, :, z_start:z_end], [2, 0, 1]))
+                masks_slab = np.ascontiguousarray(np.transpose(mask[:, :, z_start:z_end], [2, 0, 1]))
+                compressed = compress(scans_slab.tobytes() + masks_slab.tobytes(), codec)
+                fout.write(compressed)
+
+                table[chunk_ix] = (0, z_start, z_end - z_start, offset, len(compressed), h, w)
+                offset += len(compressed)
+
+        utils.store_npy(ChunkedDataset.get_chunks_table_fp(chunked_data_root_dp, img_id), table)
+
+    @staticmethod
+    def store_index(chunked_data_root_dp: str, shapes: dict, chunk_size: int, codec: str):
+        """
+        Create chunk index and volumes table for volumes stored with `store_volume`.
+
+        :param shapes: dict with (H, W, Z) volume shapes. has the same structure as `shapes.pickle`
+        """
+        paths = const.ChunkedDataPaths(chunked_data_root_dp)
+        print(f'storing chunked dataset index to "{paths.index_fp}"')
+
+        volumes = []
+        index_parts = []
+        n_chunks = 0
+        for vol_ix, (img_id, shape) in enumerate(sorted(shapes.items())):
+            table = utils.load_npy(ChunkedDataset.get_chunks_table_fp(chunked_data_root_dp, img_id))
+            table['vol_ix'] = vol_ix
+            volumes.append({
+                'id': img_id, 'shape': list(shape), 'chunk_size': chunk_size, 'codec': codec,
+                'first_chunk_ix': n_chunks
+            })
+            index_parts.append(table)
+            n_chunks += len(table)
+
+        index = np.concatenate(index_parts) if index_parts else np.zeros(0, dtype=CHUNK_INDEX_DTYPE)
+
+        os.makedirs(paths.chunked_dp, exist_ok=True)
+        utils.write_file_atomically(paths.index_fp, lambda fout: np.save(fout, index, allow_pickle=False))
+        utils.write_file_atomically(paths.volumes_fp, lambda fout: json.dump(volumes, fout, indent=2), mode='w')
@@ -1,29 +1,89 @@
+import json
 import os
 import pickle
 import shutil
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Tuple
 
 import numpy as np
 import tqdm
 
 import const
 import utils
-from data import preprocessing, augmentations
+from data import preprocessing
+from data.cache import LRUCache
+from data.catalog import DatasetCatalog
 from data.datasets import BaseDataset
+from data.datasets.chunked_dataset import ChunkedDataset
+from data.datasets.packed_dataset import PackedDataset
+from data.datasets.slice_index import SliceIndex
 
 
 class NiftiDataset(BaseDataset):
-    def __init__(self, scans_dp: str, masks_dp: str, img_ids: List[str] = None):
+    """
+    Dataset that reads slices directly from Nifti `.nii.gz` images.
+
+    Reading a single slice from `.nii.gz` requires decompression of the file up to that slice.
+    To avoid decompressing the same file over and over again, decoded volumes can be kept
+    in a bounded LRU cache and optionally spilled to uncompressed `.npy` files in a scratch directory.
+    Spilled volumes are memory-mapped, so each `.nii.gz` file is decompressed at most once per run.
+    Decoded masks are kept bit-packed (see `preprocessing.pack_mask_bits`), so they occupy 8 times less
+    memory (or scratch space) than one byte per pixel masks.
+
+    If decoded volumes can't be kept, slices can be read through a persistent gzip seek-point index
+    (see `utils.load_nifti_with_gzip_index`). Then only the data between the nearest seek point
+    and the slice is decompressed, so reading a slice takes roughly the same time regardless of its z-index.
+    """
+
+    # number of processed images after which manifest is stored while creating numpy dataset
+    MANIFEST_STORE_PERIOD = 10
+
+    def __init__(
+            self, scans_dp: str, masks_dp: str, img_ids: List[str] = None,
+            cache_max_bytes: int = 0, cache_max_volumes: int = 64, spill_dp: str = None,
+            use_gzip_index: bool = False, gzip_index_dp: str = None, catalog: DatasetCatalog = None
+    ):
+        """
+        :param cache_max_bytes: max number of bytes occupied by decoded volumes kept in memory.
+        pass 0 to disable the cache. memory-mapped spilled volumes are counted as 0 bytes
+        :param cache_max_volumes: max number of volumes (decoded or memory-mapped) to keep in cache
+        :param spill_dp: scratch directory to store decoded volumes to as uncompressed `.npy` files.
+        if None decoded volumes are kept in memory only
+        :param use_gzip_index: whether to read slices through gzip seek-point index.
+        used only if decoded volumes cache is disabled
+        :param gzip_index_dp: directory to store gzip indices to. indices are stored next to images if None
+        :param catalog: catalog to get image paths and shapes from. if None all headers are read on start
+        """
         utils.check_var_to_be_iterable_collection(img_ids)
 
         self._scans_dp = scans_dp
         self._masks_dp = masks_dp
         self._img_ids = img_ids
+        self._catalog = catalog
+
+        self._spill_dp = spill_dp
+        if spill_dp is not None:
+            os.makedirs(spill_dp, exist_ok=True)
+        self._use_volume_cache = cache_max_bytes != 0 or spill_dp is not None
+        self._volume_cache = LRUCache(max_items=cache_max_volumes, max_bytes=cache_max_bytes or None) \
+            if self._use_volume_cache else LRUCache(max_items=0)
+
+        self._use_gzip_index = use_gzip_index and not self._use_volume_cache
+        self._gzip_index_dp = gzip_index_dp
+        if use_gzip_index:
+            utils.check_indexed_gzip_is_installed()
+        # opened indexed images. each cached item is a (Nifti1Image, file object) tuple
+        self._indexed_files_cache = LRUCache(max_items=cache_max_volumes, on_evict=self._close_indexed_file)
+        self._indexed_files_pid = os.getpid()
 
         self._init_info()
-        self._init_slice_info()
+        self._init_slice_index()
 
     def _init_info(self):
+        if self._catalog is not None:
+            self._info = self._catalog.get_files_dict(self._scans_dp, self._masks_dp, ids=self._img_ids)
+            return
+
         paths_dict = utils.get_files_dict(self._scans_dp, self._masks_dp, ids=self._img_ids)
 
         for cur_id, paths in paths_dict.items():
@@ -38,12 +98,13 @@ class NiftiDataset(BaseDataset):
 
         self._info = paths_dict
 
-    def _init_slice_info(self):
-        self._slice_info = [
-            {'id': k, 'scan_fp': v['scan_fp'], 'mask_fp': v['mask_fp'], 'z_ix': x}
+    def _init_slice_index(self):
+        volumes = [
+            {'id': k, 'scan_fp': v['scan_fp'], 'mask_fp': v['mask_fp'], 'shape': v['shape']}
             for k, v in self._info.items()
-            for x in range(v['shape'][2])
         ]
+        n_slices = [v['shape'][2] for v in self._info.values()]
+        self._slice_index = SliceIndex.from_n_slices(volumes, n_slices)
 
     @property
     def n_images(self):
@@ -53,100 +114,446 @@ class NiftiDataset(BaseDataset):
         """
         Yield (scan, mask, description) tuple for single slice.
 
-        If `slice_info` dict has 'augment' == True for specified slice
+        If sample is an augmented copy of the slice (see `SliceIndex`)
         than augmentations are applied before yielding results.
         """
-        cur_info = self._slice_info[ix]
-        cur_id = cur_info['id']
-        z_ix = cur_info['z_ix']
+        volume, z_ix, augment, _ = self._slice_index.get_sample(ix)
+        cur_id = volume['id']
 
-        scan = utils.load_nifti_slice(cur_info['scan_fp'], z_ix)
-        mask = utils.load_nifti_slice(cur_info['mask_fp'], z_ix)
+        scan = self._load_slice(volume['scan_fp'], z_ix)
+        mask = self._load_mask_slice(volume['mask_fp'], z_ix, volume['shape'][1])
 
         # transforms
         scan = preprocessing.clip_intensities(scan)
 
-        if 'augment' in cur_info and cur_info['augment'] is True:
-            scan, mask = augmentations.get_single_augmentation(scan, mask)
+        to_augment = False
+        if augment:
+            scan, mask, to_augment = self._augment_sample(scan, mask)
 
         sample = {
             'scan': scan,
             'mask': mask,
-            'description': f'{cur_id}_{z_ix}'
+            'description': f'{cur_id}_{z_ix}',
+            # whether sample is left to be augmented by data loader (see `BaseDataset.set_aug_backend`)
+            'to_augment': to_augment
         }
 
         return sample
 
-    def store_as_numpy_dataset(self, out_dp: str, zoom_factor: float):
+    def cache_info(self) -> dict:
+        """Return hits and misses statistics for decoded volumes cache (or opened indexed files cache)"""
+        if self._use_gzip_index:
+            return self._indexed_files_cache.cache_info()
+        return self._volume_cache.cache_info()
+
+    def _load_slice(self, fp: str, z_ix: int) -> np.ndarray:
+        if self._use_gzip_index:
+            return self._load_slice_with_gzip_index(fp, z_ix)
+
+        if not self._use_volume_cache:
+            return utils.load_nifti_slice(fp, z_ix)
+
+        volume = self._volume_cache.get_or_load(fp, lambda: self._decode_volume(fp))
+        # copy slice to detach it from cached volume
+        return np.array(volume[:, :, z_ix])
+
+    def _load_mask_slice(self, fp: str, z_ix: int, width: int) -> np.ndarray:
+        if self._use_gzip_index or not self._use_volume_cache:
+            return self._load_slice(fp, z_ix)
+
+        volume_packed = self._volume_cache.get_or_load(fp, lambda: self._decode_volume(fp, is_mask=True))
+        return preprocessing.unpack_mask_bits(volume_packed[:, :, z_ix], width)
+
+    def _load_slice_with_gzip_index(self, fp: str, z_ix: int) -> np.ndarray:
+        if self._indexed_files_pid != os.getpid():
+            # forked worker process inherited opened files of the parent.
+            # reading them would move file position shared with the parent, so open own files
+            self._indexed_files_cache = LRUCache(
+                max_items=self._indexed_files_cache.cache_info()['max_items'], on_evict=self._close_indexed_file
+            )
+            self._indexed_files_pid = os.getpid()
+
+        image, _ = self._indexed_files_cache.get_or_load(
+            fp, lambda: utils.load_nifti_with_gzip_index(fp, self._gzip_index_dp)
+        )
+        return np.asarray(image.dataobj[:, :, z_ix])
+
+    @staticmethod
+    def _close_indexed_file(fp: str, item):
+        _, fileobj = item
+        fileobj.close()
+
+    def _get_spill_fp(self, fp: str, is_mask: bool = False):
+        fn = os.path.basename(fp)
+        fn = fn[:-len('.nii.gz')] if fn.endswith('.nii.gz') else fn
+        return os.path.join(self._spill_dp, f'{fn}.bits.npy' if is_mask else f'{fn}.npy')
+
+    def _decode_volume(self, fp: str, is_mask: bool = False) -> np.ndarray:
+        """
+        Decompress the whole volume. If spill directory is set, store decoded volume
+        to `.npy` file (or reuse already stored one) and return it memory-mapped.
+
+        :param is_mask: whether volume is a binary mask. masks are bit-packed along rows
+        """
+        if self._spill_dp is None:
+            return self._decode_nifti(fp, is_mask)
+
+        spill_fp = self._get_spill_fp(fp, is_mask)
+        if not os.path.isfile(spill_fp) or os.path.getmtime(spill_fp) < os.path.getmtime(fp):
+            data = self._decode_nifti(fp, is_mask)
+            # write to temporary file first so that concurrent readers never see partial file
+            tmp_fp = f'{spill_fp}.{os.getpid()}.tmp'
+            with open(tmp_fp, 'wb') as fout:
+                np.save(fout, data, allow_pickle=False)
+            os.replace(tmp_fp, spill_fp)
+
+        return utils.load_npy(spill_fp, mmap_mode='r')
+
+    @staticmethod
+    def _decode_nifti(fp: str, is_mask: bool) -> np.ndarray:
+        _, data = utils.load_nifti(fp)
+        if is_mask:
+            data = preprocessing.pack_mask_bits(data, axis=1)
+        return data
+
+    def store_as_numpy_dataset(
+            self, out_dp: str, zoom_factor: float, store_packed: bool = False,
+            n_workers: int = None, rebuild: bool = False, chunked_params: dict = None,
+            crop_params: dict = None, verify_checksums: bool = False
+    ):
         """
         Convert Nifti images to numpy nd.arrays and store them to .npy files
         to save time on probably time-expensive zoom.
+
+        Dataset creation is incremental: manifest with source files stats, zoom factor
+        and output files checksums is stored under `out_dp`. Only new images, images with changed
+        source files and images with missing outputs or outputs of changed size are processed.
+        Outputs with changed content of the same size are detected only with `verify_checksums`.
+        Images are processed in parallel in a pool of worker processes.
+
+        :param store_packed: whether to additionally store images in slice-major format
+        for `PackedDataset`
+        :param n_workers: number of worker processes. defaults to number of CPUs
+        :param rebuild: whether to remove `out_dp` and process all the images
+        :param chunked_params: dict with 'chunk_size' and 'codec' keys. if passed images are additionally
+        stored as compressed chunks for `ChunkedDataset`
+        :param crop_params: dict with 'margin' key. if passed images are cropped to body bounding box
+        with margin (see `preprocessing.get_body_bbox`) before zoom. bounding boxes are stored to `crops.json`
+        :param verify_checksums: whether to compare md5 of existing outputs with the ones stored in manifest.
+        reads all the outputs, so it's off by default
+        """
+        self.store_as_numpy_datasets(
+            {zoom_factor: out_dp}, store_packed, n_workers, rebuild, chunked_params, crop_params, verify_checksums
+        )
+
+    def store_as_numpy_datasets(
+            self, out_dps: Dict[float, str], store_packed: bool = False,
+            n_workers: int = None, rebuild: bool = False, chunked_params: dict = None,
+            crop_params: dict = None, verify_checksums: bool = False
+    ):
+        """
+        Create numpy datasets for several zoom factors at once.
+        Each image is decoded only once and is zoomed for all the zoom factors it's outdated for.
+        See `store_as_numpy_dataset` for details.
+
+        :param out_dps: dict with output directory path for each zoom factor
         """
         print(const.SEPARATOR)
-        print('NiftiDataset.store_as_numpy_dataset():')
-        print(f'\nout_dp: {out_dp}')
-        print(f'zoom_factor: {zoom_factor}')
-
-        if os.path.isdir(out_dp):
-            print(f'\noutput dir "{out_dp}" already exists. \nwill remove and create a new one.')
-            shutil.rmtree(out_dp)
-
-        numpy_scans_dp = os.path.join(out_dp, 'numpy', 'scans')
-        numpy_masks_dp = os.path.join(out_dp, 'numpy', 'masks')
-        nifti_dp = os.path.join(out_dp, 'nifti')
-        os.makedirs(numpy_scans_dp, exist_ok=True)
-        os.makedirs(numpy_masks_dp, exist_ok=True)
-        os.makedirs(nifti_dp, exist_ok=True)
-
-        # store shapes dict for NumpyDataset
-        shapes_dict = {k: v['shape'] for (k, v) in self._info.items()}
-        shapes_dict_fp = os.path.join(out_dp, 'numpy', 'shapes.pickle')
-        with open(shapes_dict_fp, 'wb')as fout:
-            pickle.dump(shapes_dict, fout)
-
-        # process and store scans with masks
-        with tqdm.tqdm(total=len(self._info), unit='scan', bar_format=const.TQDM_BAR_FORMAT) as pbar:
-            for cur_id, cur_info in self._info.items():
-                pbar.set_description(f'image: {cur_id}. shape: {cur_info["shape"]}')
-
-                scan_img, scan_data = utils.load_nifti(cur_info['scan_fp'])
-                mask_img, mask_data = utils.load_nifti(cur_info['mask_fp'])
-
-                # check raw mask
-                mask_is_ok, msg = utils.validate_binary_mask(mask_data)
-                if not mask_is_ok:
-                    raise ValueError(f'id: "{cur_id}". {msg}')
-
-                # clip scan
-                scan_data = preprocessing.clip_intensities(scan_data)
-
-                # convert scan to np.int16 after clipping intensities if needed
-                if scan_data.dtype != np.int16:
-                    print(f'\nWARNING: scan {cur_id} has {scan_data.dtype} dtype.\n'
-                          f'will convert to np.int16')
-                    scan_data = scan_data.astype(np.int16)
-
-                # zoom scan and mask
-                scan_data = preprocessing.zoom_volume_along_x_y(scan_data, zoom_factor)
-                mask_data = preprocessing.zoom_volume_along_x_y(mask_data, zoom_factor)
-
-                # check mask after all transformations
-                mask_is_ok, msg = utils.validate_binary_mask(mask_data)
-                if not mask_is_ok:
-                    raise ValueError(f'id: "{cur_id}". {msg}')
-
-                # store numpy arrays to files
-                utils.store_npy(os.path.join(numpy_scans_dp, f'{cur_id}.npy'), scan_data)
-                utils.store_npy(os.path.join(numpy_masks_dp, f'{cur_id}.npy'), mask_data)
-
-                # also store processed images to Nifti
-                scan_img_new = utils.change_nifti_data(
-                    data_new=scan_data, nifti_original=scan_img, is_scan=True
+        print('NiftiDataset.store_as_numpy_datasets():')
+        print(f'\nout_dps: {out_dps}')
+        print(f'store_packed: {store_packed}')
+        print(f'chunked_params: {chunked_params}')
+        print(f'crop_params: {crop_params}')
+        print(f'verify_checksums: {verify_checksums}')
+        print(f'n_workers: {n_workers}')
+
+        manifests = {
+            out_dp: self._prepare_numpy_dataset_dir(out_dp, zoom_factor, rebuild)
+            for (zoom_factor, out_dp) in out_dps.items()
+        }
+
+        # (zoom factor, output dir) pairs each image needs to be processed for
+        targets = {}
+        for (cur_id, cur_info) in self._info.items():
+            cur_targets = [
+                (zoom_factor, out_dp) for (zoom_factor, out_dp) in out_dps.items()
+                if not _volume_is_up_to_date(
+                    manifests[out_dp]['volumes'].get(cur_id), cur_info, out_dp,
+                    store_packed, chunked_params, crop_params, verify_checksums
                 )
-                mask_img_new = utils.change_nifti_data(
-                    data_new=mask_data, nifti_original=mask_img, is_scan=False
+            ]
+            if cur_targets:
+                targets[cur_id] = cur_targets
+
+        print(f'\n# of images: {len(self._info)}')
+        print(f'# of up-to-date images: {len(self._info) - len(targets)}')
+        print(f'# of images to process: {len(targets)}')
+
+        # ids of images failed to be processed. the other images are processed and recorded anyway
+        failed_ids = []
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor, \
+                    tqdm.tqdm(total=len(targets), unit='scan', bar_format=const.TQDM_BAR_FORMAT) as pbar:
+                futures = {
+                    executor.submit(
+                        _process_volume, cur_id, self._info[cur_id]['scan_fp'], self._info[cur_id]['mask_fp'],
+                        cur_targets, store_packed, chunked_params, crop_params
+                    ): cur_id for (cur_id, cur_targets) in targets.items()
+                }
+                for n_done, future in enumerate(as_completed(futures), start=1):
+                    try:
+                        records = future.result()
+                    except Exception as e:
+                        failed_ids.append(futures[future])
+                        tqdm.tqdm.write(f'failed to process image "{futures[future]}": {e!r}')
+                        records = {}
+                    for out_dp, record in records.items():
+                        manifests[out_dp]['volumes'][record['id']] = record
+                        pbar.set_description(f'image: {record["id"]}. shape: {record["src_shape"]}')
+                    pbar.update()
+                    if n_done % NiftiDataset.MANIFEST_STORE_PERIOD == 0:
+                        for out_dp, manifest in manifests.items():
+                            _store_manifest(const.NumpyDataPaths(out_dp).manifest_fp, manifest)
+        finally:
+            # keep records of already processed images even if processing failed
+            for out_dp, manifest in manifests.items():
+                _store_manifest(const.NumpyDataPaths(out_dp).manifest_fp, manifest)
+
+        if failed_ids:
+            # indices are stored only for complete datasets. rerun to process failed images only
+            raise RuntimeError(f'failed to process {len(failed_ids)} images: {sorted(failed_ids)}')
+
+        for out_dp, manifest in manifests.items():
+            paths = const.NumpyDataPaths(out_dp)
+
+            # store shapes dict of processed volumes (after crop and zoom) for NumpyDataset
+            shapes_dict = {k: tuple(v['shape']) for (k, v) in manifest['volumes'].items()}
+            print(f'\nstoring shapes dict to "{paths.shapes_fp}"')
+            utils.write_file_atomically(paths.shapes_fp, lambda fout: pickle.dump(shapes_dict, fout))
+
+            if store_packed:
+                PackedDataset.store_index(out_dp, shapes_dict)
+
+            if chunked_params is not None:
+                ChunkedDataset.store_index(out_dp, shapes_dict, **chunked_params)
+
+            # per-slice stats for samplers (see `BaseDataset.load_slices_stats`)
+            stats_dict = {k: v['slices_stats'] for (k, v) in manifest['volumes'].items()}
+            print(f'storing slices stats to "{paths.slices_stats_fp}"')
+            utils.write_file_atomically(paths.slices_stats_fp, lambda fout: json.dump(stats_dict, fout), mode='w')
+
+            if crop_params is not None:
+                # crops are stored in source image coordinates
+                crops_dict = {
+                    k: {'bbox': v['bbox'], 'src_shape': v['src_shape']} for (k, v) in manifest['volumes'].items()
+                }
+                print(f'storing crops dict to "{paths.crops_fp}"')
+                utils.write_file_atomically(
+                    paths.crops_fp, lambda fout: json.dump(crops_dict, fout, indent=2), mode='w'
                 )
-                utils.store_nifti_to_file(scan_img_new, os.path.join(nifti_dp, f'{cur_id}.nii.gz'))
-                utils.store_nifti_to_file(mask_img_new, os.path.join(nifti_dp, f'{cur_id}_autolungs.nii.gz'))
 
-                pbar.update()
+    def _prepare_numpy_dataset_dir(self, out_dp: str, zoom_factor: float, rebuild: bool) -> dict:
+        """
+        Load manifest of numpy dataset under `out_dp` (or remove the directory if it has to be rebuilt)
+        and remove outputs of images that are no longer present among sources.
+
+        :return: manifest
+        """
+        paths = const.NumpyDataPaths(out_dp)
+        manifest = _load_manifest(paths.manifest_fp)
+        if rebuild or manifest is None or manifest['zoom_factor'] != zoom_factor:
+            if os.path.isdir(out_dp):
+                print(f'\noutput dir "{out_dp}" already exists and will be rebuilt. '
+                      f'\nwill remove and create a new one.')
+                shutil.rmtree(out_dp)
+            manifest = {'zoom_factor': zoom_factor, 'volumes': {}}
+
+        os.makedirs(paths.scans_dp, exist_ok=True)
+        os.makedirs(paths.masks_dp, exist_ok=True)
+        os.makedirs(paths.masks_bits_dp, exist_ok=True)
+        os.makedirs(paths.nifti_dp, exist_ok=True)
+
+        ids_removed = [k for k in manifest['volumes'] if k not in self._info]
+        for cur_id in ids_removed:
+            for rel_fp in manifest['volumes'].pop(cur_id)['outputs']:
+                fp = os.path.join(out_dp, rel_fp)
+                if os.path.isfile(fp):
+                    os.remove(fp)
+        print(f'\n"{out_dp}": # of removed images: {len(ids_removed)}')
+
+        return manifest
+
+
+def _load_manifest(manifest_fp: str):
+    if not os.path.isfile(manifest_fp):
+        return None
+    with open(manifest_fp) as fin:
+        return json.load(fin)
+
+
+def _store_manifest(manifest_fp: str, manifest: dict):
+    utils.write_file_atomically(manifest_fp, lambda fout: json.dump(manifest, fout, indent=2), mode='w')
+
+
+def _get_source_stats(fp: str) -> dict:
+    st = os.stat(fp)
+    return {'path': os.path.abspath(fp), 'mtime': st.st_mtime, 'size': st.st_size}
+
+
+def _get_output_rel_fps(cur_id: str, store_packed: bool, chunked_params: dict) -> List[str]:
+    rel_fps = [
+        os.path.join('numpy', 'scans', f'{cur_id}.npy'),
+        os.path.join('numpy', 'masks', f'{cur_id}.npy'),
+        os.path.join('numpy', 'masks_bits', f'{cur_id}.npy'),
+        os.path.join('nifti', f'{cur_id}.nii.gz'),
+        os.path.join('nifti', f'{cur_id}_autolungs.nii.gz')
+    ]
+    if store_packed:
+        rel_fps.extend([
+            os.path.join('packed', 'scans', f'{cur_id}.bin'),
+            os.path.join('packed', 'masks', f'{cur_id}.bin')
+        ])
+    if chunked_params is not None:
+        rel_fps.extend([
+            os.path.join('chunked', 'chunks', f'{cur_id}.bin'),
+            os.path.join('chunked', 'chunks', f'{cur_id}.npy')
+        ])
+    return rel_fps
+
+
+def _volume_is_up_to_date(
+        record: dict, info: dict, out_dp: str, store_packed: bool, chunked_params: dict, crop_params: dict,
+        verify_checksums: bool = False
+) -> bool:
+    """
+    Check manifest record of the image against its source files and outputs.
+    Outputs are checked for existence and size.
+
+    :param verify_checksums: whether to additionally compare md5 of outputs with the ones stored in manifest
+    """
+    if record is None:
+        return False
+    if record['scan_src'] != _get_source_stats(info['scan_fp']) or \
+            record['mask_src'] != _get_source_stats(info['mask_fp']):
+        return False
+    if chunked_params is not None and record.get('chunked_params') != chunked_params:
+        return False
+    if record.get('crop_params') != crop_params or 'slices_stats' not in record:
+        return False
+
+    for rel_fp in _get_output_rel_fps(record['id'], store_packed, chunked_params):
+        fp = os.path.join(out_dp, rel_fp)
+        if rel_fp not in record['outputs'] or not os.path.isfile(fp) or \
+                os.path.getsize(fp) != record['outputs'][rel_fp]['size']:
+            return False
+        if verify_checksums and utils.get_file_md5(fp) != record['outputs'][rel_fp].get('md5'):
+            return False
+
+    return True
+
+
+def _process_volume(
+        cur_id: str, scan_fp: str, mask_fp: str, targets: List[Tuple[float, str]],
+        store_packed: bool, chunked_params: dict, crop_params: dict
+) -> Dict[str, dict]:
+    """
+    Process single image and store outputs for each (zoom factor, output dir) pair in `targets`.
+    Image is decoded only once. Is run in worker processes of `store_as_numpy_datasets`.
+
+    :return: dict with manifest record of the image for each output dir
+    """
+    scan_src, mask_src = _get_source_stats(scan_fp), _get_source_stats(mask_fp)
+
+    scan_img, scan_data = utils.load_nifti(scan_fp)
+    mask_img, mask_data = utils.load_nifti(mask_fp)
+    src_shape = scan_data.shape
+
+    # check raw mask
+    mask_is_ok, msg = utils.validate_binary_mask(mask_data)
+    if not mask_is_ok:
+        raise ValueError(f'id: "{cur_id}". {msg}')
+
+    # clip scan
+    scan_data = preprocessing.clip_intensities(scan_data)
+
+    # convert scan to np.int16 after clipping intensities if needed
+    if scan_data.dtype != np.int16:
+        print(f'\nWARNING: scan {cur_id} has {scan_data.dtype} dtype.\n'
+              f'will convert to np.int16')
+        scan_data = scan_data.astype(np.int16)
+
+    # body mask is used both for crop and per-slice stats
+    body_mask = preprocessing.get_body_mask(scan_data)
+
+    # crop scan and mask to body bounding box
+    bbox = (0, src_shape[0], 0, src_shape[1])
+    if crop_params is not None:
+        bbox = preprocessing.get_body_bbox(body_mask, crop_params['margin'])
+        mask_sum = mask_data.sum()
+        scan_data = preprocessing.crop_volume_along_x_y(scan_data, bbox)
+        mask_data = preprocessing.crop_volume_along_x_y(mask_data, bbox)
+        body_mask = preprocessing.crop_volume_along_x_y(body_mask, bbox)
+        if mask_data.sum() != mask_sum:
+            print(f'\nWARNING: mask {cur_id} is not entirely inside body bounding box {bbox}.\n'
+                  f'part of the mask is cropped')
+
+    records = {}
+    for zoom_factor, out_dp in targets:
+        paths = const.NumpyDataPaths(out_dp)
+
+        # zoom scan and mask
+        scan_zoomed = preprocessing.zoom_volume_along_x_y(scan_data, zoom_factor)
+        mask_zoomed = preprocessing.zoom_volume_along_x_y(mask_data, zoom_factor)
+
+        # check mask after all transformations
+        mask_is_ok, msg = utils.validate_binary_mask(mask_zoomed)
+        if not mask_is_ok:
+            raise ValueError(f'id: "{cur_id}". zoom_factor: {zoom_factor}. {msg}')
+
+        # per-slice stats of processed volume
+        slices_stats = preprocessing.get_slices_stats(
+            mask_zoomed, preprocessing.zoom_volume_along_x_y(body_mask, zoom_factor)
+        )
+
+        # store numpy arrays to files
+        utils.store_npy(os.path.join(paths.scans_dp, f'{cur_id}.npy'), scan_zoomed)
+        utils.store_npy(os.path.join(paths.masks_dp, f'{cur_id}.npy'), mask_zoomed)
+        utils.store_npy(
+            os.path.join(paths.masks_bits_dp, f'{cur_id}.npy'), preprocessing.pack_mask_bits(mask_zoomed, axis=1)
+        )
+
+        if store_packed:
+            PackedDataset.store_volume(out_dp, cur_id, scan_zoomed, mask_zoomed)
+
+        if chunked_params is not None:
+            ChunkedDataset.store_volume(out_dp, cur_id, scan_zoomed, mask_zoomed, **chunked_params)
+
+        # also store processed images to Nifti
+        scan_img_new = utils.change_nifti_data(
+            data_new=scan_zoomed, nifti_original=scan_img, is_scan=True
+        )
+        mask_img_new = utils.change_nifti_data(
+            data_new=mask_zoomed, nifti_original=mask_img, is_scan=False
+        )
+        utils.store_nifti_to_file(scan_img_new, os.path.join(paths.nifti_dp, f'{cur_id}.nii.gz'))
+        utils.store_nifti_to_file(mask_img_new, os.path.join(paths.nifti_dp, f'{cur_id}_autolungs.nii.gz'))
+
+        outputs = {}
+        for rel_fp in _get_output_rel_fps(cur_id, store_packed, chunked_params):
+            fp = os.path.join(out_dp, rel_fp)
+            outputs[rel_fp] = {'size': os.path.getsize(fp), 'md5': utils.get_file_md5(fp)}
+
+        records[out_dp] = {
+            'id': cur_id,
+            'scan_src': scan_src,
+            'mask_src': mask_src,
+            'src_shape': list(src_shape),
+            'shape': list(scan_zoomed.shape),
+            'chunked_params': chunked_params,
+            'crop_params': crop_params,
+            'bbox': [int(x) for x in bbox],
+            'slices_stats': slices_stats,
+            'outputs': outputs
+        }
+
+    return records
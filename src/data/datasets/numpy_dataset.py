@@ -2,25 +2,74 @@ import os
 import pickle
 from typing import List
 
+import numpy as np
 import tqdm
 
 import const
 import utils
-from data import augmentations
+from data import preprocessing
+from data.cache import LRUCache
 from data.datasets import BaseDataset
+from data.datasets.slice_index import SliceIndex
 
 
 class NumpyDataset(BaseDataset):
-    def __init__(self, scans_dp: str, masks_dp: str, images_shapes_fp: str, img_ids: List[str] = None):
+    """
+    Dataset that reads slices from .npy volumes created with `NiftiDataset.store_as_numpy_dataset`.
+
+    With `access_mode='load'` the whole volume is read from file for every slice.
+    With `access_mode='mmap'` volumes are memory-mapped. Volumes are stored C-ordered with (H, W, Z) shape,
+    so a single slice is a strided gather of one element per Z elements: unless volume has thousands of slices
+    it touches every page of the file, and the first read of a slice pulls the whole volume through page cache.
+    Following reads of the same volume are served from page cache while it's not evicted.
+    Use `PackedDataset` that stores slice-major shards to read no more than a slice from disk.
+    Open volume handles and recently read slices are kept in bounded LRU caches.
+
+    With `mask_format='bits'` masks are read from bit-packed volumes (see `preprocessing.pack_mask_bits`):
+    mask I/O and memory occupied by cached mask slices are 8 times smaller.
+    Masks are unpacked right before they are yielded.
+    """
+
+    ACCESS_MODES = ['load', 'mmap']
+    MASK_FORMATS = ['uint8', 'bits']
+
+    def __init__(
+            self, scans_dp: str, masks_dp: str, images_shapes_fp: str, img_ids: List[str] = None,
+            access_mode: str = 'load', cache_max_volumes: int = 32, cache_max_bytes: int = None,
+            slice_cache_max_bytes: int = 0, mask_format: str = 'uint8'
+    ):
+        """
+        :param access_mode: how to read .npy volumes: 'load' or 'mmap'
+        :param cache_max_volumes: max number of volumes to keep in volume cache.
+        volume cache is used only with `access_mode='mmap'`
+        :param cache_max_bytes: max number of bytes to keep in volume cache. no limit if None.
+        memory-mapped volumes are not resident in memory and are counted as 0 bytes
+        :param slice_cache_max_bytes: max number of bytes occupied by cached slices.
+        pass 0 to disable slice cache, None - for unbounded cache
+        :param mask_format: format of masks under `masks_dp`: 'uint8' - one byte per pixel,
+        'bits' - bit-packed along rows (see `const.NumpyDataPaths.masks_bits_dp`)
+        """
         utils.check_var_to_be_iterable_collection(img_ids)
+        if access_mode not in NumpyDataset.ACCESS_MODES:
+            raise ValueError(f'`access_mode` should be in {NumpyDataset.ACCESS_MODES}. passed "{access_mode}"')
+        if mask_format not in NumpyDataset.MASK_FORMATS:
+            raise ValueError(f'`mask_format` should be in {NumpyDataset.MASK_FORMATS}. passed "{mask_format}"')
 
         self._scans_dp = scans_dp
         self._masks_dp = masks_dp
         self._images_shapes_fp = images_shapes_fp
         self._img_ids = img_ids
+        self._access_mode = access_mode
+        self._mask_format = mask_format
+
+        if access_mode == 'mmap':
+            self._volume_cache = LRUCache(max_items=cache_max_volumes, max_bytes=cache_max_bytes)
+        else:
+            self._volume_cache = LRUCache(max_items=0)
+        self._slice_cache = LRUCache(max_bytes=slice_cache_max_bytes)
 
         self._load_images_shapes()
-        self._init_slice_info()
+        self._init_slice_index()
 
     def _load_images_shapes(self):
         if not os.path.isfile(self._images_shapes_fp):
@@ -34,15 +83,17 @@ class NumpyDataset(BaseDataset):
         if self._img_ids is not None:
             self._shapes = {k: v for (k, v) in self._shapes.items() if k in self._img_ids}
 
-    def _init_slice_info(self):
-        self._slice_info = [
+    def _init_slice_index(self):
+        volumes = [
             {
                 'id': cur_id,
                 'scan_fp': os.path.join(self._scans_dp, f'{cur_id}.npy'),
                 'mask_fp': os.path.join(self._masks_dp, f'{cur_id}.npy'),
-                'z_ix': z
-            } for (cur_id, cur_shape) in self._shapes.items() for z in range(cur_shape[2])
+                'shape': cur_shape
+            } for (cur_id, cur_shape) in self._shapes.items()
         ]
+        n_slices = [cur_shape[2] for cur_shape in self._shapes.values()]
+        self._slice_index = SliceIndex.from_n_slices(volumes, n_slices)
 
     @property
     def n_images(self):
@@ -52,27 +103,60 @@ class NumpyDataset(BaseDataset):
         """
         Yield (scan, mask, description) tuple for single slice.
 
-        If `slice_info` dict has 'augment' == True for specified slice
+        If sample is an augmented copy of the slice (see `SliceIndex`)
         than augmentations are applied before yielding results.
         """
-        cur_info = self._slice_info[ix]
-        cur_id = cur_info['id']
-        z_ix = cur_info['z_ix']
+        volume, z_ix, augment, _ = self._slice_index.get_sample(ix)
+        cur_id = volume['id']
 
-        scan = utils.load_npy(cur_info['scan_fp'])[:, :, z_ix]
-        mask = utils.load_npy(cur_info['mask_fp'])[:, :, z_ix]
+        scan, mask = self._load_slices(volume['scan_fp'], volume['mask_fp'], z_ix)
+        if self._mask_format == 'bits':
+            mask = preprocessing.unpack_mask_bits(mask, scan.shape[1])
 
-        if 'augment' in cur_info and cur_info['augment'] is True:
-            scan, mask = augmentations.get_single_augmentation(scan, mask)
+        to_augment = False
+        if augment:
+            scan, mask, to_augment = self._augment_sample(scan, mask)
 
         sample = {
             'scan': scan,
             'mask': mask,
-            'description': f'{cur_id}_{z_ix}'
+            'description': f'{cur_id}_{z_ix}',
+            # whether sample is left to be augmented by data loader (see `BaseDataset.set_aug_backend`)
+            'to_augment': to_augment
         }
 
         return sample
 
+    def cache_info(self) -> dict:
+        """Return hits and misses statistics for volume and slice caches"""
+        return {'volumes': self._volume_cache.cache_info(), 'slices': self._slice_cache.cache_info()}
+
+    def _load_volume(self, fp: str) -> np.ndarray:
+        if self._access_mode == 'mmap':
+            return self._volume_cache.get_or_load(fp, lambda: utils.load_npy(fp, mmap_mode='r'))
+        return utils.load_npy(fp)
+
+    def _load_slices(self, scan_fp: str, mask_fp: str, z_ix: int):
+        key = (scan_fp, z_ix)
+        cached = self._slice_cache.get(key)
+        if cached is not None:
+            scan, mask = cached
+        else:
+            # copy slices to detach them from memory-mapped files.
+            # bit-packed masks are cached packed
+            scan = np.array(self._load_volume(scan_fp)[:, :, z_ix])
+            mask = np.array(self._load_volume(mask_fp)[:, :, z_ix])
+            self._slice_cache.put(key, (scan, mask))
+
+        # return copies as augmentations might modify arrays in-place.
+        # unpacking of bit-packed mask creates a new array anyway
+        if self._slice_cache.enabled:
+            scan = scan.copy()
+            if self._mask_format != 'bits':
+                mask = mask.copy()
+
+        return scan, mask
+
     @staticmethod
     def store_images_shapes(numpy_data_root_dp, out_fp: str = None):
         """
@@ -0,0 +1,206 @@
+import json
+import os
+from typing import List
+
+import numpy as np
+
+import const
+import utils
+from data.cache import LRUCache
+from data.datasets import BaseDataset
+from data.datasets.slice_index import SliceIndex
+
+# single row of slice index: volume index in volumes table, slice z-index,
+# byte offsets of the slice in scan and mask shards and slice shape
+PACKED_INDEX_DTYPE = np.dtype([
+    ('vol_ix', np.int32),
+    ('z_ix', np.int32),
+    ('scan_offset', np.int64),
+    ('mask_offset', np.int64),
+    ('h', np.int32),
+    ('w', np.int32)
+])
+
+SCAN_DTYPE = np.dtype(np.int16)
+MASK_DTYPE = np.dtype(np.uint8)
+
+
+class PackedDataset(BaseDataset):
+    """
+    Dataset that reads slices from slice-major (Z, H, W) binary shards.
+
+    Shards are created with `PackedDataset.store_volume` and `PackedDataset.store_index`
+    (see `NiftiDataset.store_as_numpy_dataset`). Each slice occupies a contiguous range of bytes,
+    so reading a single slice is a single `pread` call or a contiguous read from memory-mapped shard.
+    Location of every slice is stored in compact slice index (see `PACKED_INDEX_DTYPE`).
+    """
+
+    ACCESS_MODES = ['pread', 'mmap']
+
+    def __init__(
+            self, packed_data_root_dp: str, img_ids: List[str] = None,
+            access_mode: str = 'pread', cache_max_volumes: int = 64
+    ):
+        """
+        :param packed_data_root_dp: root directory of processed dataset (see `const.PackedDataPaths`)
+        :param access_mode: how to read shards: 'pread' or 'mmap'
+        :param cache_max_volumes: max number of shards to keep open
+        """
+        utils.check_var_to_be_iterable_collection(img_ids)
+        if access_mode not in PackedDataset.ACCESS_MODES:
+            raise ValueError(f'`access_mode` should be in {PackedDataset.ACCESS_MODES}. passed "{access_mode}"')
+
+        self._paths = const.PackedDataPaths(packed_data_root_dp)
+        self._img_ids = img_ids
+        self._access_mode = access_mode
+
+        # each cached item holds either opened file descriptor or memory-mapped shard
+        self._shards_cache = LRUCache(max_items=cache_max_volumes, on_evict=self._close_shard)
+
+        self._load_index()
+        self._init_slice_index()
+
+    def _load_index(self):
+        if not os.path.isfile(self._paths.index_fp):
+            raise FileNotFoundError(f'{self._paths.index_fp}')
+
+        print(f'loading packed dataset index from "{self._paths.index_fp}"')
+        with open(self._paths.volumes_fp) as fin:
+            self._volumes = json.load(fin)
+        self._index = utils.load_npy(self._paths.index_fp)
+
+        # filter images. volumes table holds only volumes of the split, so max slice shape
+        # and slices stats are taken for them only (see `BaseDataset`)
+        if self._img_ids is not None:
+            img_ids = set(self._img_ids)
+            is_kept = np.array([v['id'] in img_ids for v in self._volumes], dtype=bool)
+            self._volumes = [v for (v, kept) in zip(self._volumes, is_kept) if kept]
+            # index of each kept volume in filtered volumes table
+            new_vol_ixs = np.cumsum(is_kept) - 1
+            self._index = self._index[is_kept[self._index['vol_ix']]]
+            self._index['vol_ix'] = new_vol_ixs[self._index['vol_ix']]
+        self._n_images = len(self._volumes)
+
+    def _init_slice_index(self):
+        # rows of slice index match rows of packed index
+        self._slice_index = SliceIndex(self._volumes, self._index['vol_ix'], self._index['z_ix'])
+
+    @property
+    def n_images(self):
+        return self._n_images
+
+    def __getitem__(self, ix):
+        """
+        Yield (scan, mask, description) tuple for single slice.
+
+        If sample is an augmented copy of the slice (see `SliceIndex`)
+        than augmentations are applied before yielding results.
+        """
+        volume, z_ix, augment, row_ix = self._slice_index.get_sample(ix)
+        cur_id = volume['id']
+        row = self._index[row_ix]
+
+        scan = self._read_slice(self._get_scan_fp(cur_id), row['scan_offset'], row['h'], row['w'], SCAN_DTYPE)
+        mask = self._read_slice(self._get_mask_fp(cur_id), row['mask_offset'], row['h'], row['w'], MASK_DTYPE)
+
+        to_augment = False
+        if augment:
+            scan, mask, to_augment = self._augment_sample(scan, mask)
+
+        sample = {
+            'scan': scan,
+            'mask': mask,
+            'description': f'{cur_id}_{z_ix}',
+            # whether sample is left to be augmented by data loader (see `BaseDataset.set_aug_backend`)
+            'to_augment': to_augment
+        }
+
+        return sample
+
+    def cache_info(self) -> dict:
+        """Return hits and misses statistics for opened shards cache"""
+        return self._shards_cache.cache_info()
+
+    def _get_scan_fp(self, img_id: str):
+        return os.path.join(self._paths.scans_dp, f'{img_id}.bin')
+
+    def _get_mask_fp(self, img_id: str):
+        return os.path.join(self._paths.masks_dp, f'{img_id}.bin')
+
+    def _open_shard(self, fp: str, dtype: np.dtype):
+        if self._access_mode == 'mmap':
+            return np.memmap(fp, dtype=dtype, mode='r')
+        return os.open(fp, os.O_RDONLY)
+
+    @staticmethod
+    def _close_shard(fp: str, shard):
+        if isinstance(shard, int):
+            os.close(shard)
+
+    def _read_slice(self, fp: str, offset: int, h: int, w: int, dtype: np.dtype) -> np.ndarray:
+        shard = self._shards_cache.get_or_load(fp, lambda: self._open_shard(fp, dtype))
+        n_items = int(h) * int(w)
+
+        if self._access_mode == 'mmap':
+            start = int(offset) // dtype.itemsize
+            res = np.array(shard[start: start + n_items])
+        else:
+            n_bytes = n_items * dtype.itemsize
+            buf = os.pread(shard, n_bytes, int(offset))
+            if len(buf) != n_bytes:
+                raise IOError(f'could not read slice from "{fp}" at offset {offset}: '
+                              f'read {len(buf)} bytes out of {n_bytes}')
+            # read-only array over the read bytes. augmentations and collation copy slices
+            res = np.frombuffer(buf, dtype=dtype)
+
+        return res.reshape(h, w)
+
+    @staticmethod
+    def store_volume(packed_data_root_dp: str, img_id: str, scan: np.ndarray, mask: np.ndarray):
+        """
+        Store scan and mask volumes of shape (H, W, Z) to slice-major (Z, H, W) binary shards.
+        """
+        paths = const.PackedDataPaths(packed_data_root_dp)
+        os.makedirs(paths.scans_dp, exist_ok=True)
+        os.makedirs(paths.masks_dp, exist_ok=True)
+
+        for data, dtype, dp in [(scan, SCAN_DTYPE, paths.scans_dp), (mask, MASK_DTYPE, paths.masks_dp)]:
+            if data.dtype != dtype:
+                raise ValueError(f'id: "{img_id}". expected {dtype} dtype. got {data.dtype}')
+            data_slice_major = np.ascontiguousarray(np.transpose(data, [2, 0, 1]))
+            data_slice_major.tofile(os.path.join(dp, f'{img_id}.bin'))
+
+    @staticmethod
+    def store_index(packed_data_root_dp: str, shapes: dict):
+        """
+        Create slice index and volumes table for volumes stored with `store_volume`.
+
+        :param shapes: dict with (H, W, Z) volume shapes. has the same structure as `shapes.pickle`
+        """
+        paths = const.PackedDataPaths(packed_data_root_dp)
+        print(f'storing packed dataset index to "{paths.index_fp}"')
+
+        volumes = []
+        index_parts = []
+        for vol_ix, (img_id, shape) in enumerate(sorted(shapes.items())):
+            h, w, n_slices = shape
+            volumes.append({
+                'id': img_id, 'shape': list(shape),
+                'scan_dtype': SCAN_DTYPE.name, 'mask_dtype': MASK_DTYPE.name
+            })
+
+            cur_index = np.zeros(n_slices, dtype=PACKED_INDEX_DTYPE)
+            cur_index['vol_ix'] = vol_ix
+            cur_index['z_ix'] = np.arange(n_slices)
+            cur_index['scan_offset'] = cur_index['z_ix'].astype(np.int64) * h * w * SCAN_DTYPE.itemsize
+            cur_index['mask_offset'] = cur_index['z_ix'].astype(np.int64) * h * w * MASK_DTYPE.itemsize
+            cur_index['h'] = h
+            cur_index['w'] = w
+            index_parts.append(cur_index)
+
+        index = np.concatenate(index_parts) if index_parts else np.zeros(0, dtype=PACKED_INDEX_DTYPE)
+
+        os.makedirs(paths.packed_dp, exist_ok=True)
+        utils.store_npy(paths.index_fp, index)
+        with open(paths.volumes_fp, 'w') as fout:
+            json.dump(volumes, fout, indent=2)
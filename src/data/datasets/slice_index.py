@@ -0,0 +1,122 @@
+from typing import List
+
+import numpy as np
+
+# single row of slice index: volume index in volumes table, slice z-index,
+# number of augmented copies of the slice and bit flags (see SLICE_FLAG_*)
+SLICE_INDEX_DTYPE = np.dtype([
+    ('vol_ix', np.int32),
+    ('z_ix', np.int32),
+    ('n_augs', np.int16),
+    ('flags', np.uint8)
+])
+
+# slice belongs to the image that is heavily augmented
+SLICE_FLAG_HEAVY_AUGS = 1
+
+
+class SliceIndex:
+    """
+    Compact index of dataset samples.
+
+    Each volume is described only once in the volumes table (list of dicts with 'id' key
+    and any other per-volume info such as file paths). Each slice is a row of structured array
+    (see `SLICE_INDEX_DTYPE`) that refers to the volumes table by integer index.
+
+    Slice with `n_augs` augmentations yields `1 + n_augs` consecutive samples:
+    the raw slice followed by `n_augs` augmented copies. Augmented copies are not stored,
+    sample index is mapped to slice row with binary search over cumulative number of samples.
+    """
+
+    def __init__(self, volumes: List[dict], vol_ixs: np.ndarray, z_ixs: np.ndarray):
+        """
+        :param volumes: volumes table. each item is a dict with at least 'id' key
+        :param vol_ixs: index in `volumes` for each slice
+        :param z_ixs: z-index for each slice
+        """
+        if len(vol_ixs) != len(z_ixs):
+            raise ValueError(f'vol_ixs and z_ixs lengths differ: {len(vol_ixs)} != {len(z_ixs)}')
+
+        self._volumes = volumes
+        self._slices = np.zeros(len(vol_ixs), dtype=SLICE_INDEX_DTYPE)
+        self._slices['vol_ix'] = vol_ixs
+        self._slices['z_ix'] = z_ixs
+        self._update_samples_ends()
+
+    @staticmethod
+    def from_n_slices(volumes: List[dict], n_slices: List[int]):
+        """
+        Create index with all the slices of each volume in the volumes table.
+
+        :param n_slices: number of slices (size along z-axis) of each volume
+        """
+        n_slices = np.asarray(n_slices, dtype=np.int64)
+        vol_ixs = np.repeat(np.arange(len(volumes)), n_slices)
+        z_ixs = np.concatenate([np.arange(n) for n in n_slices]) if len(n_slices) else np.zeros(0)
+        return SliceIndex(volumes, vol_ixs, z_ixs)
+
+    def __str__(self):
+        return (f'SliceIndex('
+                f'volumes: {len(self._volumes)}; '
+                f'slices: {len(self._slices)}; '
+                f'samples: {len(self)})')
+
+    def __len__(self):
+        return int(self._samples_ends[-1]) if len(self._slices) > 0 else 0
+
+    @property
+    def volumes(self) -> List[dict]:
+        return self._volumes
+
+    @property
+    def slices(self) -> np.ndarray:
+        return self._slices
+
+    def locate(self, ix: int):
+        """
+        Map sample index to slice row.
+
+        :return: (slice row index, whether sample is augmented copy of the slice)
+        """
+        n_samples = len(self)
+        if ix < 0:
+            ix += n_samples
+        if not 0 <= ix < n_samples:
+            raise IndexError(f'sample index {ix} is out of range for index with {n_samples} samples')
+
+        row_ix = int(np.searchsorted(self._samples_ends, ix, side='right'))
+        row_start = self._samples_ends[row_ix] - 1 - self._slices['n_augs'][row_ix]
+        return row_ix, bool(ix > row_start)
+
+    def get_sample(self, ix: int):
+        """
+        :return: (volume dict, z-index, whether sample is augmented, slice row index)
+        """
+        row_ix, augment = self.locate(ix)
+        row = self._slices[row_ix]
+        return self._volumes[row['vol_ix']], int(row['z_ix']), augment, row_ix
+
+    def set_augs_cnt(self, n_augs: np.ndarray, flags: np.ndarray = None):
+        """
+        Set number of augmentations (and optionally flags) for each slice row.
+        """
+        self._slices['n_augs'] = n_augs
+        if flags is not None:
+            self._slices['flags'] = flags
+        self._update_samples_ends()
+
+    def get_samples_vol_ixs(self) -> np.ndarray:
+        """Get volume index for each sample"""
+        return self.repeat_for_samples(self._slices['vol_ix'])
+
+    def repeat_for_samples(self, slices_values: np.ndarray) -> np.ndarray:
+        """
+        Map per-slice values to samples: value of the slice is repeated for each of its samples.
+
+        :param slices_values: array with value for each slice row
+        """
+        return np.repeat(slices_values, 1 + self._slices['n_augs'].astype(np.int64))
+
+    def _update_samples_ends(self):
+        # exclusive end of each slice's range of samples
+        self._samples_ends = np.cumsum(1 + self._slices['n_augs'].astype(np.int64))
@@ -0,0 +1,270 @@
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import utils
+from data.augmentations import get_smoothed_field, FIELD_DTYPE
+
+
+class DisplacementFieldBank:
+    """
+    Pool of precomputed smoothed random displacement fields for elastic deformations
+    (see `augmentations.elastic_transform_fused` and `augmentations.set_displacement_bank`).
+
+    For each (slice shape, sigma) pair a pool of `pool_size` (dx, dy) fields of unit amplitude
+    is generated once in a background thread and stored to `.npy` file, which is then memory-mapped.
+    Until pool is ready `get_field` returns None and caller generates fields as usual.
+
+    Each draw applies random flips, dx/dy swap, roll and scaling to a random field of the pool
+    to keep augmentations diverse. Fields are smoothed with wrap mode, so rolls produce no seams.
+    Pool is regenerated in background after every `refresh_period` draws.
+
+    Data loader workers forked from the main process share pool files. Each pool is generated by a single
+    process at a time: the process that creates lock file of the pool generates it, the others
+    generate fields for each sample until pool file appears. On refresh a process picks up the pool
+    regenerated by another process if there is one, so the pool is regenerated about once
+    per `refresh_period` draws of any process instead of once per process.
+
+    Lock file holds hostname and pid of its owner. Lock is considered stale and is broken
+    if its owner on the same host is gone or the lock is older than `LOCK_TIMEOUT_SECONDS`.
+    Locks of live processes sharing the directory (e.g. concurrent runs) are kept.
+    """
+
+    LOCK_TIMEOUT_SECONDS = 30 * 60
+
+    def __init__(
+            self, bank_dp: str, pool_size: int = 64, refresh_period: int = None, scale_range: tuple = (0.8, 1.2)
+    ):
+        """
+        :param bank_dp: directory to store pools of fields to
+        :param pool_size: number of fields in pool for each slice shape
+        :param refresh_period: number of draws from pool after which pool is regenerated.
+        pool is never regenerated if None
+        :param scale_range: range of random factor to scale sampled field by
+        """
+        if pool_size < 1:
+            raise ValueError(f'pool_size must be >= 1. passed {pool_size}')
+        if refresh_period is not None and refresh_period < 1:
+            raise ValueError(f'refresh_period must be >= 1. passed {refresh_period}')
+
+        self._bank_dp = bank_dp
+        self._pool_size = pool_size
+        self._refresh_period = refresh_period
+        self._scale_range = scale_range
+
+        os.makedirs(bank_dp, exist_ok=True)
+        self._reset_state()
+
+    def __str__(self):
+        return (f'{utils.get_class_name(self)}('
+                f'bank_dp: {self._bank_dp}; '
+                f'pool_size: {self._pool_size}; '
+                f'refresh_period: {self._refresh_period}; '
+                f'scale_range: {self._scale_range})')
+
+    def _reset_state(self):
+        # memory-mapped pools of fields of shape (pool_size, 2, H, W)
+        self._pools = {}
+        # (inode, mtime) of pool files the pools are loaded from
+        self._pools_file_ids = {}
+        self._n_draws = defaultdict(int)
+        # keys of pools being generated
+        self._generating = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get_pool_fp(self, key: tuple) -> str:
+        h, w, sigma = key
+        return os.path.join(self._bank_dp, f'fields_{h}x{w}_sigma{sigma:.2f}_n{self._pool_size}.npy')
+
+    def _get_lock_fp(self, key: tuple) -> str:
+        return f'{self.get_pool_fp(key)}.lock'
+
+    @staticmethod
+    def _get_lock_owner() -> str:
+        return f'{socket.gethostname()} {os.getpid()}'
+
+    def _acquire_lock(self, key: tuple) -> bool:
+        """
+        Create lock file of the pool. Stale lock (see `_is_lock_stale`) is broken.
+
+        :return: whether the lock is acquired
+        """
+        lock_fp = self._get_lock_fp(key)
+        for _ in range(2):
+            try:
+                fd = os.open(lock_fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._is_lock_stale(lock_fp):
+                    return False
+                print(f'{utils.get_class_name(self)}: breaking stale lock "{lock_fp}"')
+                self._remove_lock(lock_fp, owner=None)
+                continue
+            with os.fdopen(fd, 'w') as fout:
+                fout.write(self._get_lock_owner())
+            return True
+        return False
+
+    def _is_lock_stale(self, lock_fp: str) -> bool:
+        try:
+            mtime = os.stat(lock_fp).st_mtime
+            with open(lock_fp) as fin:
+                owner = fin.read().split()
+        except FileNotFoundError:
+            return False
+
+        if time.time() - mtime > DisplacementFieldBank.LOCK_TIMEOUT_SECONDS:
+            return True
+        if len(owner) != 2 or owner[0] != socket.gethostname():
+            # lock is being written or is owned by process on another host
+            return False
+        try:
+            os.kill(int(owner[1]), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # process exists, but is owned by another user
+            pass
+        return False
+
+    @staticmethod
+    def _remove_lock(lock_fp: str, owner: str = None):
+        """
+        :param owner: remove lock only if it's owned by `owner`. lock is removed regardless of its owner if None
+        """
+        try:
+            if owner is not None:
+                with open(lock_fp) as fin:
+                    if fin.read() != owner:
+                        # own lock was broken as stale and was taken by another process
+                        return
+            os.remove(lock_fp)
+        except FileNotFoundError:
+            pass
+
+    def _release_lock(self, key: tuple):
+        self._remove_lock(self._get_lock_fp(key), owner=self._get_lock_owner())
+
+    @staticmethod
+    def _get_file_id(fp: str):
+        try:
+            stat = os.stat(fp)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def get_field(self, shape: tuple, sigma: float, random_state: np.random.RandomState):
+        """
+        Draw random displacement field from the pool.
+
+        :param shape: (H, W) shape of the field
+        :param sigma: std of gaussian filter used to smooth the field
+        :return: np.ndarray of shape (2, H, W) with (dx, dy) fields of unit amplitude
+        or None if pool for the shape is not ready yet
+        """
+        if self._pid != os.getpid():
+            # forked worker process inherited state of the parent, but not its generating threads
+            self._reset_state()
+
+        key = (int(shape[0]), int(shape[1]), round(float(sigma), 2))
+        pool = self._get_pool(key)
+        if pool is None:
+            return None
+
+        self._n_draws[key] += 1
+        if self._refresh_period is not None and self._n_draws[key] % self._refresh_period == 0:
+            self._refresh_pool(key)
+
+        field = pool[random_state.randint(len(pool))]
+        if random_state.rand() < 0.5:
+            field = field[:, ::-1]
+        if random_state.rand() < 0.5:
+            field = field[:, :, ::-1]
+        if random_state.rand() < 0.5:
+            field = field[::-1]
+        field = np.roll(field, (random_state.randint(key[0]), random_state.randint(key[1])), axis=(1, 2))
+        return field * random_state.uniform(*self._scale_range)
+
+    def _get_pool(self, key: tuple):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None:
+                return pool
+
+            # pool generated by this process is used only after its lock is released
+            if key not in self._generating and os.path.isfile(self.get_pool_fp(key)):
+                return self._load_pool(key)
+
+        self._start_generation(key, seen_file_id=None)
+        return None
+
+    def _load_pool(self, key: tuple):
+        # must be called under `self._lock`
+        fp = self.get_pool_fp(key)
+        file_id = self._get_file_id(fp)
+        pool = np.load(fp, mmap_mode='r')
+        self._pools[key] = pool
+        self._pools_file_ids[key] = file_id
+        return pool
+
+    def _refresh_pool(self, key: tuple):
+        with self._lock:
+            file_id = self._get_file_id(self.get_pool_fp(key))
+            if file_id != self._pools_file_ids.get(key):
+                # pool was regenerated by another process
+                self._load_pool(key)
+                return
+        self._start_generation(key, seen_file_id=file_id)
+
+    def _start_generation(self, key: tuple, seen_file_id):
+        """
+        :param seen_file_id: id of pool file (see `_get_file_id`) the need to generate pool was decided on.
+        pool is not generated if another process has written the file since then
+        """
+        with self._lock:
+            if key in self._generating:
+                return
+            # pool is being generated by another process if lock is not acquired
+            if not self._acquire_lock(key):
+                return
+            if self._get_file_id(self.get_pool_fp(key)) != seen_file_id:
+                # pool was written by another process that has already released the lock
+                self._release_lock(key)
+                return
+            self._generating.add(key)
+
+        thread = threading.Thread(target=self._generate_pool, args=(key,), daemon=True)
+        thread.start()
+
+    def _generate_pool(self, key: tuple):
+        h, w, sigma = key
+        fp = self.get_pool_fp(key)
+        random_state = np.random.RandomState(None)
+
+        def write_pool(fout):
+            # write fields one by one to avoid holding the whole pool in memory
+            header = {
+                'descr': np.lib.format.dtype_to_descr(FIELD_DTYPE),
+                'fortran_order': False,
+                'shape': (self._pool_size, 2, h, w)
+            }
+            np.lib.format.write_array_header_1_0(fout, header)
+            for _ in range(self._pool_size * 2):
+                fout.write(get_smoothed_field((h, w), sigma, random_state, mode='wrap').tobytes())
+
+        try:
+            utils.write_file_atomically(fp, write_pool)
+        finally:
+            try:
+                self._release_lock(key)
+            finally:
+                with self._lock:
+                    self._generating.discard(key)
+        # lock is released before the pool is drawn from by this process,
+        # so the lock is not left behind if the process exits right after
+        with self._lock:
+            self._load_pool(key)
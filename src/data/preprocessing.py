@@ -42,21 +42,31 @@ def zoom_slice(matrix, zoom_factor: float = None) -> np.ndarray:
     return res
 
 
+def get_nearest_neighbor_indices(src_size: int, dst_size: int) -> np.ndarray:
+    """
+    Get source indices for each destination index of nearest-neighbor resize.
+    Matches `cv2.INTER_NEAREST` rounding: src_ix = min(floor(dst_ix * src_size / dst_size), src_size - 1).
+    """
+    scale = 1. / (dst_size / src_size)
+    ixs = np.floor(np.arange(dst_size) * scale).astype(np.int64)
+    return np.minimum(ixs, src_size - 1)
+
+
 def zoom_volume_along_x_y(volume: np.ndarray, zoom_factor: float = None) -> np.ndarray:
     """
-    zoom 3D np.ndarray along X and Y axes
+    zoom 3D np.ndarray along X and Y axes with nearest-neighbor interpolation.
+    the whole volume is resampled with a single gather instead of resizing each slice separately.
+    results are the same as of `zoom_slice` applied to each slice.
     """
     if zoom_factor is None or zoom_factor == 1:
         return volume
 
-    res = []
-    for z in range(volume.shape[2]):
-        cur_slice = volume[:, :, z]
-        cur_slice = zoom_slice(cur_slice, zoom_factor)
-        res.append(cur_slice)
-    res = np.stack(res, axis=2)
+    h, w = volume.shape[:2]
+    rows_ixs = get_nearest_neighbor_indices(h, math.floor(h * zoom_factor))
+    cols_ixs = get_nearest_neighbor_indices(w, math.floor(w * zoom_factor))
 
-    return res
+    res = volume[np.ix_(rows_ixs, cols_ixs)]
+    return np.ascontiguousarray(res)
 
 
 def clip_intensities(
@@ -73,60 +83,164 @@ def threshold_mask(source_mask: np.ndarray, thresh=const.MASK_BINARIZATION_THRES
     return res
 
 
-def segment_body_from_scan(volume):
+def get_body_mask(volume: np.ndarray) -> np.ndarray:
     """
-    calculates body mask and removes table with background from the scan.
+    calculate binary mask of the body (largest connected component without table and background).
 
     written by Eduard Sniazko.
 
-    :param volume: 3D matrix
+    :param volume: 3D scan of shape (H, W, Z)
+    :return: np.uint8 mask of the same shape
     """
-
-    # def calc_ct_body_mask(src_filename_, dst_filename_):
-    #     if not os.path.isfile(src_filename_):
-    #         print('File {} not exists'.format(src_filename_))
-    #         return None
-    #     img_ = nib.load(src_filename_)
-    #     img_affine_ = img_.affine
-    #     img_vol_ = img_.get_data()
-
-    img_vol_ = volume.copy()
-    res_img_vol_ = np.zeros(img_vol_.shape, np.uint8)
-    res_img_vol_[img_vol_[:] > -700] = 1
+    res_img_vol_ = np.zeros(volume.shape, np.uint8)
+    res_img_vol_[volume > -700] = 1
 
     res_img_vol_ = morph.binary_erosion(res_img_vol_, iterations=3)
-    # res_img_vol_[:, :, 0] = 1
-    # res_img_vol_[:, :, res_img_vol_.shape[2] - 1] = 1
 
     for zz in range(res_img_vol_.shape[2]):
         res_img_vol_[:, :, zz] = morph.binary_fill_holes(res_img_vol_[:, :, zz])
-    # res_img_vol_[:, :, 0] = 0
-    # res_img_vol_[:, :, res_img_vol_.shape[2] - 1] = 0
 
+    # leave the largest connected component. label 0 is background
     labeled_array, num_features = label(res_img_vol_)
-    max_lbl_cnt = 0
-    max_lbl_idx = -1
-    if num_features > 0:
-        for idx in range(num_features):
-            cur_cnt = np.sum(labeled_array[:] == idx)
-            if num_features == 1:
-                max_lbl_idx = 1
-                max_lbl_cnt = cur_cnt
-            else:
-                if cur_cnt > max_lbl_cnt and np.sum(res_img_vol_[labeled_array[:] == idx]) > 0:
-                    max_lbl_cnt = cur_cnt
-                    max_lbl_idx = idx
-    res_img_vol_[labeled_array[:] != max_lbl_idx] = 0
-    res_img_vol_[labeled_array[:] == max_lbl_idx] = 1
-
-    res_img_vol_ = res_img_vol_.astype(np.uint8)
-    img_vol_[res_img_vol_[:] == 0] = -4_000
+    if num_features == 0:
+        return np.zeros(volume.shape, np.uint8)
+    labels_cnt = np.bincount(labeled_array.ravel())
+    labels_cnt[0] = 0
+    max_lbl_idx = np.argmax(labels_cnt)
+
+    return (labeled_array == max_lbl_idx).astype(np.uint8)
+
+
+def segment_body_from_scan(volume):
+    """
+    calculates body mask and removes table with background from the scan.
 
-    #     if img_affine_[0][0] < 0:
-    #         img_vol_ = np.flip(img_vol_, axis=0)
-    #         img_affine_[0][0] = -img_affine_[0][0]
-    #     img_vol_ = img_vol_.astype(np.int16)
-    #     dst_img_ = nib.Nifti1Image(img_vol_, img_affine_)
-    #     nib.save(dst_img_, dst_filename_)
+    written by Eduard Sniazko.
 
+    :param volume: 3D matrix
+    """
+    img_vol_ = volume.copy()
+    res_img_vol_ = get_body_mask(volume)
+    img_vol_[res_img_vol_[:] == 0] = -4_000
     return img_vol_
+
+
+def get_body_bbox(body_mask: np.ndarray, margin: int = const.BODY_CROP_MARGIN) -> tuple:
+    """
+    calculate bounding box of the body along X and Y axes over all the slices of the volume.
+
+    :param body_mask: binary mask of shape (H, W, Z) (see `get_body_mask`)
+    :param margin: number of pixels to extend bounding box by on each side
+    :return: (row_start, row_end, col_start, col_end) with exclusive ends.
+    bounding box of the whole slice is returned if mask is empty
+    """
+    h, w = body_mask.shape[:2]
+    rows = np.flatnonzero(np.any(body_mask, axis=(1, 2)))
+    cols = np.flatnonzero(np.any(body_mask, axis=(0, 2)))
+    if len(rows) == 0 or len(cols) == 0:
+        return 0, h, 0, w
+
+    return (
+        max(int(rows[0]) - margin, 0), min(int(rows[-1]) + 1 + margin, h),
+        max(int(cols[0]) - margin, 0), min(int(cols[-1]) + 1 + margin, w)
+    )
+
+
+def pack_mask_bits(mask: np.ndarray, axis: int = -1) -> np.ndarray:
+    """
+    pack binary mask into bits along `axis` (8 pixels per byte). see `unpack_mask_bits`.
+    for volumes of shape (H, W, Z) pack along W axis (axis=1), so that each slice is packed along its rows.
+    """
+    return np.packbits(mask != 0, axis=axis)
+
+
+def unpack_mask_bits(packed: np.ndarray, size: int, axis: int = -1) -> np.ndarray:
+    """
+    unpack mask packed with `pack_mask_bits`. works for single slices, volumes and whole batches at once.
+
+    :param size: size of the mask along `axis` before packing
+    :return: np.uint8 mask with {0, 1} values
+    """
+    return np.unpackbits(packed, axis=axis, count=size)
+
+
+def get_slices_stats(mask: np.ndarray, body_mask: np.ndarray) -> dict:
+    """
+    calculate per-slice statistics of the volume.
+
+    :param mask: binary lungs mask of shape (H, W, Z)
+    :param body_mask: binary body mask of the same shape (see `get_body_mask`)
+    :return: dict with number of lungs and body pixels on each slice
+    and [start, end) z-range of slices with lungs (None if there are no lungs)
+    """
+    lungs_pixels = np.count_nonzero(mask, axis=(0, 1))
+    body_pixels = np.count_nonzero(body_mask, axis=(0, 1))
+    z_ixs = np.flatnonzero(lungs_pixels)
+    lungs_z_range = [int(z_ixs[0]), int(z_ixs[-1]) + 1] if len(z_ixs) > 0 else None
+    return {
+        'lungs_pixels': lungs_pixels.tolist(),
+        'body_pixels': body_pixels.tolist(),
+        'lungs_z_range': lungs_z_range
+    }
+
+
+def crop_volume_along_x_y(volume: np.ndarray, bbox: tuple) -> np.ndarray:
+    """crop 3D np.ndarray along X and Y axes with (row_start, row_end, col_start, col_end) bounding box"""
+    row_start, row_end, col_start, col_end = bbox
+    return np.ascontiguousarray(volume[row_start:row_end, col_start:col_end])
+
+
+def paste_volume_along_x_y(cropped: np.ndarray, bbox: tuple, shape: tuple, fill_value=0) -> np.ndarray:
+    """
+    paste cropped 3D np.ndarray back to array of full `shape`. inverse of `crop_volume_along_x_y`
+    """
+    row_start, row_end, col_start, col_end = bbox
+    res = np.full(shape, fill_value, dtype=cropped.dtype)
+    res[row_start:row_end, col_start:col_end] = cropped
+    return res
+
+
+def get_padded_shape(shapes, multiple_of: int = const.PAD_MULTIPLE) -> tuple:
+    """
+    get the smallest (H, W) shape that fits all 2D `shapes` and is divisible by `multiple_of`
+    """
+    h = max(s[0] for s in shapes)
+    w = max(s[1] for s in shapes)
+    return math.ceil(h / multiple_of) * multiple_of, math.ceil(w / multiple_of) * multiple_of
+
+
+def copy_slices_with_padding(scans, masks, scans_out: np.ndarray, masks_out: np.ndarray):
+    """
+    copy 2D slices to top-left corner of (N, H, W) output arrays. the rest of the output arrays
+    is filled with air intensity for scans and with zeros for masks.
+    """
+    h, w = scans_out.shape[1:]
+    for i, (s, m) in enumerate(zip(scans, masks)):
+        sh, sw = s.shape
+        scans_out[i, :sh, :sw] = s
+        masks_out[i, :sh, :sw] = m
+        if (sh, sw) != (h, w):
+            scans_out[i, sh:] = const.BODY_THRESH_LOW
+            scans_out[i, :sh, sw:] = const.BODY_THRESH_LOW
+            masks_out[i, sh:] = 0
+            masks_out[i, :sh, sw:] = 0
+
+
+def pad_slices(scans, masks, multiple_of: int = const.PAD_MULTIPLE):
+    """
+    pad 2D slices to common shape divisible by `multiple_of` (see `copy_slices_with_padding`).
+    slices are returned as is if they already have such shape.
+
+    :return: (scans, masks) as lists or (N, H, W) np.ndarrays
+    """
+    if len(scans) == 0:
+        return scans, masks
+
+    shape = get_padded_shape([s.shape for s in scans], multiple_of)
+    if all(s.shape == shape for s in scans):
+        return scans, masks
+
+    scans_out = np.empty((len(scans), *shape), dtype=scans[0].dtype)
+    masks_out = np.empty((len(masks), *shape), dtype=masks[0].dtype)
+    copy_slices_with_padding(scans, masks, scans_out, masks_out)
+    return scans_out, masks_out
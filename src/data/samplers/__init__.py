@@ -0,0 +1,3 @@
+from .base_sampler import BaseSampler
+from .foreground_sampler import ForegroundSampler
+from .volume_locality_sampler import VolumeLocalitySampler
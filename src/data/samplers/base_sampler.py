@@ -0,0 +1,19 @@
+import numpy as np
+
+from data.datasets import BaseDataset
+
+
+class BaseSampler:
+    """
+    Base class for samplers that define the order of dataset samples within an epoch.
+    Data loaders use sampler instead of global shuffle of sample indices.
+    """
+
+    def get_n_samples(self, dataset: BaseDataset) -> int:
+        """
+        Get number of samples yielded on each epoch. Samplers that subsample the dataset override it.
+        """
+        return len(dataset)
+
+    def get_indices(self, dataset: BaseDataset) -> np.ndarray:
+        raise NotImplementedError
@@ -0,0 +1,56 @@
+import numpy as np
+
+import utils
+from data.datasets import BaseDataset
+from .base_sampler import BaseSampler
+
+
+class ForegroundSampler(BaseSampler):
+    """
+    Sampler that subsamples samples of empty slices (slices without lungs).
+
+    All the samples of slices with lungs are yielded on each epoch, while only `empty_ratio` share
+    of samples of empty slices is yielded. Empty samples are chosen randomly on each epoch,
+    so all of them are seen during training but they cost less forward/backward passes.
+    Requires slices stats to be loaded to the dataset (see `BaseDataset.load_slices_stats`).
+
+    Order of samples is defined by wrapped `sampler` (global shuffle if None),
+    subsampling keeps this order, so `ForegroundSampler` can be combined with `VolumeLocalitySampler`.
+    """
+
+    def __init__(self, empty_ratio: float, sampler: BaseSampler = None):
+        """
+        :param empty_ratio: share of empty samples to yield on each epoch. value in [0, 1]
+        :param sampler: sampler that defines order of samples
+        """
+        if not 0 <= empty_ratio <= 1:
+            raise ValueError(f'empty_ratio must be in [0, 1]. passed {empty_ratio}')
+        self._empty_ratio = empty_ratio
+        self._sampler = sampler
+
+    def __str__(self):
+        return f'{utils.get_class_name(self)}(empty_ratio: {self._empty_ratio}; sampler: {self._sampler})'
+
+    def get_n_samples(self, dataset: BaseDataset) -> int:
+        is_empty = dataset.get_samples_lungs_pixels() == 0
+        n_empty = int(is_empty.sum())
+        return len(is_empty) - n_empty + self._get_n_empty_to_keep(n_empty)
+
+    def get_indices(self, dataset: BaseDataset) -> np.ndarray:
+        if self._sampler is not None:
+            indices = self._sampler.get_indices(dataset)
+        else:
+            indices = np.random.permutation(len(dataset))
+
+        is_empty = dataset.get_samples_lungs_pixels()[indices] == 0
+        empty_positions = np.flatnonzero(is_empty)
+        keep_positions = np.random.choice(
+            empty_positions, self._get_n_empty_to_keep(len(empty_positions)), replace=False
+        )
+
+        keep = ~is_empty
+        keep[keep_positions] = True
+        return indices[keep]
+
+    def _get_n_empty_to_keep(self, n_empty: int) -> int:
+        return int(round(n_empty * self._empty_ratio))
@@ -0,0 +1,43 @@
+import numpy as np
+
+import utils
+from data.datasets import BaseDataset
+from .base_sampler import BaseSampler
+
+
+class VolumeLocalitySampler(BaseSampler):
+    """
+    Sampler that shuffles volumes and then shuffles slices within windows of `window_volumes` volumes.
+
+    Consecutive samples come from a small set of resident volumes, so volume-level caches
+    of datasets hit most of the time. `window_volumes` controls locality / randomness trade-off:
+    with 1 volumes are yielded one by one, with number of volumes >= `dataset.n_images`
+    sampler is equivalent to the global shuffle.
+    """
+
+    def __init__(self, window_volumes: int):
+        if window_volumes < 1:
+            raise ValueError(f'window_volumes must be >= 1. passed {window_volumes}')
+        self._window_volumes = window_volumes
+
+    def __str__(self):
+        return f'{utils.get_class_name(self)}(window_volumes: {self._window_volumes})'
+
+    def get_indices(self, dataset: BaseDataset) -> np.ndarray:
+        volume_ixs = dataset.get_samples_volume_ixs()
+        n_volumes = volume_ixs.max() + 1 if volume_ixs.size > 0 else 0
+
+        # group sample indices by volume
+        order = np.argsort(volume_ixs, kind='stable')
+        bounds = np.searchsorted(volume_ixs[order], np.arange(n_volumes + 1))
+        samples_by_volume = [order[bounds[v]: bounds[v + 1]] for v in range(n_volumes)]
+
+        volumes_order = np.random.permutation(n_volumes)
+        indices = []
+        for a in range(0, n_volumes, self._window_volumes):
+            window = np.concatenate([samples_by_volume[v] for v in volumes_order[a: a + self._window_volumes]])
+            np.random.shuffle(window)
+            indices.append(window)
+
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        return indices
@@ -0,0 +1,236 @@
+import os
+import pickle
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+import const
+import utils
+
+
+def _copy_to_host(obj, pin_memory: bool):
+    if torch.is_tensor(obj):
+        copy = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=pin_memory)
+        copy.copy_(obj.detach(), non_blocking=pin_memory)
+        return copy
+    if isinstance(obj, dict):
+        return {k: _copy_to_host(v, pin_memory) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_host(v, pin_memory) for v in obj)
+    return obj
+
+
+def snapshot_state_dict(state_dict: dict, pin_memory: bool = False) -> dict:
+    """
+    Copy tensors of state dict to host memory, so the copy is not changed by further training
+    and doesn't occupy memory of the training device.
+    Nested dicts and lists (e.g. optimizer state dict) are copied as well.
+
+    :param pin_memory: whether to copy tensors to pinned memory. speeds up copies from cuda devices
+    """
+    pin_memory = pin_memory and torch.cuda.is_available()
+    snapshot = _copy_to_host(state_dict, pin_memory)
+    if pin_memory:
+        # non-blocking copies must complete before the snapshot is used
+        torch.cuda.synchronize()
+    return snapshot
+
+
+def get_rng_states() -> dict:
+    """Get states of python, numpy and torch global random generators."""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    }
+
+
+def set_rng_states(states: dict):
+    """Restore states of global random generators stored with `get_rng_states`."""
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if states['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def get_training_state_fp(checkpoints_dp: str) -> str:
+    return os.path.join(checkpoints_dp, const.TRAINING_STATE_FN)
+
+
+def load_training_state(checkpoints_dp: str) -> dict:
+    """
+    Load training state stored with `CheckpointWriter.save_state`.
+    """
+    fp = get_training_state_fp(checkpoints_dp)
+    if not os.path.isfile(fp):
+        raise FileNotFoundError(f'no training state found at "{fp}"')
+    with open(fp, 'rb') as fin:
+        return pickle.load(fin)
+
+
+class CheckpointWriter:
+    """
+    Writes model checkpoints from a background thread, so the training loop doesn't wait for disk.
+
+    Weights are snapshot to host memory on the training thread (see `snapshot_state_dict`)
+    and are written in the order of `save_*` calls. Training state saved with `save_state`
+    is thus always written after the epoch checkpoints it refers to. Every file is written to a temporary file
+    and renamed, so readers never see partially written checkpoints.
+
+    Retention policy: epoch checkpoints are kept if any of the rules holds:
+    the epoch is among the last `keep_last` saved ones, the epoch number is divisible by `keep_every`
+    or the epoch is the best one (see `set_best_epoch`). All epoch checkpoints are kept if no rule is set.
+    """
+
+    def __init__(
+            self, checkpoints_dp: str, loss_name: str,
+            keep_last: int = None, keep_every: int = None, pin_memory: bool = False
+    ):
+        """
+        :param checkpoints_dp: directory to store checkpoints to
+        :param loss_name: loss name to use in checkpoints filenames
+        :param keep_last: number of last epoch checkpoints to keep
+        :param keep_every: keep checkpoints of every `keep_every`-th epoch
+        :param pin_memory: whether to snapshot weights to pinned memory
+        """
+        for name, value in [('keep_last', keep_last), ('keep_every', keep_every)]:
+            if value is not None and value < 1:
+                raise ValueError(f'{name} must be >= 1. passed {value}')
+
+        self._checkpoints_dp = checkpoints_dp
+        self._loss_name = loss_name
+        self._keep_last = keep_last
+        self._keep_every = keep_every
+        self._pin_memory = pin_memory
+
+        # epochs with checkpoints on disk in the order of saving
+        self._saved_epochs = []
+        self._best_epoch_ix = None
+
+        self._error = None
+        self._tasks = queue.Queue()
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+
+    def __str__(self):
+        return (f'{utils.get_class_name(self)}('
+                f'checkpoints_dp: {self._checkpoints_dp}; '
+                f'keep_last: {self._keep_last}; '
+                f'keep_every: {self._keep_every}; '
+                f'pin_memory: {self._pin_memory})')
+
+    def get_epoch_fp(self, epoch_ix: int) -> str:
+        return os.path.join(self._checkpoints_dp, f'cp_{self._loss_name}_epoch_{epoch_ix:02}.pth')
+
+    def get_best_fp(self) -> str:
+        return os.path.join(self._checkpoints_dp, f'cp_{self._loss_name}_best.pth')
+
+    def snapshot(self, state_dict: dict) -> dict:
+        return snapshot_state_dict(state_dict, self._pin_memory)
+
+    def save_epoch(self, epoch_ix: int, snapshot: dict):
+        """
+        Write checkpoint of the epoch and remove checkpoints that are not kept by retention policy.
+
+        :param snapshot: state dict copied to host memory with `snapshot`
+        """
+        self._put(('epoch', epoch_ix, snapshot))
+
+    def save_best(self, snapshot: dict):
+        self._put(('best', None, snapshot))
+
+    def save_state(self, snapshot: dict):
+        """
+        Overwrite full training state used to resume training (see `load_training_state`).
+        State is pickled as it holds numpy arrays and python objects besides tensors.
+
+        :param snapshot: training state copied to host memory with `snapshot`
+        """
+        self._put(('state', None, snapshot))
+
+    def resume(self, last_epoch_ix: int, best_epoch_ix: int):
+        """
+        Take into account checkpoints of epochs up to `last_epoch_ix` written by the interrupted run,
+        so they are subject to retention policy.
+        """
+        self._put(('resume', last_epoch_ix, best_epoch_ix))
+
+    def set_best_epoch(self, epoch_ix: int):
+        """Keep checkpoint of the best epoch regardless of the other retention rules."""
+        self._put(('set_best', epoch_ix, None))
+
+    def wait(self):
+        """Block until all the submitted checkpoints are written."""
+        self._tasks.join()
+        self._raise_if_failed()
+
+    def close(self):
+        self.wait()
+        self._tasks.put(None)
+        self._thread.join()
+
+    def _put(self, task):
+        self._raise_if_failed()
+        self._tasks.put(task)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError('checkpoint writer failed') from self._error
+
+    def _writer_loop(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                self._tasks.task_done()
+                break
+            try:
+                kind, epoch_ix, payload = task
+                if kind == 'epoch':
+                    self._write(self.get_epoch_fp(epoch_ix), payload)
+                    self._saved_epochs.append(epoch_ix)
+                    self._apply_retention()
+                elif kind == 'best':
+                    self._write(self.get_best_fp(), payload)
+                elif kind == 'set_best':
+                    self._best_epoch_ix = epoch_ix
+                    self._apply_retention()
+                elif kind == 'state':
+                    utils.write_file_atomically(
+                        get_training_state_fp(self._checkpoints_dp), lambda fout: pickle.dump(payload, fout)
+                    )
+                elif kind == 'resume':
+                    self._saved_epochs = [
+                        ix for ix in range(1, epoch_ix + 1) if os.path.isfile(self.get_epoch_fp(ix))
+                    ]
+                    self._best_epoch_ix = payload
+                    self._apply_retention()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._tasks.task_done()
+
+    @staticmethod
+    def _write(fp: str, snapshot: dict):
+        utils.write_file_atomically(fp, lambda fout: torch.save(snapshot, fout))
+
+    def _is_kept(self, epoch_ix: int) -> bool:
+        if self._keep_last is None and self._keep_every is None:
+            return True
+        if epoch_ix == self._best_epoch_ix:
+            return True
+        if self._keep_last is not None and epoch_ix in self._saved_epochs[-self._keep_last:]:
+            return True
+        return self._keep_every is not None and epoch_ix % self._keep_every == 0
+
+    def _apply_retention(self):
+        to_remove = [ix for ix in self._saved_epochs if not self._is_kept(ix)]
+        for epoch_ix in to_remove:
+            fp = self.get_epoch_fp(epoch_ix)
+            if os.path.isfile(fp):
+                os.remove(fp)
+            self._saved_epochs.remove(epoch_ix)
@@ -30,10 +30,11 @@ class LRFinder:
             self, net: nn.Module,
             loss_func: nn.Module, optimizer: Optimizer, train_loader: BaseDataLoader,
             lr_min: float = 1e-8, lr_max: float = 5e1, beta=0.97,
-            device: torch.device = torch.device('cuda:0')
+            device: torch.device = torch.device('cuda:0'), precision: str = 'fp32'
     ):
         """
         :param beta: smoothing factor for exponentially weighted window
+        :param precision: precision to run the net in (see `model.utils.PRECISIONS`)
         """
         self.net = net
         self.loss_func = loss_func
@@ -49,6 +50,8 @@ class LRFinder:
 
         self.beta = beta
         self.device = device
+        self.precision = precision
+        self.scaler = mu.create_grad_scaler(precision, device)
 
         self.lrs = None
         self.losses = None
@@ -63,6 +66,7 @@ class LRFinder:
             f'lr_min: {self.lr_min : .3e}\n'
             f'lr_max: {self.lr_max : .3e}\n'
             f'batches: {self.n_batches}\n'
+            f'precision: {self.precision}\n'
             f'q: {self.q : e}\n'
         )
         print(f'\ntrain_loader:\n{self.train_loader}\n')
@@ -86,7 +90,8 @@ class LRFinder:
 
                 batch_stats = mu.loss_batch(
                     net=self.net, x_batch=xb, y_batch=yb, loss_func=self.loss_func,
-                    metrics=[], device=self.device, optimizer=self.optimizer
+                    metrics=[], device=self.device, optimizer=self.optimizer,
+                    precision=self.precision, scaler=self.scaler
                 )
                 loss_value = batch_stats[self.loss_name]
 
@@ -139,9 +144,25 @@ class LRFinder:
 
         print(const.SEPARATOR)
         print(f'LRFinder.store_results: storing results under "{out_dp}"')
-        self.results_df.to_csv(os.path.join(out_dp, 'lr_finder_results.csv'), index=False)
+        self.results_df.to_csv(os.path.join(out_dp, const.LR_FINDER_RESULTS_FN), index=False)
         self.plot_loss_values(self.results_df, os.path.join(out_dp, 'lr_finder_plots.png'))
 
+    @staticmethod
+    def suggest_max_lr(results_fp: str, divisor: float = 10) -> float:
+        """
+        Suggest max learning rate for 1-cycle policy from stored results:
+        learning rate with minimal smoothed loss divided by `divisor`,
+        so training stays away from the region where loss starts to explode.
+
+        :param results_fp: path to `.csv` file stored with `store_results`
+        """
+        df = pd.read_csv(results_fp)
+        df = df[np.isfinite(df['loss'])]
+        if len(df) == 0:
+            raise ValueError(f'no finite loss values in "{results_fp}"')
+        lr_min_loss = df['learning_rate'].iloc[df['loss'].values.argmin()]
+        return float(lr_min_loss / divisor)
+
     def plot_loss_values(self, df, out_fp: str = None):
         fig, ax = plt.subplots(1, 1, figsize=(15, 10), dpi=110)
 
@@ -0,0 +1,75 @@
+from typing import List
+
+import torch
+import torch.nn as nn
+
+import utils
+
+
+def compute_metrics(out: torch.Tensor, y: torch.Tensor, metrics: List[nn.Module]) -> torch.Tensor:
+    """
+    Compute values of `metrics` for a single batch and stack them into a single tensor on the device,
+    so they are added to running sums with no host sync per metric.
+
+    :param out: net outputs (sigmoid probabilities) of shape (N, 1, H, W)
+    :param y: targets of the same shape
+    :return: float tensor of shape (len(metrics),) on the device of `out`
+    """
+    values = [metric(out, y) for metric in metrics]
+    return torch.stack([v.float() for v in values]) if values else torch.zeros(0, device=out.device)
+
+
+class MetricsAccumulator:
+    """
+    Keeps running sums of loss and metrics on the device, so batches are processed
+    without waiting for the device to report values to the host (no `.item()` per batch and metric).
+    Values are copied to the host only by `get_stats`.
+    """
+
+    def __init__(self, loss_name: str, metrics: List[nn.Module], device: torch.device):
+        """
+        :param loss_name: name of the loss. loss values are passed to `add` as computed by the loss function
+        :param metrics: metrics to compute. metric with the same name as the loss is not computed again
+        """
+        self._metrics = [m for m in metrics if utils.get_class_name(m) != loss_name]
+        self._names = [loss_name] + [utils.get_class_name(m) for m in self._metrics]
+
+        self._sums = torch.zeros(len(self._names), dtype=torch.float64, device=device)
+        self._n_samples = 0
+
+    def add(self, out: torch.Tensor, y: torch.Tensor, loss: torch.Tensor):
+        """
+        Add loss and metrics of a single batch to running sums.
+        Values are multiplied by batch size to handle mean reduction.
+
+        :param loss: loss value computed for the batch
+        """
+        batch_size = out.shape[0]
+        with torch.no_grad():
+            values = torch.cat([loss.detach().float().view(1), compute_metrics(out.detach(), y, self._metrics)])
+            self._sums += values.double() * batch_size
+        self._n_samples += batch_size
+
+    @property
+    def n_samples(self) -> int:
+        return self._n_samples
+
+    def state_dict(self) -> dict:
+        """Running sums to resume accumulation from with `load_state_dict`."""
+        return {'names': self._names, 'sums': self._sums, 'n_samples': self._n_samples}
+
+    def load_state_dict(self, state: dict):
+        if state['names'] != self._names:
+            raise ValueError(f'accumulator state of {state["names"]} doesn\'t match accumulator of {self._names}')
+        self._sums.copy_(state['sums'])
+        self._n_samples = state['n_samples']
+
+    def get_stats(self, n_samples: int = None) -> dict:
+        """
+        Copy running sums to the host and average them.
+
+        :param n_samples: number of samples to average by. defaults to number of added samples
+        """
+        n_samples = n_samples or self._n_samples
+        sums = self._sums.cpu().tolist()
+        return {name: s / max(n_samples, 1) for name, s in zip(self._names, sums)}
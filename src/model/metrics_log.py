@@ -0,0 +1,156 @@
+import json
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
+from matplotlib import pyplot as plt
+
+import const
+import utils
+
+
+class MetricsLog:
+    """
+    Append-only log of a training run: one JSON record per line (see `const.METRICS_LOG_FN`).
+    Every record holds its `type` and wall-clock `time`:
+
+    * 'run' - written once train_valid starts (or resumes)
+    * 'batch' - timings of a single batch, learning rate of train batches and running loss and metrics
+      if they were copied from the device after the batch (see `model.utils.loss_epoch`)
+    * 'stage' - number of slices, timings and throughput of training or validation stage of the epoch
+    * 'epoch' - loss and metrics of the epoch, its learning rate and best-so-far tracking
+
+    Lines are flushed as they are written, so the log of interrupted run holds everything
+    up to the moment of interruption. Resumed runs append to the same log.
+    """
+
+    def __init__(self, out_dp: str):
+        """
+        :param out_dp: run directory to write the log to
+        """
+        self._fp = os.path.join(out_dp, const.METRICS_LOG_FN)
+        # line-buffered
+        self._fout = open(self._fp, 'a', buffering=1)
+
+    def __str__(self):
+        return f'{utils.get_class_name(self)}(fp: {self._fp})'
+
+    def log(self, record_type: str, **fields):
+        record = {'type': record_type, 'time': time.time(), **fields}
+        self._fout.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self._fout.close()
+
+
+def read_metrics_log(fp: str) -> list:
+    """
+    Read records of `MetricsLog`. Partially written last line of interrupted run is skipped.
+    """
+    records = []
+    with open(fp) as fin:
+        for line in fin:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def _get_last_records(records: list, record_type: str, key_fields: tuple) -> list:
+    """
+    Get records of `record_type` ordered by `key_fields`. Resumed runs repeat records
+    of batches and epochs processed after the last saved training state, the last of them are taken.
+    """
+    last = {}
+    for r in records:
+        if r['type'] == record_type:
+            last[tuple(r[k] for k in key_fields)] = r
+    return [last[k] for k in sorted(last)]
+
+
+def get_history_from_records(records: list) -> dict:
+    """
+    Build train history of the same structure as returned by `model.utils.train_valid` from log records.
+    """
+    run_records = [r for r in records if r['type'] == 'run']
+    if not run_records:
+        raise ValueError('no run records found in metrics log')
+    loss_name = run_records[-1]['loss_name']
+
+    metrics = defaultdict(lambda: {'train': [], 'valid': []})
+    epoch_records = _get_last_records(records, 'epoch', ('epoch',))
+    for r in epoch_records:
+        for m_name in r['train'].keys() & r['valid'].keys():
+            metrics[m_name]['train'].append(r['train'][m_name])
+            metrics[m_name]['valid'].append(r['valid'][m_name])
+
+    return {
+        'metrics': dict(metrics),
+        'loss_name': loss_name,
+        'best_loss_valid': epoch_records[-1]['best_loss_valid'] if epoch_records else float('inf'),
+        'best_epoch_ix': epoch_records[-1]['best_epoch_ix'] if epoch_records else -1,
+        'precision': run_records[-1]['precision']
+    }
+
+
+def build_batch_stats_plot(records: list, out_fp: str = None):
+    """
+    Plot learning rate and throughput of train batches and data loading share of train time
+    over the whole run.
+    """
+    batch_records = _get_last_records(
+        [r for r in records if r['type'] == 'batch' and r['stage'] == 'train'], 'batch', ('epoch', 'batch')
+    )
+    x = np.arange(1, len(batch_records) + 1)
+    lrs = [r['lr'] for r in batch_records]
+    batch_times = np.array([r['data_time'] + r['step_time'] for r in batch_records])
+    n_slices = np.array([r['n_slices'] for r in batch_records])
+    data_times = np.array([r['data_time'] for r in batch_records])
+
+    fig, ax = plt.subplots(1, 3, figsize=(18, 5), squeeze=False)
+    fig.suptitle(f'train batches: {len(batch_records)}')
+    for cur_ax, y, title in zip(
+            ax.flatten(),
+            [lrs, n_slices / np.maximum(batch_times, 1e-9), data_times / np.maximum(batch_times, 1e-9)],
+            ['learning rate', 'slices per second', 'share of time waiting for data']
+    ):
+        cur_ax.plot(x, y)
+        cur_ax.set_title(title)
+        cur_ax.set_xlabel('batch')
+        cur_ax.grid()
+
+    if out_fp is not None:
+        fig.savefig(out_fp, dpi=100)
+
+    return fig, ax
+
+
+def plot_run(run_dp: str):
+    """
+    Build learning curves and batch statistics plots of the run from its metrics log.
+    Can be called while the run is in progress.
+
+    :param run_dp: directory of the run (`out_dp` of `model.utils.train_valid`)
+    """
+    log_fp = os.path.join(run_dp, const.METRICS_LOG_FN)
+    print(const.SEPARATOR)
+    print(f'plot_run(): reading metrics log "{log_fp}"')
+
+    records = read_metrics_log(log_fp)
+    history = get_history_from_records(records)
+    n_epochs = len(list(history['metrics'].values())[0]['train']) if history['metrics'] else 0
+    print(f'records: {len(records)}\n'
+          f'finished epochs: {n_epochs}\n'
+          f'best loss valid: {history["best_loss_valid"] : .4f}\n'
+          f'best epoch: {history["best_epoch_ix"]}')
+
+    if n_epochs > 0:
+        fig, _ = utils.build_learning_curves(metrics=history['metrics'], loss_name=history['loss_name'], out_dp=run_dp)
+        plt.close(fig)
+
+    batch_stats_fp = os.path.join(run_dp, 'batch_stats.png')
+    fig, _ = build_batch_stats_plot(records, batch_stats_fp)
+    plt.close(fig)
+    print(f'plots are stored under "{run_dp}"')
@@ -1,4 +1,4 @@
-import copy
+import contextlib
 import os
 import pickle
 import time
@@ -12,13 +12,53 @@ from matplotlib import pyplot as plt
 # from skimage.segmentation import mark_boundaries
 # from skimage.util import img_as_float
 from sklearn.metrics import pairwise_distances
-from torch.optim.lr_scheduler import ReduceLROnPlateau
+from torch.optim.lr_scheduler import ReduceLROnPlateau, OneCycleLR
 from torch.optim.optimizer import Optimizer
 
 import const
 import utils
-from data.dataloaders import BaseDataLoader
-from utils import get_single_image_slice_gen
+from data import preprocessing
+from data.dataloaders import BaseDataLoader, BitPackedMasks
+from model.checkpoints import CheckpointWriter, get_rng_states, set_rng_states
+from model.metrics import MetricsAccumulator
+from model.metrics_log import MetricsLog
+
+
+# fp32 - train and infer in float32.
+# bf16 / fp16 - run the net under autocast to bfloat16 / float16. fp16 is supported only on cuda devices
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+_AUTOCAST_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def check_precision(precision: str, device: torch.device):
+    if precision not in PRECISIONS:
+        raise ValueError(f'`precision` should be in {PRECISIONS}. passed "{precision}"')
+    if precision == 'fp16' and device.type != 'cuda':
+        raise ValueError(f'fp16 precision is supported only on cuda devices. passed device: {device}')
+
+
+def get_autocast(precision: str, device: torch.device):
+    """
+    Get context manager to run forward pass of the net in.
+    Losses and metrics must be computed outside of it on float32 outputs (see `loss_batch`).
+    """
+    check_precision(precision, device)
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=_AUTOCAST_DTYPES[precision])
+
+
+def create_grad_scaler(precision: str, device: torch.device):
+    """
+    Create gradient scaler for precisions with narrow exponent range (fp16).
+    bf16 has the same exponent range as fp32 and needs no scaling.
+
+    :return: `torch.cuda.amp.GradScaler` or None if no gradient scaling is needed
+    """
+    check_precision(precision, device)
+    if precision == 'fp16':
+        return torch.cuda.amp.GradScaler()
+    return None
 
 
 def get_all_lr_from_optimizer(optimizer: Optimizer):
@@ -35,50 +75,166 @@ def get_lr_from_optimizer_first_group(optimizer: Optimizer):
     return lrs[0]
 
 
-def segment_single_scan(data: np.ndarray, net, device):
-    gen = get_single_image_slice_gen(data)
-    outs = []
+def batch_to_tensor(batch, device: torch.device) -> torch.Tensor:
+    """
+    Convert batch of slices to float tensor of shape (N, 1, H, W) on `device`.
+
+    Slices are moved to the device in their compact dtype (int16 scans, uint8 masks)
+    and are cast to float there, so 2-4 times less bytes are copied and allocated on the host.
+
+    :param batch: either a tensor of shape (N, H, W) collated by data loader (see `BatchBuffers`),
+    3D np.ndarray or a list of 2D np.ndarrays of the same shape
+    """
+    if not torch.is_tensor(batch):
+        batch = torch.from_numpy(np.ascontiguousarray(np.stack(batch) if isinstance(batch, list) else batch))
+    x = batch.to(device=device, non_blocking=batch.is_pinned()).float()
+    return x.unsqueeze(1)
+
+
+def unpack_mask_bits_tensor(packed: torch.Tensor, width: int) -> torch.Tensor:
+    """
+    Unpack masks bit-packed along the last axis (see `preprocessing.pack_mask_bits`) on the device of `packed`.
+
+    :param width: size of unpacked masks along the last axis
+    :return: uint8 tensor with {0, 1} values
+    """
+    # np.packbits stores the first pixel in the most significant bit
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    return bits.flatten(-2)[..., :width]
+
+
+def masks_to_tensor(masks, device: torch.device) -> torch.Tensor:
+    """
+    Convert batch of masks to float tensor of shape (N, 1, H, W) on `device`.
+
+    :param masks: `BitPackedMasks` or any batch accepted by `batch_to_tensor`.
+    bit-packed masks are moved to the device packed and are unpacked there
+    """
+    if isinstance(masks, BitPackedMasks):
+        packed = masks.packed.to(device=device, non_blocking=masks.packed.is_pinned())
+        return unpack_mask_bits_tensor(packed, masks.width).float().unsqueeze(1)
+    return batch_to_tensor(masks, device)
+
+
+def ingest_batch(scans, masks, device: torch.device) -> tuple:
+    """
+    Move batch yielded by data loader to `device`. The only place where training batches are converted
+    to float tensors: used by `loss_batch` and thus by training and `LRFinder`.
+
+    :return: (x, y) float tensors of shape (N, 1, H, W)
+    """
+    return batch_to_tensor(scans, device), masks_to_tensor(masks, device)
+
+
+def segment_single_scan(
+        data, net, device, batch_size: int = 4, pin_memory: bool = False, precision: str = 'fp32'
+) -> np.ndarray:
+    """
+    :param data: scan volume of shape (H, W, Z). either np.ndarray or torch.Tensor.
+    slices are padded with air to shape divisible by `const.PAD_MULTIPLE` before passing them to the net
+    :param pin_memory: whether to store slice-major copy of the volume in pinned memory
+    :param precision: precision to run the net in (see `PRECISIONS`)
+    :return: binary mask np.ndarray of shape (H, W, Z)
+    """
+    if not torch.is_tensor(data):
+        data = torch.from_numpy(data)
+    h, w = data.shape[:2]
+    h_padded, w_padded = preprocessing.get_padded_shape([(h, w)])
+    # make slices contiguous in memory: (H, W, Z) -> (Z, H, W)
+    if (h_padded, w_padded) == (h, w):
+        slices = data.permute(2, 0, 1).contiguous()
+    else:
+        slices = torch.full((data.shape[2], h_padded, w_padded), const.BODY_THRESH_LOW, dtype=data.dtype)
+        slices[:, :h, :w] = data.permute(2, 0, 1)
+    if pin_memory and torch.cuda.is_available():
+        slices = slices.pin_memory()
+
+    out_combined = np.empty(data.shape, dtype=np.uint8)
 
     net.eval()
     with torch.no_grad():
-        for scan_slices in gen:
-            x = torch.tensor(scan_slices, dtype=torch.float, device=device).unsqueeze(1)
-            out = net(x)
-            out = utils.squeeze_and_to_numpy(out)
-            out = (out > 0.5).astype(np.uint8)
-
-            if len(out.shape) == 2:
-                # `out` is an array of shape (H, W)
-                outs.append(out)
-            elif len(out.shape) == 3:
-                # `out` is an array of shape (N, H, W)
-                outs.extend(out)
-
-    out_combined = np.stack(outs, axis=2)  # stack along axis 2 to get array of shape (H, W, N)
+        for z_start in range(0, slices.shape[0], batch_size):
+            x = batch_to_tensor(slices[z_start: z_start + batch_size], device)
+            with get_autocast(precision, device):
+                out = net(x)
+            # binarize on device to transfer 1 byte per pixel
+            out = (out > 0.5).to(torch.uint8).squeeze(1)[:, :h, :w].cpu().numpy()
+            # `out` is an array of shape (N, H, W)
+            out_combined[:, :, z_start: z_start + out.shape[0]] = np.transpose(out, [1, 2, 0])
+
     return out_combined
 
 
 # ----------- train functions ----------- #
 
+def get_one_cycle_scheduler(
+        optimizer: Optimizer, max_lr: float, n_epochs: int, steps_per_epoch: int,
+        pct_start: float = 0.3, anneal_strategy: str = 'cos'
+) -> OneCycleLR:
+    """
+    Create 1-cycle learning rate scheduler to step after each batch (see `loss_epoch`):
+    learning rate grows from `max_lr / 25` to `max_lr` during the first `pct_start` of steps
+    and then is annealed to `max_lr / 25e4`. Momentum (beta1 for Adam) cycles in the opposite direction.
+
+    :param pct_start: share of steps to increase learning rate on
+    :param anneal_strategy: 'cos' or 'linear'
+    """
+    return OneCycleLR(
+        optimizer, max_lr=max_lr, epochs=n_epochs, steps_per_epoch=steps_per_epoch,
+        pct_start=pct_start, anneal_strategy=anneal_strategy, cycle_momentum=True
+    )
+
+
+def get_scheduler_state(scheduler) -> dict:
+    """
+    Get state dict of learning rate scheduler with no callables (annealing functions of `OneCycleLR`),
+    so that it can be pickled. Callables are set by the constructor of the scheduler the state is loaded into.
+
+    :return: state dict or None if no scheduler passed
+    """
+    if scheduler is None:
+        return None
+    return {k: v for k, v in scheduler.state_dict().items() if not callable(v)}
+
+
 def loss_batch(
         net: nn.Module, x_batch, y_batch,
         loss_func: nn.Module, metrics: List[nn.Module],
-        device: torch.device, optimizer: Optimizer = None
+        device: torch.device, optimizer: Optimizer = None,
+        precision: str = 'fp32', scaler: torch.cuda.amp.GradScaler = None,
+        accumulator: MetricsAccumulator = None
 ) -> dict:
+    """
+    :param precision: precision to run the net in (see `PRECISIONS`)
+    :param scaler: gradient scaler to use with fp16 precision (see `create_grad_scaler`)
+    :param accumulator: accumulator to add loss and metrics to on the device.
+    if passed - `metrics` are ignored and empty dict is returned, so no device sync is performed
+    :return: dict with loss and metrics values of the batch
+    """
     batch_stats = {}
-    x = torch.tensor(x_batch, dtype=torch.float, device=device).unsqueeze(1)
-    y = torch.tensor(y_batch, dtype=torch.float, device=device).unsqueeze(1)
+    x, y = ingest_batch(x_batch, y_batch, device)
 
-    out = net(x)
+    with get_autocast(precision, device):
+        out = net(x)
+    # compute losses and metrics in float32: reductions over the whole batch
+    # and logarithms of sigmoid outputs are not safe in half precision
+    out = out.float()
     loss = loss_func(out, y)
 
     loss_name = utils.get_class_name(loss_func)
-    batch_stats[loss_name] = loss.item()
+    if accumulator is None:
+        batch_stats[loss_name] = loss.item()
 
     if optimizer is not None:
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
     # It's uncommon to set model to evaluation state with `net.eval()`
     # to calculate additional metrics during training because:
@@ -87,6 +243,10 @@ def loss_batch(
     # According to https://discuss.pytorch.org/t/model-eval-for-train-accuracy/61526
     # So we'll just disable gradient tracking.
     # `net.eval`() must be called outside this function when calculating metrics on validation set
+    if accumulator is not None:
+        accumulator.add(out, y, loss)
+        return batch_stats
+
     with torch.no_grad():
         for metric_func in metrics:
             metric_name = utils.get_class_name(metric_func)
@@ -101,45 +261,99 @@ def loss_epoch(
         net: nn.Module, dataloader: BaseDataLoader,
         loss_func: nn.Module, metrics: List[nn.Module],
         device: torch.device, optimizer: Optimizer = None,
-        tqdm_description: str = None, max_batches: int = None
+        tqdm_description: str = None, max_batches: int = None,
+        precision: str = 'fp32', scaler: torch.cuda.amp.GradScaler = None,
+        batch_scheduler: OneCycleLR = None, sync_every: int = None,
+        batch_indices: list = None, start_batch_ix: int = 0,
+        accumulator: MetricsAccumulator = None, on_batch_end=None,
+        metrics_log: MetricsLog = None, log_fields: dict = None
 ) -> dict:
     """
     :param max_batches: max number of batches to process. use to perform sanity check
+    :param precision: precision to run the net in (see `PRECISIONS`)
+    :param scaler: gradient scaler to use with fp16 precision (see `create_grad_scaler`)
+    :param batch_scheduler: learning rate scheduler to step after each optimizer step
+    :param sync_every: number of batches to copy running loss and metrics from the device
+    to show them in progress bar after. copy them only in the end of epoch if None
+    :param batch_indices: batches of the epoch (see `BaseDataLoader.get_batch_indices`).
+    drawn by `dataloader` if None
+    :param start_batch_ix: number of batches of `batch_indices` that are already processed.
+    use with `accumulator` to resume interrupted epoch
+    :param accumulator: accumulator with loss and metrics of already processed batches
+    :param on_batch_end: function to call with number of processed batches and accumulator after each batch
+    :param metrics_log: log to write timings of each batch and of the whole stage to.
+    step time is measured on the host, so on cuda devices it doesn't include the time of the work
+    queued on the device unless the device is synchronized after the batch (e.g. with `sync_every`)
+    :param log_fields: fields to add to each record of `metrics_log` (e.g. epoch and stage)
     """
-    # create `epoch_stats` dict
-    epoch_stats = {utils.get_class_name(metric): 0 for metric in metrics}
-    # generate field to store loss in case it's not present in `metrics` list
-    epoch_stats[utils.get_class_name(loss_func)] = 0
+    # loss and metrics are accumulated on the device. see `MetricsAccumulator`
+    if accumulator is None:
+        accumulator = MetricsAccumulator(utils.get_class_name(loss_func), metrics, device)
 
     n_samples = len(dataloader)
-    gen = dataloader.get_generator()
+    if batch_indices is not None:
+        batch_indices = batch_indices[start_batch_ix:]
+    gen = dataloader.get_generator(batch_indices)
+
+    log_fields = log_fields or {}
+    n_samples_start = accumulator.n_samples
+    data_time, step_time = 0., 0.
+    time_start = time.time()
+    time_batch_requested = time_start
 
-    with tqdm.tqdm(total=n_samples, desc=tqdm_description,
+    with tqdm.tqdm(total=n_samples, initial=accumulator.n_samples, desc=tqdm_description,
                    unit='slice', leave=True, bar_format=const.TQDM_BAR_FORMAT) as pbar_t:
-        for batch_ix, (scans_batch, masks_batch, descriptions_batch) in enumerate(gen, start=1):
+        for batch_ix, (scans_batch, masks_batch, descriptions_batch) in enumerate(gen, start=start_batch_ix + 1):
+            time_batch_ready = time.time()
             batch_size = len(scans_batch)
-            batch_stats = loss_batch(
+            lr = get_lr_from_optimizer_first_group(optimizer) if optimizer is not None else None
+            loss_batch(
                 net=net, x_batch=scans_batch, y_batch=masks_batch,
-                loss_func=loss_func, metrics=metrics, device=device, optimizer=optimizer
+                loss_func=loss_func, metrics=metrics, device=device, optimizer=optimizer,
+                precision=precision, scaler=scaler, accumulator=accumulator
             )
+            if optimizer is not None and batch_scheduler is not None:
+                batch_scheduler.step()
 
             # TODO: what are the issues of using `reduction='sum'`?
             #   there was one as I remember
 
-            # add values of batch stats to epoch stats.
-            # multiply batch_stats by batch_size to handle reduction='mean'
-            epoch_stats = {
-                k: epoch_stats[k] + batch_stats[k] * batch_size
-                for k in epoch_stats.keys() & batch_stats.keys()
-            }
+            # running stats are copied from the device only once per `sync_every` batches
+            running_stats = None
+            if sync_every is not None and batch_ix % sync_every == 0:
+                running_stats = accumulator.get_stats()
+                pbar_t.set_postfix({k: f'{v : .4f}' for k, v in running_stats.items()}, refresh=False)
 
             pbar_t.update(batch_size)
 
+            time_batch_done = time.time()
+            data_time += time_batch_ready - time_batch_requested
+            step_time += time_batch_done - time_batch_ready
+            if metrics_log is not None:
+                metrics_log.log(
+                    'batch', **log_fields, batch=batch_ix, n_slices=batch_size, lr=lr,
+                    data_time=time_batch_ready - time_batch_requested, step_time=time_batch_done - time_batch_ready,
+                    running=running_stats
+                )
+
+            if on_batch_end is not None:
+                on_batch_end(batch_ix, accumulator)
+
             if max_batches is not None and batch_ix >= max_batches:
                 break
 
+            time_batch_requested = time.time()
+
     # average stats
-    epoch_stats = {k: v / n_samples for k, v in epoch_stats.items()}
+    epoch_stats = accumulator.get_stats(n_samples)
+
+    if metrics_log is not None:
+        stage_time = time.time() - time_start
+        stage_samples = accumulator.n_samples - n_samples_start
+        metrics_log.log(
+            'stage', **log_fields, n_slices=stage_samples, stage_time=stage_time, data_time=data_time,
+            step_time=step_time, slices_per_sec=stage_samples / max(stage_time, 1e-9)
+        )
 
     return epoch_stats
 
@@ -149,11 +363,28 @@ def train_valid(
         train_loader: BaseDataLoader, valid_loader: BaseDataLoader,
         optimizer: Optimizer, scheduler: ReduceLROnPlateau, device: torch.device,
         n_epochs: int, es_tolerance: float, es_patience: int,
-        out_dp: str, max_batches: int = None
+        out_dp: str, max_batches: int = None, precision: str = 'fp32',
+        batch_scheduler: OneCycleLR = None, sync_every: int = None,
+        keep_last: int = None, keep_every: int = None,
+        state_every: int = None, resume_state: dict = None
 ) -> dict:
     """
-    :param out_dp: path to dir where to store checkpoints, history and learning curves plot
+    :param scheduler: scheduler to step with validation loss after each epoch. pass None to use `batch_scheduler`.
+    model is reset to the best epoch parameters whenever the scheduler reduces learning rate
+    :param batch_scheduler: scheduler to step after each train batch (see `get_one_cycle_scheduler`)
+    :param out_dp: path to dir where to store checkpoints, history, metrics log (see `MetricsLog`)
+    and learning curves plot. learning curves are built in the end of training only.
+    use `metrics_log.plot_run` to build them while training is in progress
     :param max_batches: max number of batches to process on each epoch. use to perform sanity check
+    :param precision: precision to run the net in (see `PRECISIONS`)
+    :param sync_every: number of batches to show running loss and metrics after (see `loss_epoch`)
+    :param keep_last: number of last epoch checkpoints to keep. checkpoint of the best epoch is always kept
+    :param keep_every: keep checkpoints of every `keep_every`-th epoch.
+    all epoch checkpoints are kept if neither `keep_last` nor `keep_every` is passed
+    :param state_every: number of train batches to save full training state after (see `CheckpointWriter.save_state`).
+    state is saved in the end of each epoch anyway
+    :param resume_state: state of interrupted training to resume (see `checkpoints.load_training_state`).
+    training continues from the batch the state was saved after. pass the same arguments as to the interrupted run
     :param es_tolerance: early stopping tolerance
     :param es_patience: number of epochs with no significant improvements for early stopping to fire
 
@@ -171,46 +402,148 @@ def train_valid(
     history = {utils.get_class_name(m): {'train': [], 'valid': []} for m in metrics}
     loss_name = utils.get_class_name(loss_func)
 
+    scaler = create_grad_scaler(precision, device)
+    checkpoint_writer = CheckpointWriter(
+        checkpoints_dp, loss_name, keep_last=keep_last, keep_every=keep_every, pin_memory=device.type == 'cuda'
+    )
+    metrics_log = MetricsLog(out_dp)
+
     es_cnt = 0  # early stopping counter
 
     best_loss_valid = float('inf')
     best_epoch_ix = -1  # index of best epoch starting from 1
-    best_net_params = copy.deepcopy(net.state_dict())
+    # kept in host memory not to occupy memory of the device
+    best_net_params = checkpoint_writer.snapshot(net.state_dict())
+
+    start_epoch = 1
+    # state of the interrupted epoch: its batches, number of processed batches and accumulated metrics
+    epoch_progress = None
+
+    if resume_state is not None:
+        net.load_state_dict(resume_state['net'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        for key, obj in [('scheduler', scheduler), ('batch_scheduler', batch_scheduler), ('scaler', scaler)]:
+            if (obj is None) != (resume_state[key] is None):
+                raise ValueError(f'{key} of the interrupted run doesn\'t match. '
+                                 f'pass the same arguments as to the interrupted run')
+            if obj is not None:
+                obj.load_state_dict(resume_state[key])
+
+        history = resume_state['history']
+        es_cnt = resume_state['es_cnt']
+        best_loss_valid = resume_state['best_loss_valid']
+        best_epoch_ix = resume_state['best_epoch_ix']
+        best_net_params = resume_state['best_net_params']
+        set_rng_states(resume_state['rng'])
+
+        if resume_state['batch_ix'] is None:
+            start_epoch = resume_state['epoch'] + 1
+        else:
+            start_epoch = resume_state['epoch']
+            epoch_progress = resume_state
+        checkpoint_writer.resume(start_epoch - 1, best_epoch_ix)
+
+        if es_cnt >= es_patience:
+            print('early stopping fired in the interrupted run. nothing to resume')
+            start_epoch = n_epochs + 1
+
+    def save_training_state(epoch_ix: int, batch_ix: int = None, batch_indices: list = None,
+                            accumulator: MetricsAccumulator = None):
+        """
+        :param batch_ix: number of processed train batches of the epoch. None if the epoch is finished
+        """
+        state = checkpoint_writer.snapshot({
+            'net': net.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': get_scheduler_state(scheduler),
+            'batch_scheduler': get_scheduler_state(batch_scheduler),
+            'scaler': scaler.state_dict() if scaler is not None else None,
+            'accumulator': accumulator.state_dict() if accumulator is not None else None,
+            'history': history
+        })
+        state.update({
+            'epoch': epoch_ix,
+            'batch_ix': batch_ix,
+            'batch_indices': batch_indices,
+            'lr_on_epoch_start': lr_on_epoch_start,
+            'es_cnt': es_cnt,
+            'best_loss_valid': best_loss_valid,
+            'best_epoch_ix': best_epoch_ix,
+            # already in host memory
+            'best_net_params': best_net_params,
+            'rng': get_rng_states()
+        })
+        checkpoint_writer.save_state(state)
+
+    def on_train_batch_end(batch_ix: int, accumulator: MetricsAccumulator):
+        if batch_ix % state_every == 0:
+            save_training_state(cur_epoch, batch_ix, batch_indices, accumulator)
 
     print(f'\ntrain parameters:\n\n'
           f'model architecture: {utils.get_class_name(net)}\n'
           f'loss function: {loss_name}\n'
           f'optimizer: {optimizer}\n'
+          f'scheduler: {utils.get_class_name(scheduler or batch_scheduler)}\n'
           f'number of epochs: {n_epochs}\n'
           f'es tolerance: {es_tolerance : .3e}\n'
           f'es patience: {es_patience}\n'
           f'device: {device}\n'
+          f'precision: {precision}\n'
           f'checkpoints dir: {os.path.abspath(checkpoints_dp)}\n'
+          f'checkpoint writer: {checkpoint_writer}\n'
+          f'state every: {state_every}\n'
+          f'metrics log: {metrics_log}\n'
+          f'resumed from epoch: {start_epoch if resume_state is not None else None}\n'
           f'out dp: "{out_dp}"\n'
           f'max_batches: {max_batches}'
           )
     print(f'\ntrain_loader:\n{train_loader}')
     print(f'\nvalid_loader:\n{valid_loader}')
 
+    metrics_log.log(
+        'run', loss_name=loss_name, n_epochs=n_epochs, start_epoch=start_epoch,
+        precision=precision, device=str(device), resumed=resume_state is not None
+    )
+
     # count global time of training
     time_start_train_valid = time.time()
 
-    for cur_epoch in range(1, n_epochs + 1):
+    for cur_epoch in range(start_epoch, n_epochs + 1):
         print(f'\n{"=" * 15} epoch {cur_epoch}/{n_epochs} {"=" * 15}')
         time_start_epoch = time.time()
 
-        lr_on_epoch_start = get_lr_from_optimizer_first_group(optimizer)
+        if epoch_progress is not None:
+            # batch scheduler has already been stepped during the processed batches of the resumed epoch
+            lr_on_epoch_start = epoch_progress['lr_on_epoch_start']
+        else:
+            lr_on_epoch_start = get_lr_from_optimizer_first_group(optimizer)
         print(f'current learning rate: {lr_on_epoch_start : .3e}\n')
 
         # ----------- training ----------- #
         net.train()
         tqdm_description = f'epoch {cur_epoch}. training'
 
+        if epoch_progress is not None:
+            batch_indices = epoch_progress['batch_indices']
+            start_batch_ix = epoch_progress['batch_ix']
+            accumulator = MetricsAccumulator(loss_name, metrics, device)
+            accumulator.load_state_dict(epoch_progress['accumulator'])
+            epoch_progress = None
+            print(f'resuming epoch after {start_batch_ix}/{len(batch_indices)} batches\n')
+        else:
+            # batches are drawn in advance to be stored with training state
+            batch_indices = train_loader.get_batch_indices()[:max_batches]
+            start_batch_ix, accumulator = 0, None
+
         epoch_stats_train = loss_epoch(
             net=net, dataloader=train_loader,
             loss_func=loss_func, metrics=metrics,
             device=device, optimizer=optimizer,
-            tqdm_description=tqdm_description, max_batches=max_batches
+            tqdm_description=tqdm_description, max_batches=max_batches,
+            precision=precision, scaler=scaler, batch_scheduler=batch_scheduler, sync_every=sync_every,
+            batch_indices=batch_indices, start_batch_ix=start_batch_ix, accumulator=accumulator,
+            on_batch_end=on_train_batch_end if state_every is not None else None,
+            metrics_log=metrics_log, log_fields={'epoch': cur_epoch, 'stage': 'train'}
         )
 
         for m_name, val in epoch_stats_train.items():
@@ -229,7 +562,9 @@ def train_valid(
                 net=net, dataloader=valid_loader,
                 loss_func=loss_func, metrics=metrics,
                 device=device, optimizer=None,  # provide no optimizer to avoid backpropagation
-                tqdm_description=tqdm_description, max_batches=max_batches
+                tqdm_description=tqdm_description, max_batches=max_batches,
+                precision=precision, sync_every=sync_every,
+                metrics_log=metrics_log, log_fields={'epoch': cur_epoch, 'stage': 'valid'}
             )
 
         for m_name, val in epoch_stats_valid.items():
@@ -239,11 +574,9 @@ def train_valid(
 
         # ----------- end of epoch ----------- #
 
-        # store parameters
-        torch.save(
-            net.state_dict(),
-            os.path.join(checkpoints_dp, f'cp_{loss_name}_epoch_{cur_epoch:02}.pth')
-        )
+        # store parameters. checkpoint is written in background
+        epoch_net_params = checkpoint_writer.snapshot(net.state_dict())
+        checkpoint_writer.save_epoch(cur_epoch, epoch_net_params)
 
         # append epoch stats to history
         for k in epoch_stats_train.keys() & epoch_stats_valid.keys():
@@ -251,15 +584,13 @@ def train_valid(
             history[k]['valid'].append(epoch_stats_valid[k])
         last_val_loss = history[loss_name]['valid'][-1]
 
-        # build learning curves (overwrite existing file on each epoch)
-        utils.build_learning_curves(metrics=history, loss_name=loss_name, out_dp=out_dp)
-
         print(f'\nepoch validation loss: {last_val_loss : .4f}')
 
-        # scheduler step
-        scheduler.step(last_val_loss)
+        # scheduler step. batch scheduler is stepped during training
+        if scheduler is not None:
+            scheduler.step(last_val_loss)
         cur_lr = get_lr_from_optimizer_first_group(optimizer)
-        if cur_lr != lr_on_epoch_start:
+        if scheduler is not None and cur_lr != lr_on_epoch_start:
             # load previous best parameters and continue training
             print(f'LR was reduced. Loading model state dict from previous best epoch:\n'
                   f'best_epoch_ix: {best_epoch_ix}\n'
@@ -276,12 +607,20 @@ def train_valid(
         if history[loss_name]['valid'][-1] < best_loss_valid - es_tolerance:
             best_loss_valid = history[loss_name]['valid'][-1]
             tqdm.tqdm.write(f'\nepoch {cur_epoch}: new best loss valid: {best_loss_valid : .4f}')
-            best_net_params = copy.deepcopy(net.state_dict())
+            # use epoch snapshot: the model could have been reset to the previous best parameters above
+            best_net_params = epoch_net_params
             best_epoch_ix = cur_epoch
+            checkpoint_writer.set_best_epoch(best_epoch_ix)
             es_cnt = 0
         else:
             es_cnt += 1
 
+        metrics_log.log(
+            'epoch', epoch=cur_epoch, lr=lr_on_epoch_start, train=epoch_stats_train, valid=epoch_stats_valid,
+            epoch_time=time.time() - time_start_epoch, best_loss_valid=best_loss_valid, best_epoch_ix=best_epoch_ix
+        )
+        save_training_state(cur_epoch)
+
         if es_cnt >= es_patience:
             tqdm.tqdm.write(const.SEPARATOR)
             tqdm.tqdm.write(f'\nEarly Stopping!'
@@ -289,19 +628,25 @@ def train_valid(
             break
 
     # ----------- end of training ----------- #
+    metrics_log.close()
+
+    if history[loss_name]['valid']:
+        fig, _ = utils.build_learning_curves(metrics=history, loss_name=loss_name, out_dp=out_dp)
+        plt.close(fig)
+
     # modify history dict
     history = {
         'metrics': history,
         'loss_name': loss_name,
         'best_loss_valid': best_loss_valid,
-        'best_epoch_ix': best_epoch_ix
+        'best_epoch_ix': best_epoch_ix,
+        'precision': precision,
+        'scheduler': utils.get_class_name(scheduler or batch_scheduler)
     }
 
     # save best weights once again
-    torch.save(
-        best_net_params,
-        os.path.join(checkpoints_dp, f'cp_{loss_name}_best.pth')
-    )
+    checkpoint_writer.save_best(best_net_params)
+    checkpoint_writer.close()
 
     # load best model
     # TODO: check if weights of net outside this function are updated
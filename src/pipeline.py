@@ -6,6 +6,7 @@ import pickle
 import time
 from typing import List
 
+import numpy as np
 import tqdm
 from matplotlib import pyplot as plt
 from torch import optim
@@ -16,8 +17,10 @@ import const
 import model.utils as mu
 import utils
 from data import preprocessing
+from data.catalog import DatasetCatalog
 from data.dataloaders import BaseDataLoader
 from model import UNet, MobileNetV2_UNet
+from model.checkpoints import load_training_state
 from model.losses import *
 from model.lr_finder import LRFinder
 
@@ -34,6 +37,8 @@ METRICS_DICT = {
     # FocalLoss(alpha=0.75, gamma=2, reduction='mean'),
 }
 
+SCHEDULES = ['plateau', 'onecycle']
+
 
 class Pipeline:
     net = None
@@ -81,22 +86,55 @@ class Pipeline:
     def train(
             self, train_loader: BaseDataLoader, valid_loader: BaseDataLoader,
             n_epochs: int, loss_func: nn.Module, metrics: List[nn.Module],
-            out_dp: str = None, max_batches: int = None, initial_checkpoint_fp: str = None
+            out_dp: str = None, max_batches: int = None, initial_checkpoint_fp: str = None,
+            precision: str = 'fp32', schedule: str = 'plateau', max_lr: float = None,
+            lr_finder_results_fp: str = None, anneal_strategy: str = 'cos', sync_every: int = None,
+            keep_last: int = None, keep_every: int = None,
+            state_every: int = None, resume_dp: str = None
     ):
         """
         Train wrapper.
 
         :param max_batches: maximum number of batches for training and validation to perform sanity check
         :param initial_checkpoint_fp: path to .pth checkpoint for warm start
+        :param precision: precision to run the net in (see `model.utils.PRECISIONS`)
+        :param schedule: learning rate schedule (see `SCHEDULES`).
+        'plateau' - reduce learning rate when validation loss stops improving.
+        'onecycle' - 1-cycle policy with learning rate changed after each batch
+        :param max_lr: max learning rate of 1-cycle policy. if None - suggested from `lr_finder_results_fp`
+        :param lr_finder_results_fp: path to `LRFinder` results. defaults to the path used by `lr_find_and_store`
+        :param anneal_strategy: how to anneal learning rate in 1-cycle policy: 'cos' or 'linear'
+        :param sync_every: number of batches to show running loss and metrics after.
+        loss and metrics are copied from the device only in the end of epoch if None
+        :param keep_last: number of last epoch checkpoints to keep
+        :param keep_every: keep checkpoints of every `keep_every`-th epoch.
+        all epoch checkpoints are kept if neither `keep_last` nor `keep_every` is passed
+        :param state_every: number of train batches to save full training state after.
+        state is saved in the end of each epoch anyway
+        :param resume_dp: `out_dp` of interrupted training to resume from its last saved training state.
+        artifacts are stored to the same dir. pass the same arguments as to the interrupted run
         """
-
-        out_dp = out_dp or const.RESULTS_DN
-        # check if dir is nonempty
-        utils.prompt_to_clear_dir_content_if_nonempty(out_dp)
-        os.makedirs(out_dp, exist_ok=True)
+        mu.check_precision(precision, self.device)
+        if schedule not in SCHEDULES:
+            raise ValueError(f'`schedule` should be in {SCHEDULES}. passed "{schedule}"')
+        if resume_dp is not None and initial_checkpoint_fp is not None:
+            raise ValueError('warm start checkpoint can\'t be used while resuming training')
+
+        resume_state = None
+        if resume_dp is not None:
+            out_dp = resume_dp
+            resume_state = load_training_state(os.path.join(resume_dp, const.MODEL_CHECKPOINTS_DN))
+        else:
+            out_dp = out_dp or const.RESULTS_DN
+            # check if dir is nonempty
+            utils.prompt_to_clear_dir_content_if_nonempty(out_dp)
+            os.makedirs(out_dp, exist_ok=True)
 
         print(const.SEPARATOR)
-        if initial_checkpoint_fp is not None:
+        if resume_state is not None:
+            print(f'RESUMING training stored under "{resume_dp}"')
+            self.create_net()
+        elif initial_checkpoint_fp is not None:
             print('training with WARM START')
             self.load_net_from_weights(initial_checkpoint_fp)
         else:
@@ -108,18 +146,37 @@ class Pipeline:
         # consider providing the same tolerance to ReduceLROnPlateau and Early Stopping
         tolerance = 1e-4
 
-        scheduler = optim.lr_scheduler.ReduceLROnPlateau(
-            self.optimizer, mode='min', factor=0.2, min_lr=1e-6,
-            threshold=tolerance, patience=2, threshold_mode='abs',
-            cooldown=0, verbose=True
-        )
+        scheduler, batch_scheduler = None, None
+        if schedule == 'plateau':
+            scheduler = optim.lr_scheduler.ReduceLROnPlateau(
+                self.optimizer, mode='min', factor=0.2, min_lr=1e-6,
+                threshold=tolerance, patience=2, threshold_mode='abs',
+                cooldown=0, verbose=True
+            )
+        else:
+            if max_lr is None:
+                lr_finder_results_fp = lr_finder_results_fp or os.path.join(
+                    const.RESULTS_DN, const.LR_FINDER_RESULTS_DN, const.LR_FINDER_RESULTS_FN
+                )
+                max_lr = LRFinder.suggest_max_lr(lr_finder_results_fp)
+                print(f'max learning rate suggested from "{lr_finder_results_fp}": {max_lr : .3e}')
+            steps_per_epoch = train_loader.n_batches
+            if max_batches is not None:
+                steps_per_epoch = min(steps_per_epoch, max_batches)
+            batch_scheduler = mu.get_one_cycle_scheduler(
+                self.optimizer, max_lr=max_lr, n_epochs=n_epochs, steps_per_epoch=steps_per_epoch,
+                anneal_strategy=anneal_strategy
+            )
 
         history = mu.train_valid(
             net=self.net, loss_func=loss_func, metrics=metrics,
             train_loader=train_loader, valid_loader=valid_loader,
             optimizer=self.optimizer, scheduler=scheduler, device=self.device,
             n_epochs=n_epochs, es_tolerance=tolerance, es_patience=15,
-            out_dp=out_dp, max_batches=max_batches
+            out_dp=out_dp, max_batches=max_batches, precision=precision,
+            batch_scheduler=batch_scheduler, sync_every=sync_every,
+            keep_last=keep_last, keep_every=keep_every,
+            state_every=state_every, resume_state=resume_state
         )
 
         # store history dict to .pickle file
@@ -152,7 +209,8 @@ class Pipeline:
 
     def segment_scans(
             self, checkpoint_fp: str, scans_dp: str, postfix: str,
-            ids: List[str] = None, output_dp: str = None
+            ids: List[str] = None, output_dp: str = None, catalog: DatasetCatalog = None,
+            crop_body: bool = False, crop_margin: int = const.BODY_CROP_MARGIN, precision: str = 'fp32'
     ):
         """
         :param checkpoint_fp:   path to .pth file with net's params dict
@@ -161,8 +219,14 @@ class Pipeline:
         :param postfix:     postfix of segmented filenames
         :param ids:    list of image ids to consider. if None segment all scans under `scans_dp`
         :param output_dp:   path to directory to store results of segmentation
+        :param catalog:     catalog to get scans filepaths from. if None `scans_dp` is globbed
+        :param crop_body:   whether to segment only body bounding box of the scan (see `preprocessing.get_body_bbox`).
+                            use for models trained on cropped datasets. the rest of the mask is filled with zeros
+        :param crop_margin: margin of body bounding box in pixels
+        :param precision:   precision to run the net in (see `model.utils.PRECISIONS`)
         """
         utils.check_var_to_be_iterable_collection(ids)
+        mu.check_precision(precision, self.device)
 
         print(const.SEPARATOR)
         print('Pipeline.segment_scans()')
@@ -172,18 +236,25 @@ class Pipeline:
         os.makedirs(output_dp, exist_ok=True)
 
         print(f'postfix: {postfix}')
+        print(f'crop_body: {crop_body}')
+        if crop_body:
+            print(f'crop_margin: {crop_margin}')
+        print(f'precision: {precision}')
 
         self.load_net_from_weights(checkpoint_fp)
-        scans_fps = utils.get_nii_gz_filepaths(scans_dp)
-        print(f'# of .nii.gz files under "{scans_dp}": {len(scans_fps)}')
-
-        # filter filepaths to scans
-        scans_fps_filtered = []
-        for fp in scans_fps:
-            img_id, img_postfix = utils.parse_image_id_from_filepath(fp, get_postfix=True)
-            if img_postfix != '' or ids is not None and img_id not in ids:
-                continue
-            scans_fps_filtered.append(fp)
+        if catalog is not None:
+            scans_fps_filtered = [r['path'] for r in catalog.get_images(scans_dp, ids=ids, postfixes=[''])]
+        else:
+            scans_fps = utils.get_nii_gz_filepaths(scans_dp)
+            print(f'# of .nii.gz files under "{scans_dp}": {len(scans_fps)}')
+
+            # filter filepaths to scans
+            scans_fps_filtered = []
+            for fp in scans_fps:
+                img_id, img_postfix = utils.parse_image_id_from_filepath(fp, get_postfix=True)
+                if img_postfix != '' or ids is not None and img_id not in ids:
+                    continue
+                scans_fps_filtered.append(fp)
         print(f'# of scans left after filtering: {len(scans_fps_filtered)}')
 
         print('\nstarting segmentation...')
@@ -198,8 +269,23 @@ class Pipeline:
 
                 # clip intensities as during training
                 scan_data_clipped = preprocessing.clip_intensities(scan_data)
-
-                segmented_data = mu.segment_single_scan(scan_data_clipped, self.net, self.device)
+                # keep scan in compact dtype as in numpy datasets. it's cast to float on the device
+                if scan_data_clipped.dtype != np.int16:
+                    scan_data_clipped = scan_data_clipped.astype(np.int16)
+
+                bbox = None
+                if crop_body:
+                    bbox = preprocessing.get_body_bbox(preprocessing.get_body_mask(scan_data_clipped), crop_margin)
+                    scan_data_clipped = preprocessing.crop_volume_along_x_y(scan_data_clipped, bbox)
+
+                segmented_data = mu.segment_single_scan(
+                    scan_data_clipped, self.net, self.device, pin_memory=self.device.type == 'cuda',
+                    precision=precision
+                )
+
+                if bbox is not None:
+                    # paste mask of the body bounding box back to the full scan
+                    segmented_data = preprocessing.paste_volume_along_x_y(segmented_data, bbox, scan_data.shape)
                 segmented_nifti = utils.change_nifti_data(segmented_data, scan_nifti, is_scan=False)
 
                 out_fp = os.path.join(output_dp, f'{cur_id}_{postfix}.nii.gz')
@@ -212,11 +298,14 @@ class Pipeline:
 
     def lr_find_and_store(
             self, loss_func: nn.Module, train_loader: BaseDataLoader,
-            out_dp: str = None
+            out_dp: str = None, precision: str = 'fp32'
     ):
         """
         LRFinder wrapper.
+
+        :param precision: precision to run the net in (see `model.utils.PRECISIONS`)
         """
+        mu.check_precision(precision, self.device)
         out_dp = out_dp or os.path.join(const.RESULTS_DN, const.LR_FINDER_RESULTS_DN)
         os.makedirs(out_dp, exist_ok=True)
         utils.prompt_to_clear_dir_content_if_nonempty(out_dp)
@@ -226,7 +315,7 @@ class Pipeline:
 
         lr_finder = LRFinder(
             net=self.net, loss_func=loss_func, optimizer=self.optimizer,
-            train_loader=train_loader, device=self.device
+            train_loader=train_loader, device=self.device, precision=precision
         )
         lr_finder.lr_find()
         lr_finder.store_results(out_dp=out_dp)
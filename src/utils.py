@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import os
 import re
 import shutil
@@ -18,6 +19,12 @@ import yaml
 
 import const
 
+try:
+    # optional dependency. required only for random access to .nii.gz files with gzip index
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
 
 def get_class_name(cls):
     name = type(cls).__name__
@@ -55,20 +62,88 @@ def load_nifti(fp: str, load_data=True):
     return image, data
 
 
-def load_nifti_slice(fp: str, ix: int) -> np.ndarray:
+def load_nifti_slice(fp: str, ix: int, use_gzip_index: bool = False, gzip_index_dp: str = None) -> np.ndarray:
     """
     Load single slice from Nifti image along z-axis
+
+    :param use_gzip_index: whether to use seek-point index to read the slice from .nii.gz file
+    without decompressing all the data before it. see `load_nifti_with_gzip_index`
+    :param gzip_index_dp: directory with gzip indices. see `get_gzip_index_fp`
     """
+    if use_gzip_index and fp.endswith('.gz'):
+        img, fileobj = load_nifti_with_gzip_index(fp, gzip_index_dp)
+        try:
+            img_slice = img.dataobj[:, :, ix]
+        finally:
+            fileobj.close()
+        return img_slice
+
     img, _ = load_nifti(fp, load_data=False)
     img_slice = img.dataobj[:, :, ix]
     return img_slice
 
 
-def load_npy(fp: str):
+def check_indexed_gzip_is_installed():
+    if indexed_gzip is None:
+        raise ImportError('random access to .nii.gz files requires `indexed_gzip` package. '
+                          'install it with `pip3 install indexed_gzip`')
+
+
+def get_gzip_index_fp(fp: str, index_dp: str = None):
+    """
+    Get path to seek-point index of .gz file.
+    Index is stored next to the file if `index_dp` is None.
+    """
+    index_dp = index_dp or os.path.dirname(fp)
+    return os.path.join(index_dp, f'{os.path.basename(fp)}{const.GZIP_INDEX_EXT}')
+
+
+def build_gzip_index(fp: str, index_fp: str, spacing_mb: float = const.GZIP_INDEX_SPACING_MB):
+    """
+    Build seek-point index for .gz file (zran-style access points every `spacing_mb` MB
+    of uncompressed data) and store it to `index_fp`.
+    """
+    check_indexed_gzip_is_installed()
+
+    with indexed_gzip.IndexedGzipFile(fp, spacing=int(spacing_mb * 1024 ** 2)) as fin:
+        fin.build_full_index()
+        # write to temporary file first so that concurrent readers never see partial index
+        tmp_fp = f'{index_fp}.{os.getpid()}.tmp'
+        fin.export_index(tmp_fp)
+    os.replace(tmp_fp, index_fp)
+
+
+def load_nifti_with_gzip_index(fp: str, index_dp: str = None):
+    """
+    Open .nii.gz image with random access to its data. Seek-point index is built once per file
+    and is persisted under `index_dp` (next to the file if None). Index is rebuilt if file was modified.
+
+    :return: (Nifti1Image, opened file object). close file object when image data is no longer needed
+    """
+    check_indexed_gzip_is_installed()
+
+    index_fp = get_gzip_index_fp(fp, index_dp)
+    if not os.path.isfile(index_fp) or os.path.getmtime(index_fp) < os.path.getmtime(fp):
+        os.makedirs(os.path.dirname(index_fp), exist_ok=True)
+        build_gzip_index(fp, index_fp)
+
+    fileobj = indexed_gzip.IndexedGzipFile(fp, index_file=index_fp)
+    file_map = {
+        'header': nibabel.FileHolder(filename=fp, fileobj=fileobj),
+        'image': nibabel.FileHolder(filename=fp, fileobj=fileobj)
+    }
+    image = nibabel.Nifti1Image.from_file_map(file_map)
+    return image, fileobj
+
+
+def load_npy(fp: str, mmap_mode: str = None):
     """
     Load np.ndarray from file
+
+    :param mmap_mode: if not None, memory-map the file instead of reading it into memory.
+    see `np.load` for available modes
     """
-    data = np.load(fp, allow_pickle=False)
+    data = np.load(fp, mmap_mode=mmap_mode, allow_pickle=False)
     return data
 
 
@@ -79,6 +154,25 @@ def store_npy(fp: str, data: np.ndarray):
     np.save(fp, data, allow_pickle=False)
 
 
+def write_file_atomically(fp: str, write_func, mode: str = 'wb'):
+    """
+    Write file with `write_func(file_object)` to temporary file first and then rename it to `fp`,
+    so that readers never see partially written file.
+    """
+    tmp_fp = f'{fp}.{os.getpid()}.tmp'
+    with open(tmp_fp, mode) as fout:
+        write_func(fout)
+    os.replace(tmp_fp, fp)
+
+
+def get_file_md5(fp: str, chunk_size: int = 2 ** 20) -> str:
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
 def load_split_from_yaml(split_fp: str):
     with open(split_fp) as in_stream:
         split = yaml.safe_load(in_stream)
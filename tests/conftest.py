@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of the pipeline are imported relative to `src` as in `main.py`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,111 @@
+import multiprocessing as mp
+import os
+import socket
+import time
+
+import numpy as np
+
+from data.displacement_bank import DisplacementFieldBank
+
+_SHAPE = (32, 32)
+_SIGMA = 3.
+
+
+def _draw_fields(bank: DisplacementFieldBank, n_draws: int, log_fp: str):
+    random_state = np.random.RandomState(os.getpid())
+    deadline = time.time() + 30
+    n_drawn = 0
+    while n_drawn < n_draws and time.time() < deadline:
+        if bank.get_field(_SHAPE, _SIGMA, random_state) is None:
+            time.sleep(0.01)
+        else:
+            n_drawn += 1
+    with open(log_fp, 'a') as fout:
+        fout.write(f'drawn {n_drawn}\n')
+
+
+def _run_workers(bank: DisplacementFieldBank, n_workers: int, n_draws: int, log_fp: str):
+    ctx = mp.get_context('fork')
+    workers = [ctx.Process(target=_draw_fields, args=(bank, n_draws, log_fp)) for _ in range(n_workers)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    with open(log_fp) as fin:
+        lines = fin.read().splitlines()
+    return [l for l in lines if l.startswith('generated')], [l for l in lines if l.startswith('drawn')]
+
+
+def _patch_generation_log(monkeypatch, log_fp: str):
+    generate_pool = DisplacementFieldBank._generate_pool
+
+    def logged_generate_pool(self, key):
+        with open(log_fp, 'a') as fout:
+            fout.write(f'generated {key}\n')
+        # slow generation down, so that all the workers request the pool before it's ready
+        time.sleep(0.5)
+        generate_pool(self, key)
+
+    monkeypatch.setattr(DisplacementFieldBank, '_generate_pool', logged_generate_pool)
+
+
+def test_pool_is_generated_once_for_forked_workers(tmp_path, monkeypatch):
+    log_fp = str(tmp_path / 'log.txt')
+    _patch_generation_log(monkeypatch, log_fp)
+    bank = DisplacementFieldBank(str(tmp_path / 'bank'), pool_size=4)
+
+    generated, drawn = _run_workers(bank, n_workers=4, n_draws=5, log_fp=log_fp)
+    assert len(generated) == 1
+    assert drawn == ['drawn 5'] * 4
+    assert not [fn for fn in os.listdir(tmp_path / 'bank') if fn.endswith('.lock')]
+
+
+def test_refreshed_pool_is_shared_by_forked_workers(tmp_path, monkeypatch):
+    log_fp = str(tmp_path / 'log.txt')
+    _patch_generation_log(monkeypatch, log_fp)
+    bank = DisplacementFieldBank(str(tmp_path / 'bank'), pool_size=4, refresh_period=50)
+    # pool is generated before workers are started
+    _draw_fields(bank, 1, log_fp)
+
+    generated, _ = _run_workers(bank, n_workers=4, n_draws=200, log_fp=log_fp)
+    # each worker reaches refresh period 4 times. pool regenerated by one worker is picked up by the others
+    # instead of being regenerated by each of them
+    assert 1 <= len(generated) - 1 < 4
+
+
+def _get_finished_process_pid() -> int:
+    process = mp.get_context('fork').Process(target=lambda: None)
+    process.start()
+    process.join()
+    return process.pid
+
+
+def test_live_lock_is_kept(tmp_path, monkeypatch):
+    log_fp = str(tmp_path / 'log.txt')
+    _patch_generation_log(monkeypatch, log_fp)
+    bank_dp = str(tmp_path / 'bank')
+    os.makedirs(bank_dp)
+    lock_fp = f'{DisplacementFieldBank(bank_dp, pool_size=4).get_pool_fp((*_SHAPE, _SIGMA))}.lock'
+    # lock of the pool being generated by a concurrent run
+    with open(lock_fp, 'w') as fout:
+        fout.write(f'{socket.gethostname()} {os.getppid()}')
+
+    bank = DisplacementFieldBank(bank_dp, pool_size=4)
+    assert bank.get_field(_SHAPE, _SIGMA, np.random.RandomState(0)) is None
+    assert os.path.isfile(lock_fp)
+    assert not os.path.isfile(log_fp)
+
+
+def test_stale_lock_is_broken(tmp_path, monkeypatch):
+    log_fp = str(tmp_path / 'log.txt')
+    _patch_generation_log(monkeypatch, log_fp)
+    bank = DisplacementFieldBank(str(tmp_path / 'bank'), pool_size=4)
+    lock_fp = f'{bank.get_pool_fp((*_SHAPE, _SIGMA))}.lock'
+    # lock of a process killed during generation
+    with open(lock_fp, 'w') as fout:
+        fout.write(f'{socket.gethostname()} {_get_finished_process_pid()}')
+
+    _draw_fields(bank, 1, log_fp)
+    with open(log_fp) as fin:
+        assert fin.read().splitlines() == [f'generated {(*_SHAPE, _SIGMA)}', 'drawn 1']
+    assert not os.path.isfile(lock_fp)
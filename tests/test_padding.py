@@ -0,0 +1,15 @@
+import pytest
+import torch
+
+from data import preprocessing
+from model import UNet, MobileNetV2_UNet
+
+
+@pytest.mark.parametrize('create_net', [lambda: UNet(n_channels=1, n_classes=1), MobileNetV2_UNet])
+@pytest.mark.parametrize('shape', [(80, 64), (112, 96), (144, 128)])
+def test_padded_slices_fit_all_architectures(create_net, shape):
+    h, w = preprocessing.get_padded_shape([shape])
+    net = create_net().eval()
+    with torch.no_grad():
+        out = net(torch.zeros(1, 1, h, w))
+    assert tuple(out.shape) == (1, 1, h, w)
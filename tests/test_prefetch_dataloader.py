@@ -0,0 +1,147 @@
+import multiprocessing as mp
+import threading
+import time
+
+import numpy as np
+
+from data.dataloaders import BaseDataLoader, PrefetchDataLoader
+
+_TIMEOUT_SECONDS = 10
+
+
+class _Dataset:
+    n_images = 1
+
+    def __init__(self, n_samples: int, shape: tuple = (16, 16)):
+        self._n_samples = n_samples
+        self._shape = shape
+
+    def __len__(self):
+        return self._n_samples
+
+    def __getitem__(self, ix):
+        return {
+            'scan': np.full(self._shape, ix, dtype=np.int16),
+            'mask': np.zeros(self._shape, dtype=np.uint8),
+            'description': str(ix)
+        }
+
+    def get_max_slice_shape(self):
+        return self._shape
+
+    def get_scan_dtype(self):
+        return np.dtype(np.int16)
+
+
+class _RecordingLoader(BaseDataLoader):
+    """
+    Loader that counts how many times each batch is built in worker processes.
+    Building of the first batch can be held until it's released, so later batches are received first.
+    """
+
+    def __init__(self, dataset: _Dataset, batch_size: int):
+        self._dataset = dataset
+        self._batch_size = batch_size
+        # shared with worker processes forked later
+        ctx = mp.get_context('fork')
+        self._first_batch_released = ctx.Event()
+        self._first_batch_released.set()
+        self._n_builds = ctx.Array('i', self.n_batches)
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def get_batch_indices(self):
+        indices = np.arange(len(self._dataset))
+        return [indices[a: a + self._batch_size] for a in range(0, len(indices), self._batch_size)]
+
+    def get_batch(self, indices):
+        batch_ix = int(indices[0]) // self._batch_size
+        if batch_ix == 0:
+            self._first_batch_released.wait(timeout=_TIMEOUT_SECONDS)
+        samples = [self._dataset[ix] for ix in indices]
+        with self._n_builds.get_lock():
+            self._n_builds[batch_ix] += 1
+        return [s['scan'] for s in samples], [s['mask'] for s in samples], [s['description'] for s in samples]
+
+    def hold_first_batch(self):
+        self._first_batch_released.clear()
+
+    def release_first_batch(self):
+        self._first_batch_released.set()
+
+    def get_n_builds(self) -> list:
+        return list(self._n_builds[:])
+
+
+def _release_first_batch_when_built(loader: _RecordingLoader, batch_ixs: list):
+    """
+    Release held first batch once batches `batch_ixs` are built once more, or after timeout.
+    :return: (thread, list to which the thread appends whether the batches were built before timeout)
+    """
+    n_builds_start = loader.get_n_builds()
+    built = []
+
+    def release():
+        deadline = time.time() + _TIMEOUT_SECONDS
+        while True:
+            n_builds = loader.get_n_builds()
+            is_built = all(n_builds[ix] > n_builds_start[ix] for ix in batch_ixs)
+            if is_built or time.time() > deadline:
+                break
+            time.sleep(0.01)
+        built.append(is_built)
+        loader.release_first_batch()
+
+    thread = threading.Thread(target=release, daemon=True)
+    thread.start()
+    return thread, built
+
+
+def _create_loaders(prefetch_depth: int = 4):
+    loader = _RecordingLoader(_Dataset(n_samples=32), batch_size=2)
+    return loader, PrefetchDataLoader(loader, n_workers=4, prefetch_depth=prefetch_depth)
+
+
+def test_slots_are_given_back_when_generator_is_closed_early():
+    loader, prefetch_loader = _create_loaders(prefetch_depth=4)
+    try:
+        gen = prefetch_loader.get_generator()
+        next(gen)
+        # task of the 5th batch is submitted to the slot of the first one and is in flight
+        next(gen)
+        gen.close()
+        # results of the tasks in flight are received during the next epoch
+        assert len(list(prefetch_loader.get_generator())) == prefetch_loader.n_batches
+
+        # all 4 slots are free again: 3 batches are built while the first one is held
+        loader.hold_first_batch()
+        thread, built = _release_first_batch_when_built(loader, [1, 2, 3])
+        assert len(list(prefetch_loader.get_generator())) == prefetch_loader.n_batches
+        thread.join()
+        assert built == [True]
+    finally:
+        prefetch_loader.shutdown()
+
+
+def test_batches_are_yielded_in_order_after_early_stop():
+    loader, prefetch_loader = _create_loaders(prefetch_depth=4)
+    try:
+        # later batches are built before the first one, so they are received out of order
+        loader.hold_first_batch()
+        thread, built = _release_first_batch_when_built(loader, [1, 2, 3])
+        for _ in range(3):
+            for batch_ix, _ in enumerate(prefetch_loader.get_generator(), start=1):
+                if batch_ix >= 2:
+                    break
+        thread.join()
+        assert built == [True]
+
+        scans = [scans for (scans, _, _) in prefetch_loader.get_generator()]
+        assert [int(s[0][0, 0]) for s in scans] == list(range(0, 32, 2))
+    finally:
+        prefetch_loader.shutdown()
@@ -0,0 +1,124 @@
+import os
+import random
+import time
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
+import const
+from data.dataloaders import DataLoaderWithAugmentations, PrefetchDataLoader
+from model.checkpoints import get_training_state_fp, load_training_state
+from model.losses import NegDiceLoss
+from model.utils import train_valid
+
+_SHAPE = (32, 32)
+_N_SLICES = 8
+# 4 train batches and 4 valid batches per epoch
+_ORIG_IMG_PER_BATCH = 2
+
+
+class _ToyDataset:
+    n_images = 1
+
+    def __len__(self):
+        return _N_SLICES
+
+    def __getitem__(self, ix):
+        scan = np.random.RandomState(ix).randint(0, 100, size=_SHAPE).astype(np.int16)
+        # draw from the global random state as augmentations of datasets do.
+        # samples read in the main process only would change the state of resumed runs
+        scan += np.int16(np.random.randint(-5, 6))
+        return {
+            'scan': scan,
+            'mask': (scan > 50).astype(np.uint8),
+            'description': str(ix),
+            'to_augment': False
+        }
+
+    def get_max_slice_shape(self):
+        return _SHAPE
+
+    def get_scan_dtype(self):
+        return np.dtype(np.int16)
+
+
+class _InterruptedError(Exception):
+    pass
+
+
+class InterruptingMetric(nn.Module):
+    """Metric that raises on `interrupt_on`-th call to simulate preemption of training."""
+
+    def __init__(self, interrupt_on: int = None):
+        super().__init__()
+        self._interrupt_on = interrupt_on
+        self._n_calls = 0
+
+    def forward(self, input, target):
+        self._n_calls += 1
+        if self._n_calls == self._interrupt_on:
+            raise _InterruptedError()
+        return input.new_zeros(())
+
+
+def _create_loaders(n_workers: int):
+    train_loader = DataLoaderWithAugmentations(
+        _ToyDataset(), orig_img_per_batch=_ORIG_IMG_PER_BATCH, aug_cnt=1, to_shuffle=True
+    )
+    valid_loader = DataLoaderWithAugmentations(
+        _ToyDataset(), orig_img_per_batch=_ORIG_IMG_PER_BATCH, aug_cnt=0, to_shuffle=False
+    )
+    if n_workers > 0:
+        train_loader = PrefetchDataLoader(train_loader, n_workers=n_workers)
+        valid_loader = PrefetchDataLoader(valid_loader, n_workers=n_workers)
+    return train_loader, valid_loader
+
+
+def _run(out_dp: str, n_workers: int, interrupt_on: int = None, resume_state: dict = None):
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    net = nn.Sequential(nn.Conv2d(1, 1, 3, padding=1), nn.Sigmoid())
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+    train_loader, valid_loader = _create_loaders(n_workers)
+    try:
+        return train_valid(
+            net=net, loss_func=NegDiceLoss(), metrics=[NegDiceLoss(), InterruptingMetric(interrupt_on)],
+            train_loader=train_loader, valid_loader=valid_loader,
+            optimizer=optimizer, scheduler=ReduceLROnPlateau(optimizer), device=torch.device('cpu'),
+            n_epochs=3, es_tolerance=0, es_patience=10, out_dp=out_dp,
+            state_every=1, resume_state=resume_state
+        )
+    finally:
+        for loader in [train_loader, valid_loader]:
+            if isinstance(loader, PrefetchDataLoader):
+                loader.shutdown()
+
+
+def _wait_for_training_state(checkpoints_dp: str) -> dict:
+    # state is written by the background checkpoint writer of the interrupted run.
+    # any state it has written so far is fine to resume from
+    fp = get_training_state_fp(checkpoints_dp)
+    deadline = time.time() + 30
+    while not os.path.isfile(fp) and time.time() < deadline:
+        time.sleep(0.1)
+    return load_training_state(checkpoints_dp)
+
+
+@pytest.mark.parametrize('n_workers', [0, 2])
+def test_resumed_training_reproduces_history(tmp_path, n_workers):
+    history = _run(str(tmp_path / 'full'), n_workers)
+
+    # 8 calls during epoch 1 (4 train + 4 valid batches), interrupt on the 3rd train batch of epoch 2
+    with pytest.raises(_InterruptedError):
+        _run(str(tmp_path / 'interrupted'), n_workers, interrupt_on=11)
+    state = _wait_for_training_state(str(tmp_path / 'interrupted' / const.MODEL_CHECKPOINTS_DN))
+
+    history_resumed = _run(str(tmp_path / 'resumed'), n_workers, resume_state=state)
+
+    assert history_resumed['metrics'] == history['metrics']
+    assert history_resumed['best_epoch_ix'] == history['best_epoch_ix']